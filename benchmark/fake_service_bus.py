@@ -0,0 +1,138 @@
+import os
+import sys
+import types
+import threading
+from multiprocessing.managers import BaseManager
+
+sys.path.insert(
+    1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scoring_app")
+)
+from receiver import InMemoryTransport
+
+
+class FakeQueues:
+    """
+    The queues of a fake Service Bus namespace, kept in the QueueManager's
+    server process so the enqueuer and every worker process share them.
+    Each queue is an InMemoryTransport with its peek-lock semantics.
+    """
+
+    def __init__(self, lock_duration=30.0):
+        """
+        :param lock_duration: how long a received message stays locked, in seconds
+        """
+        self.lock_duration = lock_duration
+        self._queues = {}
+        self._locked = {}
+        self._lock = threading.Lock()
+
+    def _queue(self, queue):
+        with self._lock:
+            transport = self._queues.get(queue)
+            if transport is None:
+                transport = self._queues[queue] = InMemoryTransport(
+                    lock_duration=self.lock_duration
+                )
+            return transport
+
+    def send(self, queue, bodies):
+        transport = self._queue(queue)
+        for body in bodies:
+            transport.send(body)
+
+    def receive(self, queue, timeout):
+        """
+        returns the (message_id, body) of a locked message, or None
+        """
+        msg = self._queue(queue).receive(timeout)
+        if msg is None:
+            return None
+        with self._lock:
+            self._locked[(queue, msg.message_id)] = msg
+        return msg.message_id, msg.body
+
+    def delete(self, queue, message_id):
+        with self._lock:
+            msg = self._locked.pop((queue, message_id), None)
+        if msg is not None:
+            self._queue(queue).complete(msg)
+
+    def unlock(self, queue, message_id):
+        with self._lock:
+            msg = self._locked.pop((queue, message_id), None)
+        if msg is not None:
+            self._queue(queue).abandon(msg)
+
+    def renew_lock(self, queue, message_id):
+        with self._lock:
+            msg = self._locked.get((queue, message_id))
+        if msg is not None:
+            self._queue(queue).renew_lock(msg)
+
+    def count(self, queue):
+        return len(self._queue(queue))
+
+
+class QueueManager(BaseManager):
+    pass
+
+
+QueueManager.register("FakeQueues", FakeQueues)
+
+
+class FakeMessage:
+    """
+    A received message, with the calls ServiceBusTransport makes on it.
+    """
+
+    def __init__(self, bus_service, queue, message_id=None, body=None):
+        self.bus_service = bus_service
+        self.queue = queue
+        self.message_id = message_id
+        self.body = body
+        self.broker_properties = {}
+
+    def delete(self):
+        self.bus_service.queues.delete(self.queue, self.message_id)
+
+    def unlock(self):
+        self.bus_service.queues.unlock(self.queue, self.message_id)
+
+    def renew_lock(self):
+        self.bus_service.queues.renew_lock(self.queue, self.message_id)
+
+
+class FakeServiceBus:
+    """
+    Stand-in for the ServiceBusService client with the calls the orchestrator
+    and the workers make, backed by a FakeQueues proxy.
+
+    Usage:
+        manager = QueueManager()
+        manager.start()
+        bus_service = FakeServiceBus(manager.FakeQueues())
+    """
+
+    def __init__(self, queues):
+        """
+        :param queues: a FakeQueues proxy, can be passed on to other processes
+        """
+        self.queues = queues
+
+    def send_queue_message(self, queue_name, message):
+        self.queues.send(queue_name, [message.body])
+
+    def send_queue_message_batch(self, queue_name, messages):
+        self.queues.send(queue_name, [message.body for message in messages])
+
+    def receive_queue_message(self, queue_name, peek_lock=True, timeout=60):
+        received = self.queues.receive(queue_name, timeout)
+        if received is None:
+            return FakeMessage(self, queue_name)
+        msg = FakeMessage(self, queue_name, *received)
+        if not peek_lock:
+            msg.delete()
+        return msg
+
+    def get_queue(self, queue_name):
+        return types.SimpleNamespace(message_count=self.queues.count(queue_name))
@@ -0,0 +1,320 @@
+"""
+End-to-end benchmark of the scoring pipeline without Azure: synthetic frames
+and a randomly initialised style model are written to a temp dir that stands
+in for the blob mount, the orchestrator's add_images_to_queue fills an
+in-memory Service Bus queue, and N worker processes score it with dequeue.
+
+Usage:
+    python benchmark/run_benchmark.py --workers 2 --frames 200 --output run.json
+    python benchmark/run_benchmark.py --workers 2 --baseline run.json
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+VIDEO_NAME = "bench"
+MODEL_DIR = os.path.join("models", "bench")
+QUEUE = "bench"
+
+
+def _use_app(app):
+    """
+    put flask_app or scoring_app first on the path, the apps have modules of
+    the same name so each process imports from one of them only
+    """
+    sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", app))
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _setup(mount_dir, frames, width, height, frame_format):
+    _use_app("scoring_app")
+    import synthetic
+
+    synthetic.make_frames(
+        os.path.join(mount_dir, VIDEO_NAME, "input_frames"),
+        frames,
+        width,
+        height,
+        frame_format=frame_format,
+    )
+    synthetic.make_model(os.path.join(mount_dir, MODEL_DIR))
+
+
+def _enqueue(queues, mount_dir, frame_format, chunk_size, workers, results):
+    _use_app("flask_app")
+    from add_images_to_queue import add_images_to_queue
+    from fake_service_bus import FakeServiceBus
+
+    t0 = time.time()
+    add_images_to_queue(
+        mount_dir,
+        QUEUE,
+        VIDEO_NAME,
+        FakeServiceBus(queues),
+        frame_format=frame_format,
+        chunk_size=chunk_size,
+        workers=workers,
+    )
+    results.put({"enqueue_seconds": time.time() - t0})
+
+
+def _score(queues, mount_dir, threads, options, results):
+    _use_app("scoring_app")
+    import torch
+    from process_images_from_queue import dequeue
+    from fake_service_bus import FakeServiceBus
+
+    if threads:
+        torch.set_num_threads(threads)
+    try:
+        dequeue(
+            FakeServiceBus(queues),
+            MODEL_DIR,
+            QUEUE,
+            mount_dir,
+            terminate=True,
+            **options
+        )
+    except SystemExit:
+        pass
+    finally:
+        results.put({"pid": os.getpid(), "peak_rss_mb": _peak_rss_mb()})
+
+
+def _run(ctx, target, *args):
+    process = ctx.Process(target=target, args=args)
+    process.start()
+    return process
+
+
+def _join(processes):
+    for process in processes:
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(
+                "{} exited with {}".format(process.name, process.exitcode)
+            )
+
+
+def percentile(values, p):
+    """
+    returns the nearest-rank p-th percentile of the values
+    """
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def stage_latencies(records, percentiles=(50, 90, 99)):
+    """
+    returns dict of stage -> {"p50", "p90", "p99", "mean"} seconds over the
+    frame log records
+    """
+    seconds = {}
+    for record in records:
+        for stage, value in record["stages"].items():
+            seconds.setdefault(stage, []).append(value)
+    return {
+        stage: dict(
+            [("p{}".format(p), percentile(values, p)) for p in percentiles],
+            mean=sum(values) / len(values),
+        )
+        for stage, values in sorted(seconds.items())
+    }
+
+
+def summarize(mount_dir, started, frames, worker_results):
+    """
+    returns the results of a run from the frame log of the video, the
+    throughput is measured up to the last frame so the workers' idle wait for
+    an empty queue before they exit is not counted
+    """
+    _use_app("scoring_app")
+    import frame_log
+
+    records = frame_log.read_records(mount_dir, VIDEO_NAME)
+    done = [r for r in records if r["error"] is None]
+    seconds = (records[-1]["time"] - started) if records else 0.0
+    return {
+        "frames": frames,
+        "done": len(done),
+        "failed": len(records) - len(done),
+        "seconds": seconds,
+        "fps": len(done) / seconds if seconds > 0 else 0.0,
+        "first_frame_seconds": (records[0]["time"] - started) if records else None,
+        "stages": stage_latencies(done),
+        "peak_rss_mb": {
+            "workers": [r["peak_rss_mb"] for r in worker_results],
+            "max": max(r["peak_rss_mb"] for r in worker_results),
+        },
+    }
+
+
+def run(args):
+    """
+    returns the results of a benchmark run with the parsed args
+    """
+    from fake_service_bus import QueueManager
+
+    ctx = multiprocessing.get_context("spawn")
+    mount_dir = tempfile.mkdtemp(prefix="bench-mount-")
+    try:
+        _join(
+            [
+                _run(
+                    ctx,
+                    _setup,
+                    mount_dir,
+                    args.frames,
+                    args.width,
+                    args.height,
+                    args.frame_format,
+                )
+            ]
+        )
+
+        manager = QueueManager(ctx=ctx)
+        manager.start()
+        queues = manager.FakeQueues(lock_duration=args.lock_duration)
+        results = ctx.Queue()
+
+        _join(
+            [
+                _run(
+                    ctx,
+                    _enqueue,
+                    queues,
+                    mount_dir,
+                    args.frame_format,
+                    args.chunk_size,
+                    args.workers,
+                    results,
+                )
+            ]
+        )
+        enqueued = results.get()
+
+        options = {
+            "batch_size": args.batch_size,
+            "pipeline_depth": args.pipeline_depth,
+            "precision": args.precision,
+            "channels_last": args.channels_last,
+        }
+        started = time.time()
+        workers = [
+            _run(ctx, _score, queues, mount_dir, args.threads, options, results)
+            for _ in range(args.workers)
+        ]
+        worker_results = [results.get() for _ in workers]
+        _join(workers)
+        manager.shutdown()
+
+        summary = summarize(mount_dir, started, args.frames, worker_results)
+        summary.update(enqueued)
+    finally:
+        if not args.keep:
+            shutil.rmtree(mount_dir, ignore_errors=True)
+        else:
+            print("Kept mount dir {}".format(mount_dir))
+
+    summary["config"] = {
+        k: v for k, v in vars(args).items() if k not in ("output", "baseline", "keep")
+    }
+    summary["host"] = {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+    }
+    summary["time"] = time.time()
+    return summary
+
+
+def compare(result, baseline, tolerance):
+    """
+    returns whether the throughput of the result is within `tolerance` of the
+    baseline, and prints the change of the throughput and stage latencies
+    """
+    change = result["fps"] / baseline["fps"] - 1 if baseline["fps"] else 0.0
+    print(
+        "fps: {:.2f} -> {:.2f} ({:+.1%})".format(
+            baseline["fps"], result["fps"], change
+        )
+    )
+    for stage, latencies in result["stages"].items():
+        before = baseline["stages"].get(stage)
+        if before:
+            print(
+                "{} p50: {:.4f}s -> {:.4f}s".format(
+                    stage, before["p50"], latencies["p50"]
+                )
+            )
+    return change >= -tolerance
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=360)
+    parser.add_argument(
+        "--frame-format", choices=["jpeg", "raw", "zlib"], default="jpeg"
+    )
+    parser.add_argument(
+        "--chunk-size",
+        default=None,
+        help="frames per work unit, auto or a number, one message per frame if unset",
+    )
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--pipeline-depth", type=int, default=0)
+    parser.add_argument(
+        "--precision", choices=["fp32", "bf16", "fp16"], default="fp32"
+    )
+    parser.add_argument("--channels-last", action="store_true")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="torch threads per worker, the cores are split between workers if unset",
+    )
+    parser.add_argument("--lock-duration", type=float, default=30.0)
+    parser.add_argument("--output", help="save the results as json to this file")
+    parser.add_argument("--baseline", help="compare with the json results of a run")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="the fraction the fps may drop below the baseline",
+    )
+    parser.add_argument("--keep", action="store_true", help="keep the mount dir")
+    args = parser.parse_args()
+    if args.chunk_size not in (None, "auto"):
+        args.chunk_size = int(args.chunk_size)
+    if args.threads is None:
+        args.threads = max(1, (os.cpu_count() or 1) // args.workers)
+
+    result = run(args)
+    print(json.dumps(result, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(result, baseline, args.tolerance):
+            print("Throughput regressed by more than {:.0%}".format(args.tolerance))
+            sys.exit(1)
@@ -0,0 +1,77 @@
+import os
+import numpy as np
+from PIL import Image
+
+
+def frame_pixels(index, width, height, seed=0):
+    """
+    returns a HxWx3 uint8 frame of a gradient that moves from frame to frame,
+    with noise so that no two frames are alike
+    """
+    rng = np.random.RandomState(seed + index)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    pixels = np.empty((height, width, 3), np.float32)
+    pixels[..., 0] = (x + index * 4) % 256
+    pixels[..., 1] = (y + index * 2) % 256
+    pixels[..., 2] = (x + y) / 2
+    pixels += rng.normal(0, 8, pixels.shape)
+    return pixels.clip(0, 255).astype(np.uint8)
+
+
+def make_frames(input_dir, count, width, height, frame_format="jpeg", seed=0):
+    """
+    write `count` synthetic frames to the input dir of a video, as
+    `%06d_frame.jpg` files or to a chunk store
+
+    :param input_dir: the input frames dir of the video
+    :param count: the number of frames
+    :param width: the width of the frames
+    :param height: the height of the frames
+    :param frame_format: (optional) jpeg, raw or zlib
+    :param seed: (optional) the seed of the noise
+
+    returns the names of the frames
+    """
+    import frame_store
+
+    os.makedirs(input_dir, exist_ok=True)
+    frames = []
+    writer = None
+    for index in range(1, count + 1):
+        pixels = frame_pixels(index, width, height, seed=seed)
+        if frame_format == "jpeg":
+            filename = "{:06d}_frame.jpg".format(index)
+            Image.fromarray(pixels).save(os.path.join(input_dir, filename))
+            frames.append(filename)
+            continue
+        if writer is None:
+            writer = frame_store.ChunkWriter(
+                input_dir,
+                "input-{:06d}".format((index - 1) // 100),
+                compression=frame_format,
+            )
+        frames.append(frame_store.frame_id(index))
+        writer.append(frames[-1], pixels)
+        if len(writer) == 100:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+    return frames
+
+
+def make_model(model_dir, seed=0):
+    """
+    save a randomly initialised TransformerNet as model.pth, it runs exactly
+    like a trained style model
+    """
+    import torch
+    import style_transfer
+
+    os.makedirs(model_dir, exist_ok=True)
+    torch.manual_seed(seed)
+    torch.save(
+        style_transfer.TransformerNet().state_dict(),
+        os.path.join(model_dir, style_transfer.MODEL_FILES["eager"]),
+    )
@@ -1,16 +1,150 @@
 from azure.servicebus import ServiceBusService, Message, Queue
 from azure.storage.blob import BlockBlobService
-from util import Parser, get_handler_format
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import requests
+import json
 import time
 import sys
 import subprocess
 import os
 import logging
-from util import Parser, Storage 
+import math
+import uuid
+from util import Parser, Storage, get_handler_format, job_thread
+import frame_store
+import message_codec
+
+
+# the broker rejects batches above 256KB, leave room for the batch envelope
+MAX_BATCH_BYTES = 250 * 1024
+
+# the broker properties and JSON envelope added to each message in a batch
+_MESSAGE_OVERHEAD = 256
+
+
+def make_bus_service(namespace, key_name, key_value, pool_size=8):
+    """
+    returns a service bus client whose HTTP connections are pooled, so that
+    batches can be sent concurrently without opening a connection each
+
+    :param namespace: the service bus namespace
+    :param key_name: the shared access key name
+    :param key_value: the shared access key value
+    :param pool_size: (optional) the number of pooled connections
+    """
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+    return ServiceBusService(
+        service_namespace=namespace,
+        shared_access_key_name=key_name,
+        shared_access_key_value=key_value,
+        request_session=session,
+    )
+
+
+class MessageSender:
+    """
+    Encodes message bodies with `message_codec` and sends them in batches
+    filled up to the broker's byte limit, with up to `concurrency` batches
+    in flight at once.
+
+    Usage:
+        with MessageSender(bus_service, queue) as sender:
+            sender.send({"video_name": video_name, "input_frame": filename})
+    """
+
+    def __init__(
+        self,
+        bus_service,
+        queue,
+        max_batch_bytes=MAX_BATCH_BYTES,
+        max_batch_wait=None,
+        concurrency=4,
+    ):
+        """
+        :param bus_service: service bus client, see `make_bus_service`
+        :param queue: the queue to add messages to
+        :param max_batch_bytes: (optional) the largest batch to send
+        :param max_batch_wait: (optional) send a batch once its first message has
+            waited this many seconds, for messages that trickle in
+        :param concurrency: (optional) the number of batches sent at once
+        """
+        self.bus_service = bus_service
+        self.queue = queue
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_wait = max_batch_wait
+        self.concurrency = concurrency
+        self.count = 0
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_start = None
+        self._pending = []
+        self._executor = ThreadPoolExecutor(concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def send(self, msg_body):
+        data = message_codec.encode(msg_body)
+        size = len(json.dumps(data.decode("utf-8"))) + _MESSAGE_OVERHEAD
+        if self._batch and self._batch_bytes + size > self.max_batch_bytes:
+            self.flush()
+
+        self._batch.append(Message(data))
+        self._batch_bytes += size
+        self.count += 1
+        if self._batch_start is None:
+            self._batch_start = time.time()
+
+        if (
+            self.max_batch_wait is not None
+            and time.time() - self._batch_start >= self.max_batch_wait
+        ):
+            self.flush()
+
+    def flush(self):
+        if not self._batch:
+            return
+
+        # bound the batches in flight, re-raising the error of a failed send
+        while len(self._pending) >= self.concurrency * 2:
+            self._pending.pop(0).result()
+
+        self._pending.append(
+            self._executor.submit(
+                job_thread(self.bus_service.send_queue_message_batch),
+                self.queue,
+                self._batch,
+            )
+        )
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_start = None
+
+    def close(self):
+        try:
+            self.flush()
+            while self._pending:
+                self._pending.pop(0).result()
+        finally:
+            self._executor.shutdown()
 
 
 def add_images_to_queue(
-    mount_dir, queue, video_name, bus_service, queue_limit=None
+    mount_dir,
+    queue,
+    video_name,
+    bus_service,
+    queue_limit=None,
+    frame_format="jpeg",
+    chunk_size=None,
+    workers=1,
+    frames=None,
+    model_dirs=None,
 ):
     """
     :param mount_dir: mount directory for storage container
@@ -18,9 +152,42 @@ def add_images_to_queue(
     :param video_name: the name of the video file (excluding ext)
     :param bus_service: service bus client
     :param queue_limit: (optional) an optional queue limit to stop queuing at
+    :param frame_format: (optional) jpeg, or raw or zlib if the frames are in a
+        chunk store
+    :param chunk_size: (optional) if set, queue work units of this many frames
+        instead of one message per frame, auto to derive it from the frame count
+    :param workers: (optional) the number of scoring workers, for an auto chunk_size
+    :param frames: (optional) only queue these frames, e.g. the ones a resumed job
+        has not finished yet
+    :param model_dirs: (optional) render the frames in the style of each of these
+        model dirs instead of the worker's model
 
     returns total images added to queue
     """
+    if chunk_size is not None:
+        return add_units_to_queue(
+            mount_dir,
+            queue,
+            video_name,
+            bus_service,
+            chunk_size,
+            frame_format=frame_format,
+            workers=workers,
+            frames=frames,
+            model_dirs=model_dirs,
+            queue_limit=queue_limit,
+        )
+    if frame_format != "jpeg":
+        return add_chunks_to_queue(
+            mount_dir,
+            queue,
+            video_name,
+            bus_service,
+            frames=frames,
+            model_dirs=model_dirs,
+            queue_limit=queue_limit,
+        )
+
     # set input/output dirs
     input_dir = os.path.join(mount_dir, video_name, Storage.INPUT_DIR.value)
     output_dir = os.path.join(mount_dir, video_name, Storage.OUTPUT_DIR.value)
@@ -29,39 +196,195 @@ def add_images_to_queue(
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    # count number of frames in input dir
-    path, dirs, files = next(os.walk(input_dir))
-    file_count = len(files)
+    # queue frames in order, so early frames finish first
+    if frames is None:
+        frames = [f for f in os.listdir(input_dir) if not f.startswith(".")]
+    frames = _limit(sorted(frames), queue_limit)
+
+    return enqueue_frames(frames, queue, video_name, bus_service, model_dirs=model_dirs)
+
+
+def _limit(frames, queue_limit):
+    """
+    returns the first `queue_limit` of the frames, or all of them if it is None
+    """
+    logger = logging.getLogger("root")
+
+    if queue_limit is not None and len(frames) > queue_limit:
+        logger.debug("Queue limit of {} frames is reached.".format(queue_limit))
+        frames = frames[:queue_limit]
+    return frames
+
+
+def _with_styles(msg_body, model_dirs):
+    """
+    returns the message body with the model dirs to render its frames with
+    """
+    if model_dirs:
+        msg_body["model_dirs"] = list(model_dirs)
+    return msg_body
+
+
+def add_chunks_to_queue(
+    mount_dir,
+    queue,
+    video_name,
+    bus_service,
+    frames=None,
+    model_dirs=None,
+    queue_limit=None,
+):
+    """
+    Queue the frames of a chunk store; each message references the chunk and
+    offset of its frame instead of a JPEG file.
+
+    :param mount_dir: mount directory for storage container
+    :param queue: the queue to add messages to
+    :param video_name: the name of the video file (excluding ext)
+    :param bus_service: service bus client
+    :param frames: (optional) only queue these frames
+    :param model_dirs: (optional) render the frames in the style of each of these
+        model dirs instead of the worker's model
+    :param queue_limit: (optional) only queue the first this many frames
+
+    returns total images added to queue
+    """
+    input_dir = os.path.join(mount_dir, video_name, Storage.INPUT_DIR.value)
+    output_dir = os.path.join(mount_dir, video_name, Storage.OUTPUT_DIR.value)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    if frames is not None:
+        frames = set(frames)
+    refs = [
+        ref
+        for ref in frame_store.load_index(input_dir).values()
+        if frames is None or ref["frame"] in frames
+    ]
+    refs = _limit(refs, queue_limit)
+    with MessageSender(bus_service, queue) as sender:
+        for ref in refs:
+            msg_body = {
+                "input_frame": ref["frame"],
+                "input_chunk": ref,
+                "video_name": video_name,
+            }
+            sender.send(_with_styles(msg_body, model_dirs))
 
-    # set up variables for adding messages to the queue in batch
-    msg_batch = []
-    batch_size = 500
+    return len(refs)
 
-    # iterate through all images in input dir
-    for i, filename in enumerate(os.listdir(input_dir)):
 
-        if queue_limit is not None and i >= queue_limit:
-            logger.debug("Queue limit is reached. Exiting process...")
-            exit(0)
+def auto_chunk_size(frame_count, workers, units_per_worker=4, maximum=256):
+    """
+    returns a work unit size that gives every worker about `units_per_worker`
+    units, so the last units do not leave most workers idle
 
-        msg_body = {
-            "input_frame": filename,
-            "video_name": video_name
-        }
-        msg = Message(str(msg_body).encode())
-        msg_batch.append(msg)
+    :param frame_count: the number of frames of the video
+    :param workers: the number of scoring workers
+    :param units_per_worker: (optional) the number of units per worker to aim for
+    :param maximum: (optional) the largest work unit
+    """
+    return max(1, min(maximum, math.ceil(frame_count / (workers * units_per_worker))))
 
-        if i > 0:
-            if queue_limit:
-                condition = i % batch_size == 0 or i == queue_limit - 1
-            else:
-                condition = i % batch_size == 0 or i == file_count - 1
 
-            if condition:
-                bus_service.send_queue_message_batch(queue, msg_batch)
-                msg_batch = []
+def add_units_to_queue(
+    mount_dir,
+    queue,
+    video_name,
+    bus_service,
+    chunk_size,
+    frame_format="jpeg",
+    workers=1,
+    frames=None,
+    model_dirs=None,
+    queue_limit=None,
+):
+    """
+    Queue the frames of a video as work units, each message carries a list
+    of up to `chunk_size` consecutive frames. Workers checkpoint the frames
+    of a unit they finished, so a redelivered unit only reprocesses the rest.
+    The units of each call are named after a run id of their own, so a unit
+    queued again for a resumed or rerun video never matches an old checkpoint.
 
-    return file_count
+    :param mount_dir: mount directory for storage container
+    :param queue: the queue to add messages to
+    :param video_name: the name of the video file (excluding ext)
+    :param bus_service: service bus client
+    :param chunk_size: the number of frames per unit, or auto
+    :param frame_format: (optional) jpeg, or raw or zlib if the frames are in a
+        chunk store
+    :param workers: (optional) the number of scoring workers, for an auto chunk_size
+    :param frames: (optional) only queue these frames
+    :param model_dirs: (optional) render the frames in the style of each of these
+        model dirs instead of the worker's model
+    :param queue_limit: (optional) only queue the first this many frames
+
+    returns total images added to queue
+    """
+    input_dir = os.path.join(mount_dir, video_name, Storage.INPUT_DIR.value)
+    output_dir = os.path.join(mount_dir, video_name, Storage.OUTPUT_DIR.value)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    if frame_format == "jpeg":
+        unit_frames = [
+            {"input_frame": filename}
+            for filename in sorted(os.listdir(input_dir))
+            if not filename.startswith(".")
+        ]
+    else:
+        unit_frames = [
+            {"input_frame": ref["frame"], "input_chunk": ref}
+            for ref in frame_store.load_index(input_dir).values()
+        ]
+    if frames is not None:
+        frames = set(frames)
+        unit_frames = [f for f in unit_frames if f["input_frame"] in frames]
+    unit_frames = _limit(unit_frames, queue_limit)
+
+    if chunk_size == "auto":
+        chunk_size = auto_chunk_size(len(unit_frames), workers)
+    chunk_size = int(chunk_size)
+
+    run = uuid.uuid4().hex[:12]
+    with MessageSender(bus_service, queue) as sender:
+        for unit, start in enumerate(range(0, len(unit_frames), chunk_size)):
+            msg_body = {
+                "unit": "unit-{}-{:06d}".format(run, unit),
+                "frames": unit_frames[start : start + chunk_size],
+                "video_name": video_name,
+            }
+            sender.send(_with_styles(msg_body, model_dirs))
+
+    return len(unit_frames)
+
+
+def enqueue_frames(
+    frames, queue, video_name, bus_service, max_batch_wait=1.0, model_dirs=None
+):
+    """
+    Queue frames in the order given, also as they become available, e.g.
+    from `stream_preprocess`. A batch is sent when it is full or when its
+    first frame has waited `max_batch_wait` seconds, so workers can start
+    before the last frame.
+
+    :param frames: iterable of frame names (not paths)
+    :param queue: the queue to add messages to
+    :param video_name: the name of the video file (excluding ext)
+    :param bus_service: service bus client
+    :param max_batch_wait: (optional) how long a frame may wait to be sent, in seconds
+    :param model_dirs: (optional) render the frames in the style of each of these
+        model dirs instead of the worker's model
+
+    returns total images added to queue
+    """
+    with MessageSender(bus_service, queue, max_batch_wait=max_batch_wait) as sender:
+        for filename in frames:
+            msg_body = {"input_frame": filename, "video_name": video_name}
+            sender.send(_with_styles(msg_body, model_dirs))
+    return sender.count
 
 
 if __name__ == "__main__":
@@ -86,11 +409,7 @@ if __name__ == "__main__":
     logger.addHandler(console_handler)
     logger.propagate = False
 
-    bus_service = ServiceBusService(
-        service_namespace=args.namespace,
-        shared_access_key_name=args.sb_key_name,
-        shared_access_key_value=args.sb_key_value,
-    )
+    bus_service = make_bus_service(args.namespace, args.sb_key_name, args.sb_key_value)
 
     add_images_to_queue(
         mount_dir=args.storage_mount_dir,
@@ -98,4 +417,8 @@ if __name__ == "__main__":
         video_name=args.video_name,
         bus_service=bus_service,
         queue_limit=args.queue_limit,
+        frame_format=args.frame_format,
+        chunk_size=args.chunk_size,
+        workers=args.workers,
+        model_dirs=args.model_dirs,
     )
@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import threading
+from util import Storage
+
+
+class FileEventSource:
+    """
+    Reads the completion events that workers write to the events dir of
+    each video. Every events file is written once and never changed, so
+    only files that have not been read yet are opened, and once their events
+    are kept elsewhere, e.g. in the manifest, `compact` removes them so the
+    events dir only lists the files that are still to be read.
+    """
+
+    def __init__(self, mount_dir):
+        """
+        :param mount_dir: the mount directory of the storage container
+        """
+        self.mount_dir = mount_dir
+        self._read = {}
+
+    def events(self, video_name):
+        """
+        returns the events of the video written since the last call
+        """
+        events_dir = os.path.join(self.mount_dir, video_name, Storage.EVENTS_DIR.value)
+        if not os.path.isdir(events_dir):
+            return []
+
+        read = self._read.setdefault(video_name, set())
+        events = []
+        for filename in sorted(os.listdir(events_dir)):
+            # dot files are batches that are still being written
+            if filename.startswith(".") or filename in read:
+                continue
+            with open(os.path.join(events_dir, filename)) as f:
+                events.extend(json.loads(line) for line in f if line.strip())
+            read.add(filename)
+        return events
+
+    def compact(self, video_name):
+        """
+        remove the events files of the video that have been read
+        """
+        events_dir = os.path.join(self.mount_dir, video_name, Storage.EVENTS_DIR.value)
+        read = self._read.get(video_name, set())
+        for filename in list(read):
+            try:
+                os.remove(os.path.join(events_dir, filename))
+            except FileNotFoundError:
+                pass
+            read.discard(filename)
+
+
+class QueueEventSource:
+    """
+    Receives the completion events that workers send to a results queue.
+    One source serves every video; events of videos other than the one
+    asked for are kept until they are asked for.
+    """
+
+    def __init__(self, bus_service, queue, receive_timeout=1):
+        """
+        :param bus_service: service bus client
+        :param queue: the name of the results queue
+        :param receive_timeout: how long to wait for an event, in seconds
+        """
+        self.bus_service = bus_service
+        self.queue = queue
+        self.receive_timeout = receive_timeout
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def events(self, video_name):
+        """
+        returns the events of the video received since the last call
+        """
+        with self._lock:
+            while True:
+                msg = self.bus_service.receive_queue_message(
+                    self.queue, peek_lock=False, timeout=self.receive_timeout
+                )
+                if msg.body is None:
+                    break
+                event = json.loads(msg.body.decode("utf-8"))
+                self._pending.setdefault(event["video"], []).append(event)
+            return self._pending.pop(video_name, [])
+
+
+class CompletionTracker:
+    """
+    Tracks which frames of a video are done from the events published by
+    the workers, instead of listing the output dir.
+
+    Usage:
+        tracker = CompletionTracker(FileEventSource(mount_dir), video_name, frames)
+        if not tracker.wait(stall_timeout=600):
+            logger.error("Missing frames: {}".format(tracker.missing()))
+    """
+
+    def __init__(self, source, video_name, expected_frames, since=None, manifest=None):
+        """
+        :param source: a FileEventSource or QueueEventSource
+        :param video_name: the name of the video to track
+        :param expected_frames: the names of all frames of the video
+        :param since: (optional) ignore events older than this timestamp
+        :param manifest: (optional) the Manifest of the video, frames it records as
+            done count as done and every event is compacted into it
+        """
+        self.source = source
+        self.video_name = video_name
+        self.expected = set(expected_frames)
+        self.since = since
+        self.manifest = manifest
+        self.done = set()
+        self.failed = {}
+        self.workers = {}
+        self.started = self.last_progress = time.time()
+        if manifest is not None:
+            self.done.update(self.expected.intersection(manifest.frames_in("done")))
+        self._done_before = len(self.done)
+
+    def poll(self):
+        """
+        read new events, returns the number of frames that became done
+        """
+        before = len(self.done)
+        changed = False
+        for event in self.source.events(self.video_name):
+            if self.since is not None and event["time"] < self.since:
+                continue
+            frame = event["frame"]
+            if frame not in self.expected:
+                continue
+            if self.manifest is not None:
+                changed = self.manifest.apply(event) or changed
+            if event.get("worker") is not None:
+                self.workers[event["worker"]] = event["time"]
+            if event["status"] == "done":
+                self.done.add(frame)
+                self.failed.pop(frame, None)
+            elif event["status"] == "failed" and frame not in self.done:
+                # failed frames are redelivered, count the attempts
+                self.failed[frame] = self.failed.get(frame, 0) + 1
+
+        if changed:
+            self.manifest.save()
+
+        # the events are in the saved manifest, their files are not read again
+        if self.manifest is not None and hasattr(self.source, "compact"):
+            self.source.compact(self.video_name)
+        newly_done = len(self.done) - before
+        if newly_done:
+            self.last_progress = time.time()
+        return newly_done
+
+    def is_done(self):
+        return len(self.done) == len(self.expected)
+
+    def progress(self):
+        """
+        returns the percentage of frames that are done
+        """
+        if not self.expected:
+            return 100.0
+        return 100.0 * len(self.done) / len(self.expected)
+
+    def throughput(self):
+        """
+        returns the frames done per second since tracking started, frames that
+        were already done before are not counted
+        """
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return (len(self.done) - self._done_before) / elapsed
+
+    def eta(self):
+        """
+        returns the estimated seconds until every frame is done, or None before
+        the first frame is done
+        """
+        remaining = len(self.expected) - len(self.done)
+        if remaining == 0:
+            return 0.0
+        throughput = self.throughput()
+        if throughput <= 0:
+            return None
+        return remaining / throughput
+
+    def active_workers(self, window=60):
+        """
+        returns the number of workers that published an event in the last
+        `window` seconds
+        """
+        since = time.time() - window
+        return sum(1 for last_event in self.workers.values() if last_event >= since)
+
+    def active_hosts(self, window=60):
+        """
+        returns the hostnames of the workers that published an event in the
+        last `window` seconds, a scoring pod runs one or more worker processes
+        named <hostname>-<pid>
+        """
+        since = time.time() - window
+        return set(
+            worker.rsplit("-", 1)[0]
+            for worker, last_event in self.workers.items()
+            if last_event >= since
+        )
+
+    def missing(self):
+        """
+        returns the sorted names of the frames that are not done yet
+        """
+        return sorted(self.expected - self.done)
+
+    def exhausted(self, max_attempts):
+        """
+        returns True if every frame that is not done yet failed at least
+        `max_attempts` times, so waiting longer will not finish the video
+        """
+        missing = self.expected - self.done
+        return bool(missing) and all(
+            self.failed.get(frame, 0) >= max_attempts for frame in missing
+        )
+
+    def wait(
+        self, poll_interval=10, stall_timeout=None, on_progress=None, max_attempts=None
+    ):
+        """
+        :param poll_interval: how often to read new events, in seconds
+        :param stall_timeout: (optional) give up when no frame was done for this
+            many seconds
+        :param on_progress: (optional) called with the tracker after every poll
+        :param max_attempts: (optional) give up once every frame that is not done
+            failed this many times
+
+        returns True when all frames are done, False if processing stalled or
+        the missing frames failed too often
+        """
+        while True:
+            self.poll()
+            if on_progress is not None:
+                on_progress(self)
+            if self.is_done():
+                return True
+            if max_attempts is not None and self.exhausted(max_attempts):
+                return False
+            if (
+                stall_timeout is not None
+                and time.time() - self.last_progress > stall_timeout
+            ):
+                return False
+            time.sleep(poll_interval)
+
+
+# jobs share one source per results queue so that none drops the events of another
+_queue_sources = {}
+_queue_sources_lock = threading.Lock()
+
+
+def get_event_source(backend, mount_dir, bus_service=None, results_queue=None):
+    """
+    :param backend: file or queue, must match the workers' completion backend
+    :param mount_dir: the mount directory of the storage container
+    :param bus_service: (optional) service bus client, for the queue backend
+    :param results_queue: (optional) the name of the results queue, for the queue backend
+    """
+    if backend == "queue":
+        assert bus_service is not None and results_queue is not None
+        with _queue_sources_lock:
+            source = _queue_sources.get(results_queue)
+            if source is None:
+                source = _queue_sources[results_queue] = QueueEventSource(
+                    bus_service, results_queue
+                )
+            return source
+    return FileEventSource(mount_dir)
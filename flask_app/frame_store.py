@@ -0,0 +1,136 @@
+import os
+import json
+import zlib
+import collections
+import numpy as np
+
+
+# jpeg keeps one image file per frame, raw and zlib store uint8 RGB frames in
+# chunk files with a JSON index next to each chunk
+FRAME_FORMATS = ("jpeg", "raw", "zlib")
+
+CHUNK_EXT = ".chunk"
+INDEX_EXT = ".json"
+
+# an input frame in a chunk store, and where an output frame is written to
+ChunkFrame = collections.namedtuple("ChunkFrame", ["store_dir", "ref"])
+ChunkTarget = collections.namedtuple("ChunkTarget", ["writer", "frame"])
+
+
+def frame_id(index):
+    """
+    returns the id of the frame with the (1-based) index in the video
+    """
+    return "{:06d}_frame".format(index)
+
+
+class ChunkWriter:
+    """
+    Appends uint8 HxWx3 frames to a chunk file. The chunk and its index only
+    appear under their final names in `close`, so readers never see a
+    partially written chunk.
+
+    Usage:
+        writer = ChunkWriter(store_dir, "input-000001", compression="zlib")
+        writer.append(frame_id(1), pixels)
+        refs = writer.close()
+    """
+
+    def __init__(self, store_dir, name, compression="raw"):
+        """
+        :param store_dir: the dir to write the chunk to
+        :param name: the name of the chunk, without extension
+        :param compression: (optional) raw or zlib
+        """
+        assert compression in ("raw", "zlib")
+        self.store_dir = store_dir
+        self.name = name
+        self.compression = compression
+        self.refs = []
+        self._offset = 0
+        self._tmp_path = os.path.join(store_dir, ".{}{}".format(name, CHUNK_EXT))
+        self._file = open(self._tmp_path, "wb")
+
+    def __len__(self):
+        return len(self.refs)
+
+    def target(self, frame):
+        return ChunkTarget(self, frame)
+
+    def append(self, frame, pixels):
+        """
+        :param frame: the id of the frame
+        :param pixels: HxWx3 uint8 array
+
+        returns the reference to the frame in this chunk
+        """
+        pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+        data = pixels.data if self.compression == "raw" else zlib.compress(pixels, 1)
+        length = self._file.write(data)
+
+        ref = {
+            "frame": frame,
+            "chunk": self.name,
+            "offset": self._offset,
+            "length": length,
+            "shape": list(pixels.shape),
+            "compression": self.compression,
+        }
+        self._offset += length
+        self.refs.append(ref)
+        return ref
+
+    def close(self):
+        """
+        returns the references to all frames in this chunk
+        """
+        self._file.close()
+        os.replace(
+            self._tmp_path, os.path.join(self.store_dir, self.name + CHUNK_EXT)
+        )
+
+        tmp_path = os.path.join(self.store_dir, ".{}{}".format(self.name, INDEX_EXT))
+        with open(tmp_path, "w") as f:
+            json.dump({"frames": self.refs}, f)
+        os.replace(tmp_path, os.path.join(self.store_dir, self.name + INDEX_EXT))
+        return self.refs
+
+    def abort(self):
+        """
+        drop the chunk, e.g. when scoring some of its frames failed
+        """
+        self._file.close()
+        os.remove(self._tmp_path)
+
+
+def read_frame(store_dir, ref):
+    """
+    :param store_dir: the dir holding the chunk
+    :param ref: the reference to the frame, as returned by ChunkWriter.append
+
+    returns the frame as a HxWx3 uint8 array, memory-mapped for raw chunks
+    """
+    path = os.path.join(store_dir, ref["chunk"] + CHUNK_EXT)
+    shape = tuple(ref["shape"])
+    if ref["compression"] == "raw":
+        return np.memmap(path, np.uint8, "r", ref["offset"], shape)
+
+    with open(path, "rb") as f:
+        f.seek(ref["offset"])
+        data = f.read(ref["length"])
+    return np.frombuffer(zlib.decompress(data), np.uint8).reshape(shape)
+
+
+def load_index(store_dir):
+    """
+    returns an OrderedDict of frame id -> reference of every frame in the
+    store, ordered by frame id
+    """
+    refs = {}
+    for filename in os.listdir(store_dir):
+        if filename.startswith(".") or not filename.endswith(INDEX_EXT):
+            continue
+        with open(os.path.join(store_dir, filename)) as f:
+            for ref in json.load(f)["frames"]:
+                refs[ref["frame"]] = ref
+    return collections.OrderedDict(sorted(refs.items()))
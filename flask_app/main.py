@@ -1,12 +1,26 @@
 from azure.servicebus import ServiceBusService, Message, Queue
 from azure.storage.blob import BlockBlobService
-from preprocess import preprocess
-from postprocess import postprocess
-from add_images_to_queue import add_images_to_queue
-from util import Parser, get_handler_format
+from preprocess import preprocess, stream_preprocess
+from postprocess import postprocess, StreamingPostprocess
+from add_images_to_queue import add_images_to_queue, enqueue_frames, make_bus_service
+from completion import CompletionTracker, get_event_source
+import frame_store
+from manifest import Manifest
+from util import (
+    JobFilter,
+    Parser,
+    Storage,
+    get_handler_format,
+    job_thread,
+    parse_model_dirs,
+    style_name,
+)
 from logging.handlers import RotatingFileHandler
-from flask import Flask, request
+from scheduler import JobScheduler
+import metrics
+from flask import Flask, Response, request, jsonify
 import pathlib
+import shutil
 import sys
 import logging
 import os
@@ -15,14 +29,157 @@ import threading
 
 app = Flask(__name__)
 
-def _process(video):
+# jobs run on a bounded pool, ffmpeg heavy stages have their own slots
+scheduler = JobScheduler(
+    max_jobs=int(os.getenv("MAX_JOBS", 2)),
+    stage_slots={
+        "preprocess": int(os.getenv("PREPROCESS_SLOTS", 1)),
+        "postprocess": int(os.getenv("POSTPROCESS_SLOTS", 1)),
+    },
+)
+
+# the trackers of the videos being scored, for the metrics endpoint
+_trackers = {}
+
+# per video progress and the autoscaling signal, set on every scrape
+VIDEO_FRAMES = metrics.REGISTRY.gauge(
+    "orchestrator_video_frames",
+    "Frames of a video being scored, by state.",
+    ("video", "state"),
+)
+VIDEO_THROUGHPUT = metrics.REGISTRY.gauge(
+    "orchestrator_video_frames_per_second",
+    "Measured throughput of a video being scored.",
+    ("video",),
+)
+VIDEO_ETA = metrics.REGISTRY.gauge(
+    "orchestrator_video_eta_seconds",
+    "Estimated seconds until a video is scored.",
+    ("video",),
+)
+QUEUE_DEPTH = metrics.REGISTRY.gauge(
+    "orchestrator_queue_messages", "Messages in the scoring queue."
+)
+BACKLOG = metrics.REGISTRY.gauge(
+    "orchestrator_backlog_frames", "Frames of all videos that are not scored yet."
+)
+ACTIVE_WORKERS = metrics.REGISTRY.gauge(
+    "orchestrator_active_workers",
+    "Scoring workers that reported a frame in the last minute.",
+)
+RECOMMENDED_REPLICAS = metrics.REGISTRY.gauge(
+    "orchestrator_recommended_replicas",
+    "Scoring replicas that would score the backlog within TARGET_SECONDS.",
+)
+
+# the client the metrics endpoint reads the queue depth with, created on the
+# first scrape, and the last depth read with the time it was read, so scrapes
+# do not each call the broker
+_metrics_bus_service = None
+_queue_depth = {"messages": None, "time": 0.0}
+_queue_depth_lock = threading.Lock()
+
+
+def _setup_logger():
+    """
+    log to the console once for all jobs, each job adds a log file of its own
+    """
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(get_handler_format())
+    logger = logging.getLogger("root")
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(console_handler)
+    logger.propagate = False
+
+
+def _read_queue_depth(max_age=None):
+    """
+    returns the number of messages in the scoring queue, read from the broker
+    at most once every `max_age` seconds, QUEUE_DEPTH_MAX_AGE if not set, or
+    None if the service bus is not configured
+
+    :param max_age: (optional) how long a depth that was read is reused
+    """
+    global _metrics_bus_service
+
+    if max_age is None:
+        max_age = float(os.getenv("QUEUE_DEPTH_MAX_AGE", 5))
+    settings = [
+        os.getenv(name)
+        for name in (
+            "SB_NAMESPACE",
+            "SB_SHARED_ACCESS_KEY_NAME",
+            "SB_SHARED_ACCESS_KEY_VALUE",
+            "SB_QUEUE",
+        )
+    ]
+    if not all(settings):
+        return None
+    namespace, key_name, key_value, queue = settings
+    with _queue_depth_lock:
+        if _metrics_bus_service is None:
+            _metrics_bus_service = make_bus_service(namespace, key_name, key_value)
+        if time.time() - _queue_depth["time"] >= max_age:
+            # a failed read is not retried before max_age either
+            _queue_depth["time"] = time.time()
+            _queue_depth["messages"] = _metrics_bus_service.get_queue(
+                queue
+            ).message_count
+        return _queue_depth["messages"]
+
+
+def _process(job, video, chunk_size=None, model_dirs=None):
+    """
+    Runs a job with the records it logs also written to the video's log file,
+    including those of its helper threads started with `util.job_thread`.
+
+    :param job: the scheduler.Job of the video
+    :param video: the name of the video file (including ext)
+    :param chunk_size: (optional) see `_process_video`
+    :param model_dirs: (optional) see `_process_video`
+    """
+    mount_dir = os.getenv("MOUNT_DIR", "data")
+    video_name = video.split(".")[0]
+
+    # create parent directory in mount_dir
+    if not os.path.exists(os.path.join(mount_dir, video_name)):
+        os.makedirs(os.path.join(mount_dir, video_name))
+
+    file_handler = RotatingFileHandler(
+        os.path.join(mount_dir, video_name, "{}.log".format(video_name)),
+        maxBytes=20000,
+    )
+    file_handler.setFormatter(get_handler_format())
+    file_handler.addFilter(JobFilter(job.id))
+    logger = logging.getLogger("root")
+    logger.addHandler(file_handler)
+    try:
+        job_thread(_process_video, job.id)(
+            job, video, chunk_size=chunk_size, model_dirs=model_dirs
+        )
+    finally:
+        logger.removeHandler(file_handler)
+        file_handler.close()
+
+
+def _process_video(job, video, chunk_size=None, model_dirs=None):
     """
     This route will perform 3 steps:
       1. split video into frames directory and audio file
       2. add frames into service bus queue
-      3. this function will poll storage until the number of 
-         input images matches the number of processed images
+      3. this function will track the completion events of the workers
+         until every input image has been processed
       4. download processed frames and stitch video back together
+
+    The progress of the job is kept in the video's manifest, so rerunning a
+    partially completed video resumes with the remaining work only. Remove
+    the manifest to process a finished video again.
+
+    :param job: the scheduler.Job of the video, its stages are timed
+    :param video: the name of the video file (including ext)
+    :param chunk_size: (optional) queue work units of this many frames, or auto
+    :param model_dirs: (optional) comma separated model dirs, each frame is scored
+        against every model in a single pass and one video is made per style
     """
     # get varaibles from environment
     namespace = os.getenv("SB_NAMESPACE")
@@ -31,6 +188,25 @@ def _process(video):
     sb_key_value = os.getenv("SB_SHARED_ACCESS_KEY_VALUE")
     mount_dir = os.getenv("MOUNT_DIR", "data")
     terminate = os.getenv("TERMINATE")
+    completion_backend = os.getenv("COMPLETION_BACKEND", "file")
+    results_queue = os.getenv("SB_RESULTS_QUEUE")
+    stall_timeout = int(os.getenv("STALL_TIMEOUT", 600)) or None
+    max_attempts = int(os.getenv("MAX_ATTEMPTS", 10)) or None
+    # how long a message can live locked: the lock duration times the max
+    # delivery count of the queue, 60s x 10 by default
+    requeue_after = int(os.getenv("REQUEUE_AFTER", 600))
+    frame_format = os.getenv("FRAME_FORMAT", "jpeg")
+    chunk_size = chunk_size or os.getenv("CHUNK_SIZE")
+    workers = int(os.getenv("SCORING_WORKERS", 1))
+    segments = int(os.getenv("FFMPEG_SEGMENTS", 1))
+    model_dirs = parse_model_dirs(model_dirs or os.getenv("MODEL_DIRS"))
+    styles = [style_name(d) for d in model_dirs] if model_dirs else [None]
+
+    # streaming works on jpeg frames only, chunk stores skip the codec instead
+    stream_postprocess = os.getenv("STREAM_POSTPROCESS") and frame_format == "jpeg"
+    stream_ingest = (
+        os.getenv("STREAM_PREPROCESS") and frame_format == "jpeg" and not chunk_size
+    )
 
     # start time
     t0 = time.time()
@@ -41,78 +217,218 @@ def _process(video):
     output_dir = os.path.join(mount_dir, video_name, "output_frames")
     audio_file = os.path.join(mount_dir, video_name, "audio.aac")
 
-    # create parent directory in mount_dir
-    if not os.path.exists(os.path.join(mount_dir, video_name)):
-        os.makedirs(os.path.join(mount_dir, video_name))
-
-    # setup logger
-    handler_format = get_handler_format()
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setFormatter(handler_format)
-    log_file = "{}.log".format(video_name)
-    file_handler = RotatingFileHandler(
-        os.path.join(mount_dir, video_name, log_file), maxBytes=20000
-    )
-    file_handler.setFormatter(handler_format)
     logger = logging.getLogger("root")
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
-    logger.propagate = False
-
-    # process video and upload output frames and audio file to blob
-    logger.debug("Preprocessing video {}".format(video))
-    preprocess(video=video, mount_dir=mount_dir)
-    t1 = time.time()
 
     # service bus client
-    bus_service = ServiceBusService(
-        service_namespace=namespace,
-        shared_access_key_name=sb_key_name,
-        shared_access_key_value=sb_key_value,
-    )
+    bus_service = make_bus_service(namespace, sb_key_name, sb_key_value)
 
-    # add all images from frame_dir to the queue
-    logger.debug("Adding images from {} to queue {}".format(input_dir ,queue))
-    image_count = add_images_to_queue(
-        mount_dir=mount_dir,
-        queue=queue,
-        video_name=video_name,
-        bus_service=bus_service,
-    )
+    # resume from the manifest of a previous run
+    manifest = Manifest.load(mount_dir, video_name)
+    if manifest.has_stage("postprocessed"):
+        logger.debug(
+            "Video {} is already processed, remove {} to process it again".format(
+                video_name, manifest.path
+            )
+        )
+        return
+
+    resuming = manifest.has_stage("preprocessed")
+    if resuming:
+        logger.debug("Resuming video {} from its manifest".format(video_name))
+        t1 = time.time()
+    elif stream_ingest:
+        # queue each frame as soon as ffmpeg has emitted it
+        logger.debug("Streaming frames of video {} to queue {}".format(video, queue))
+        with job.run_stage("preprocess"):
+            enqueue_frames(
+                stream_preprocess(video=video, mount_dir=mount_dir),
+                queue=queue,
+                video_name=video_name,
+                bus_service=bus_service,
+                model_dirs=model_dirs,
+            )
+        t1 = time.time()
+        manifest.finish_stage("queued")
+    else:
+        # process video and upload output frames and audio file to blob
+        logger.debug("Preprocessing video {}".format(video))
+        with job.run_stage("preprocess"):
+            preprocess(
+                video=video,
+                mount_dir=mount_dir,
+                frame_format=frame_format,
+                segments=segments,
+            )
+        t1 = time.time()
+
+    # frames are listed only once, later runs take them from the manifest
+    if not manifest.has_stage("preprocessed"):
+        if frame_format == "jpeg":
+            frames = [f for f in os.listdir(input_dir) if not f.startswith(".")]
+        else:
+            frames = list(frame_store.load_index(input_dir))
+        manifest.add_frames(frames)
+        if manifest.has_stage("queued"):
+            manifest.set_state(frames, "queued")
+        manifest.finish_stage("preprocessed")
+        manifest.save()
+    expected_frames = list(manifest.frames)
+
+    # workers trust the manifest, the frames it records as done are verified
+    # against their hashes once here; jpeg frames of a single style only, the
+    # others are never skipped
+    if resuming and frame_format == "jpeg" and not model_dirs:
+        changed = manifest.reset_changed(input_dir, output_dir)
+        if changed:
+            logger.debug(
+                "{} done frames of {} changed, scoring them again".format(
+                    len(changed), video_name
+                )
+            )
+            manifest.save()
+
+    # frames of a previous run that are still queued or being scored will be
+    # delivered again, unless their messages were dead-lettered, expired or
+    # dropped; requeue those without an event for longer than a message can
+    # live, and the ones that never made it or failed. Workers skip the
+    # duplicates of frames that are done by then.
+    if manifest.has_stage("queued"):
+        to_queue = sorted(
+            set(manifest.frames_in("pending", "failed"))
+            | set(
+                manifest.frames_in(
+                    "queued", "scoring", before=time.time() - requeue_after
+                )
+            )
+        )
+    else:
+        to_queue = manifest.frames_in("pending", "queued", "scoring", "failed")
+    if to_queue:
+        logger.debug(
+            "Adding {} images from {} to queue {}".format(len(to_queue), input_dir, queue)
+        )
+        with job.run_stage("queue"):
+            add_images_to_queue(
+                mount_dir=mount_dir,
+                queue=queue,
+                video_name=video_name,
+                bus_service=bus_service,
+                frame_format=frame_format,
+                chunk_size=chunk_size,
+                workers=workers,
+                frames=to_queue,
+                model_dirs=model_dirs,
+            )
+        manifest.set_state(to_queue, "queued")
+    manifest.finish_stage("queued")
+    manifest.save()
+    image_count = len(expected_frames)
     t2 = time.time()
 
     # terminate if testing
     if terminate:
-        exit(0)
+        return
 
-    # poll storage for output
+    # track completion events of the workers and compact them into the manifest
+    tracker = CompletionTracker(
+        get_event_source(
+            completion_backend,
+            mount_dir,
+            bus_service=bus_service,
+            results_queue=results_queue,
+        ),
+        video_name,
+        expected_frames,
+        since=manifest.started,
+        manifest=manifest,
+    )
+    _trackers[video_name] = tracker
     logger.debug(
-        "Polling for input images {} to equal output images {}".format(input_dir, output_dir)
+        "Waiting for {} frames of {} to be processed...".format(image_count, video_name)
     )
 
-    while True:
-        path, dirs, files = next(os.walk(output_dir))
-        output_frames_length = len(files)
+    # encode the output videos while frames are still being scored
+    streams = []
+    if stream_postprocess:
+        streams = [
+            StreamingPostprocess(
+                mount_dir, video_name, len(expected_frames), style=style
+            ).start()
+            for style in styles
+        ]
 
-        if output_frames_length == image_count:
-            t3 = time.time()
+    def _on_progress(tracker):
+        for stream in streams:
+            stream.update(tracker.done)
+        logger.debug(
+            "Processed {}/{} frames ({:.1f}%), {} failed attempts".format(
+                len(tracker.done),
+                len(tracker.expected),
+                tracker.progress(),
+                sum(tracker.failed.values()),
+            )
+        )
 
-            # postprocess video
-            logger.debug(
-                "Stitching video together with processed frames dir '{}' and audio file '{}'.".format(
-                    output_dir, audio_file 
+    try:
+        with job.run_stage("score"):
+            finished = tracker.wait(
+                stall_timeout=stall_timeout,
+                on_progress=_on_progress,
+                max_attempts=max_attempts,
+            )
+    finally:
+        _trackers.pop(video_name, None)
+    if not finished:
+        for stream in streams:
+            stream.abort()
+        if max_attempts is not None and tracker.exhausted(max_attempts):
+            logger.error(
+                "Frames of {} failed {} times, giving up: {}".format(
+                    video_name, max_attempts, tracker.missing()
+                )
+            )
+            raise RuntimeError(
+                "{} frames failed {} times".format(
+                    len(tracker.missing()), max_attempts
                 )
             )
-            postprocess(video_name=video_name, mount_dir=mount_dir)
+        logger.error(
+            "No frame of {} was processed in {} seconds, missing frames: {}".format(
+                video_name, stall_timeout, tracker.missing()
+            )
+        )
+        raise RuntimeError(
+            "No frame was processed in {} seconds".format(stall_timeout)
+        )
 
-            t4 = time.time()
-            break
+    # every work unit of the video is done, its checkpoints are not read again
+    shutil.rmtree(
+        os.path.join(mount_dir, video_name, Storage.CHECKPOINT_DIR.value),
+        ignore_errors=True,
+    )
+    t3 = time.time()
 
-        else:
-            logger.debug("Images are still processing. Retrying in 10 seconds...")
-            time.sleep(10)
-            continue
+    # postprocess video
+    logger.debug(
+        "Stitching video together with processed frames dir '{}' and audio file '{}'.".format(
+            output_dir, audio_file
+        )
+    )
+    with job.run_stage("postprocess"):
+        for stream in streams:
+            stream.close()
+        if not streams:
+            for style in styles:
+                postprocess(
+                    video_name=video_name,
+                    mount_dir=mount_dir,
+                    frame_format=frame_format,
+                    style=style,
+                    segments=segments,
+                )
+    manifest.finish_stage("postprocessed")
+    manifest.save()
+    t4 = time.time()
 
     t5 = time.time()
 
@@ -125,8 +441,95 @@ def _process(video):
 @app.route('/process', methods=['GET'])
 def process_video():
     video_name = request.args.get('video_name')
-    threading.Thread(target=_process, args=(video_name,)).start()
-    return "Processing {} in background...\n".format(video_name)
+    chunk_size = request.args.get('chunk_size')
+    model_dirs = request.args.get('model_dirs')
+    try:
+        parse_model_dirs(model_dirs)
+    except ValueError as e:
+        return "{}\n".format(e), 400
+    job, created = scheduler.submit(
+        video_name, _process, chunk_size=chunk_size, model_dirs=model_dirs
+    )
+    if not created:
+        return "{} is already being processed as job {}\n".format(video_name, job.id)
+    return "Processing {} in background as job {}...\n".format(video_name, job.id)
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify([job.to_dict() for job in scheduler.jobs()])
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = scheduler.get(job_id)
+    if job is None:
+        return jsonify({"error": "no job {}".format(job_id)}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/stages', methods=['GET'])
+def get_job_stages(job_id):
+    job = scheduler.get(job_id)
+    if job is None:
+        return jsonify({"error": "no job {}".format(job_id)}), 404
+    return jsonify(job.stage_times())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Prometheus metrics of the jobs, the progress of each video being scored
+    and the number of scoring replicas recommended for the backlog, for an
+    autoscaler to act on
+    """
+    logger = logging.getLogger("root")
+
+    VIDEO_FRAMES.clear()
+    VIDEO_THROUGHPUT.clear()
+    VIDEO_ETA.clear()
+    backlog = 0
+    throughput = 0.0
+    workers = set()
+    hosts = set()
+    for video_name, tracker in list(_trackers.items()):
+        remaining = len(tracker.expected) - len(tracker.done)
+        backlog += remaining
+        throughput += tracker.throughput()
+        workers.update(
+            worker
+            for worker, last_event in list(tracker.workers.items())
+            if last_event >= time.time() - 60
+        )
+        hosts.update(tracker.active_hosts(60))
+        VIDEO_FRAMES.set(len(tracker.done), video=video_name, state="done")
+        VIDEO_FRAMES.set(remaining, video=video_name, state="remaining")
+        VIDEO_FRAMES.set(sum(tracker.failed.values()), video=video_name, state="failed")
+        VIDEO_THROUGHPUT.set(tracker.throughput(), video=video_name)
+        if tracker.eta() is not None:
+            VIDEO_ETA.set(tracker.eta(), video=video_name)
+
+    # the queue depth is exported as is, the backlog counts frames
+    try:
+        messages = _read_queue_depth()
+        if messages is not None:
+            QUEUE_DEPTH.set(messages)
+    except Exception:
+        logger.exception("Failed to read the depth of the scoring queue")
+
+    # throughput is per replica, a pod, which may run several worker processes
+    replicas = len(hosts) or int(os.getenv("SCORING_WORKERS", 1))
+    BACKLOG.set(backlog)
+    ACTIVE_WORKERS.set(len(workers))
+    RECOMMENDED_REPLICAS.set(
+        metrics.recommended_replicas(
+            backlog,
+            throughput,
+            replicas,
+            target_seconds=int(os.getenv("TARGET_SECONDS", 600)),
+            minimum=int(os.getenv("MIN_REPLICAS", 1)),
+            maximum=int(os.getenv("MAX_REPLICAS", 0)) or None,
+        )
+    )
+    return Response(metrics.REGISTRY.render(), mimetype=metrics.CONTENT_TYPE)
+
+_setup_logger()
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8080)
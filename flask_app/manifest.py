@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+MANIFEST_FILE = "manifest.json"
+
+# the states a frame moves through, failed frames are redelivered and may
+# still become done
+FRAME_STATES = ("pending", "queued", "scoring", "done", "failed")
+
+
+def file_sha256(path, block_size=1 << 20):
+    """
+    returns the hex sha256 digest of the file
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    The persistent state of a video job: which stages have finished and the
+    state of each frame, with the content hashes of its input and output
+    once it is done. The orchestrator owns the manifest and builds it by
+    compacting the completion events of the workers into it; workers only
+    read it to skip frames whose output is already there.
+
+    Usage:
+        manifest = Manifest.load(mount_dir, video_name)
+        manifest.add_frames(frames)
+        manifest.apply(event)
+        manifest.save()
+    """
+
+    def __init__(self, path, video_name, started=None, stages=None, frames=None):
+        """
+        :param path: full path of the manifest file
+        :param video_name: the name of the video (excluding ext)
+        :param started: (optional) when the job was first started
+        :param stages: (optional) list of the job stages that have finished
+        :param frames: (optional) dict of frame -> record
+        """
+        self.path = path
+        self.video_name = video_name
+        self.started = started or time.time()
+        self.stages = stages or []
+        self.frames = frames or {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, mount_dir, video_name):
+        """
+        returns the manifest of the video, or a new empty one
+        """
+        path = os.path.join(mount_dir, video_name, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return cls(path, video_name)
+        with open(path) as f:
+            data = json.load(f)
+        return cls(
+            path,
+            video_name,
+            started=data["started"],
+            stages=data["stages"],
+            frames=data["frames"],
+        )
+
+    def save(self):
+        with self._lock:
+            data = {
+                "video": self.video_name,
+                "started": self.started,
+                "stages": self.stages,
+                "frames": self.frames,
+            }
+            tmp_path = os.path.join(
+                os.path.dirname(self.path), ".{}".format(os.path.basename(self.path))
+            )
+            with open(tmp_path, "w") as f:
+                json.dump(data, f, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+    def has_stage(self, stage):
+        return stage in self.stages
+
+    def finish_stage(self, stage):
+        if stage not in self.stages:
+            self.stages.append(stage)
+
+    def add_frames(self, frames):
+        """
+        add frames that are not in the manifest yet as pending
+        """
+        with self._lock:
+            for frame in frames:
+                self.frames.setdefault(frame, {"state": "pending"})
+
+    def set_state(self, frames, state):
+        """
+        set the state of frames that are not done yet
+        """
+        assert state in FRAME_STATES
+        now = time.time()
+        with self._lock:
+            for frame in frames:
+                record = self.frames.setdefault(frame, {"state": state})
+                if record["state"] != "done":
+                    record["state"] = state
+                    record["time"] = now
+
+    def reset_changed(self, input_dir, output_dir):
+        """
+        set the done frames whose input or output no longer match their recorded
+        hashes back to pending, done frames without hashes are kept as they are
+
+        :param input_dir: the dir of the input frames
+        :param output_dir: the dir of the output frames
+
+        returns the frames that were reset
+        """
+        with self._lock:
+            hashed = [
+                f
+                for f, r in self.frames.items()
+                if r["state"] == "done" and r.get("output_sha256") is not None
+            ]
+        changed = [
+            f
+            for f in hashed
+            if not self.is_done(
+                f, os.path.join(input_dir, f), os.path.join(output_dir, f)
+            )
+        ]
+        now = time.time()
+        with self._lock:
+            for f in changed:
+                self.frames[f] = {"state": "pending", "time": now}
+        return changed
+
+    def apply(self, event):
+        """
+        compact a completion event of a worker into the frame's record
+
+        returns True if the record changed
+        """
+        with self._lock:
+            record = self.frames.setdefault(event["frame"], {"state": "pending"})
+            if event["status"] == "done":
+                updated = dict(
+                    record,
+                    state="done",
+                    input_sha256=event.get("input_sha256"),
+                    output_sha256=event.get("output_sha256"),
+                    time=event["time"],
+                )
+            elif record["state"] == "done":
+                return False
+            else:
+                updated = dict(record, state=event["status"], time=event["time"])
+            changed = updated != record
+            self.frames[event["frame"]] = updated
+            return changed
+
+    def frames_in(self, *states, before=None):
+        """
+        returns the sorted frames in any of the states
+
+        :param before: (optional) only the frames whose state last changed before
+            this timestamp, frames without a recorded time count as older
+        """
+        with self._lock:
+            return sorted(
+                f
+                for f, r in self.frames.items()
+                if r["state"] in states
+                and (before is None or r.get("time", 0) < before)
+            )
+
+    def is_done(self, frame, input_file, output_file, verify=True):
+        """
+        returns True if the frame is done, its output exists and, if `verify`,
+        both its input and its output still match the recorded hashes
+
+        :param verify: (optional) hash the files, which reads both of them
+        """
+        record = self.frames.get(frame)
+        if record is None or record["state"] != "done":
+            return False
+        if record.get("input_sha256") is None or record.get("output_sha256") is None:
+            return False
+        if not os.path.exists(output_file):
+            return False
+        if not verify:
+            return True
+        return (
+            file_sha256(input_file) == record["input_sha256"]
+            and file_sha256(output_file) == record["output_sha256"]
+        )
@@ -4,10 +4,33 @@ import glob
 import subprocess
 import os
 import pathlib
-from util import Parser, Storage
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from util import (
+    Parser,
+    Storage,
+    job_thread,
+    output_dir_name,
+    split_frames,
+    style_name,
+)
+import frame_store
 
 
-def postprocess(mount_dir, video_name):
+def _video_names(video_name, style=None):
+    """
+    returns the names of the video without and with audio, one pair per style
+    when a video is rendered in several styles
+    """
+    if style is not None:
+        video_name = "{}_{}".format(video_name, style)
+    return (
+        "{}_without_audio.mp4".format(video_name),
+        "{}_processed.mp4".format(video_name),
+    )
+
+
+def postprocess(mount_dir, video_name, frame_format="jpeg", style=None, segments=1):
     """
     This function uses ffmpeg on a set of individual frames and 
     an audio file to reconstruct the video. Once the video is 
@@ -15,21 +38,169 @@ def postprocess(mount_dir, video_name):
 
     :param mount_dir: the mount directory of the storage container
     :param video_name: the name of the video file
+    :param frame_format: (optional) jpeg, or raw or zlib if the output frames are
+        in a chunk store
+    :param style: (optional) the style to assemble the output_frames_<style> dir of
+        into <video_name>_<style>_processed.mp4
+    :param segments: (optional) if > 1, encode this many segments of jpeg frames
+        in parallel and join them
     """
     # set video file without audio name
-    video_without_audio = "{}_without_audio.mp4".format(video_name)
-    video_with_audio = "{}_processed.mp4".format(video_name)
+    video_without_audio, video_with_audio = _video_names(video_name, style)
+    output_dir = os.path.join(mount_dir, video_name, output_dir_name(style))
+
+    if frame_format != "jpeg":
+        _encode_chunks(mount_dir, video_name, output_dir, video_without_audio)
+        _mux_audio(mount_dir, video_name, video_without_audio, video_with_audio)
+        return
+
+    if segments > 1:
+        _encode_segments(
+            mount_dir, video_name, output_dir, video_without_audio, segments
+        )
+        _mux_audio(mount_dir, video_name, video_without_audio, video_with_audio)
+        return
 
     # stitch frames to generate new video with ffmpeg
     subprocess.run(
         "ffmpeg -framerate 30 -i {}/%06d_frame.jpg -c:v libx264 -profile:v high -crf 20 -pix_fmt yuv420p -y {}".format(
-            os.path.join(mount_dir, video_name, Storage.OUTPUT_DIR.value),
+            output_dir,
             os.path.join(mount_dir, video_name, video_without_audio),
         ),
         shell=True,
         check=True,
     )
 
+    _mux_audio(mount_dir, video_name, video_without_audio, video_with_audio)
+
+
+def _encode_segments(
+    mount_dir, video_name, output_dir, video_without_audio, segments, framerate=30
+):
+    """
+    encode ranges of `%06d_frame.jpg` frames with an ffmpeg process each, in
+    parallel, and join the segments with the concat demuxer
+    """
+    frame_count = len([f for f in os.listdir(output_dir) if not f.startswith(".")])
+    segments_dir = os.path.join(
+        mount_dir,
+        video_name,
+        "{}_{}".format(Storage.SEGMENTS_DIR.value, os.path.basename(output_dir)),
+    )
+    if not os.path.exists(segments_dir):
+        os.makedirs(segments_dir)
+
+    def _encode(segment_file, start, count):
+        subprocess.run(
+            [
+                "ffmpeg",
+                "-framerate",
+                str(framerate),
+                "-start_number",
+                str(start + 1),
+                "-i",
+                os.path.join(output_dir, "%06d_frame.jpg"),
+                "-frames:v",
+                str(count),
+                "-c:v",
+                "libx264",
+                "-profile:v",
+                "high",
+                "-crf",
+                "20",
+                "-pix_fmt",
+                "yuv420p",
+                "-y",
+                segment_file,
+            ],
+            check=True,
+        )
+
+    ranges = split_frames(frame_count, segments)
+    segment_files = [
+        os.path.join(segments_dir, "{:04d}.mp4".format(segment))
+        for segment in range(len(ranges))
+    ]
+    with ThreadPoolExecutor(len(ranges)) as executor:
+        futures = [
+            executor.submit(job_thread(_encode), segment_file, start, count)
+            for segment_file, (start, count) in zip(segment_files, ranges)
+        ]
+        for future in futures:
+            future.result()
+
+    # the segments share their encoding settings, so they are joined as is
+    concat_file = os.path.join(segments_dir, "segments.txt")
+    with open(concat_file, "w") as f:
+        for segment_file in segment_files:
+            f.write("file '{}'\n".format(os.path.abspath(segment_file)))
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            concat_file,
+            "-c",
+            "copy",
+            "-y",
+            os.path.join(mount_dir, video_name, video_without_audio),
+        ],
+        check=True,
+    )
+    shutil.rmtree(segments_dir)
+
+
+def _encode_chunks(
+    mount_dir, video_name, output_dir, video_without_audio, framerate=30
+):
+    """
+    pipe the raw frames of the output chunk store into ffmpeg in frame order
+    """
+    refs = frame_store.load_index(output_dir)
+    height, width = next(iter(refs.values()))["shape"][:2]
+
+    process = subprocess.Popen(
+        [
+            "ffmpeg",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "-s",
+            "{}x{}".format(width, height),
+            "-framerate",
+            str(framerate),
+            "-i",
+            "-",
+            "-c:v",
+            "libx264",
+            "-profile:v",
+            "high",
+            "-crf",
+            "20",
+            "-pix_fmt",
+            "yuv420p",
+            "-y",
+            os.path.join(mount_dir, video_name, video_without_audio),
+        ],
+        stdin=subprocess.PIPE,
+    )
+    try:
+        for ref in refs.values():
+            process.stdin.write(frame_store.read_frame(output_dir, ref).data)
+    finally:
+        process.stdin.close()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, "ffmpeg")
+
+
+def _mux_audio(mount_dir, video_name, video_without_audio, video_with_audio):
+    """
+    reattach the audio of the original video and remove the video without audio
+    """
     # reattach audio to the newly generated video
     subprocess.run(
         "ffmpeg -i {} -i {} -map 0:0 -map 1:0 -vcodec copy -acodec copy -y {}".format(
@@ -45,6 +216,128 @@ def postprocess(mount_dir, video_name):
     os.remove(os.path.join(mount_dir, video_name, video_without_audio))
 
 
+class StreamingPostprocess:
+    """
+    Encodes the output video while frames are still being scored. Frames
+    are piped into a long-running ffmpeg process in frame order as soon as
+    the contiguous prefix of `%06d_frame.jpg` outputs is done; frames done
+    out of order within `window` frames of the prefix are read ahead into
+    memory. The audio is muxed in `close`.
+
+    Usage:
+        stream = StreamingPostprocess(mount_dir, video_name, frame_count).start()
+        tracker.wait(on_progress=lambda tracker: stream.update(tracker.done))
+        stream.close()
+    """
+
+    def __init__(
+        self, mount_dir, video_name, frame_count, framerate=30, window=64, style=None
+    ):
+        """
+        :param mount_dir: the mount directory of the storage container
+        :param video_name: the name of the video file
+        :param frame_count: the number of frames of the video
+        :param framerate: (optional) the framerate of the output video
+        :param window: (optional) the number of out-of-order frames to read ahead
+        :param style: (optional) the style to encode the output frames of
+        """
+        self.mount_dir = mount_dir
+        self.video_name = video_name
+        self.frame_count = frame_count
+        self.framerate = framerate
+        self.window = window
+        self.output_dir = os.path.join(mount_dir, video_name, output_dir_name(style))
+        self.video_without_audio, self.video_with_audio = _video_names(
+            video_name, style
+        )
+        self.next_frame = 1
+        self._buffered = {}
+        self._process = None
+
+    @staticmethod
+    def frame_name(index):
+        return "{:06d}_frame.jpg".format(index)
+
+    def start(self):
+        self._process = subprocess.Popen(
+            [
+                "ffmpeg",
+                "-f",
+                "image2pipe",
+                "-framerate",
+                str(self.framerate),
+                "-c:v",
+                "mjpeg",
+                "-i",
+                "-",
+                "-c:v",
+                "libx264",
+                "-profile:v",
+                "high",
+                "-crf",
+                "20",
+                "-pix_fmt",
+                "yuv420p",
+                "-y",
+                os.path.join(self.mount_dir, self.video_name, self.video_without_audio),
+            ],
+            stdin=subprocess.PIPE,
+        )
+        return self
+
+    def _read(self, index):
+        with open(os.path.join(self.output_dir, self.frame_name(index)), "rb") as f:
+            return f.read()
+
+    def update(self, done_frames):
+        """
+        :param done_frames: the names of all output frames that are done so far
+
+        returns the number of frames written to ffmpeg
+        """
+        written = 0
+        while True:
+            # read ahead the out-of-order frames within the window
+            last = min(self.next_frame + self.window, self.frame_count + 1)
+            for index in range(self.next_frame, last):
+                if index not in self._buffered and self.frame_name(index) in done_frames:
+                    self._buffered[index] = self._read(index)
+
+            # write the contiguous prefix
+            if self.next_frame not in self._buffered:
+                return written
+            self._process.stdin.write(self._buffered.pop(self.next_frame))
+            self.next_frame += 1
+            written += 1
+
+    def close(self):
+        """
+        finish the encode once every frame has been written and mux the audio
+        """
+        if self.next_frame <= self.frame_count:
+            self.abort()
+            raise ValueError(
+                "Only {} of {} frames were encoded".format(
+                    self.next_frame - 1, self.frame_count
+                )
+            )
+        self._process.stdin.close()
+        if self._process.wait() != 0:
+            raise subprocess.CalledProcessError(self._process.returncode, "ffmpeg")
+        _mux_audio(
+            self.mount_dir,
+            self.video_name,
+            self.video_without_audio,
+            self.video_with_audio,
+        )
+
+    def abort(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+        self._buffered.clear()
+
+
 if __name__ == "__main__":
     parser = Parser()
     parser.append_postprocess_args()
@@ -53,7 +346,11 @@ if __name__ == "__main__":
     assert args.video_name is not None
     assert args.storage_mount_dir is not None
 
-    postprocess(
-        mount_dir=args.storage_mount_dir,
-        video_name=args.video_name
-    )
+    for style in [style_name(d) for d in args.model_dirs or []] or [None]:
+        postprocess(
+            mount_dir=args.storage_mount_dir,
+            video_name=args.video_name,
+            frame_format=args.frame_format,
+            style=style,
+            segments=args.segments,
+        )
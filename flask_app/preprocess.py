@@ -3,10 +3,13 @@ import glob
 import subprocess
 import os
 import pathlib
-from util import Parser, Storage
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import frame_store
+from util import Parser, Storage, job_thread, split_frames
 
 
-def preprocess(video, mount_dir):
+def preprocess(video, mount_dir, frame_format="jpeg", chunk_frames=100, segments=1):
     """
     This function uses ffmpeg on the `video` to create
         - a new frames_dir with all the frames of the video and
@@ -17,7 +20,16 @@ def preprocess(video, mount_dir):
 
     :param video: the name (not path) of the video file in blob storage (including ext)
     :param mount_dir: the mount storage of the storage container
+    :param frame_format: (optional) jpeg to write a file per frame, raw or zlib to
+        write uint8 frames to a chunk store
+    :param chunk_frames: (optional) the number of frames per chunk
+    :param segments: (optional) if > 1, extract jpeg frames of this many keyframe
+        aligned segments of the video in parallel
     """
+    if frame_format != "jpeg":
+        return preprocess_chunks(video, mount_dir, frame_format, chunk_frames)
+    if segments > 1:
+        return preprocess_segments(video, mount_dir, segments)
 
     # video name (remove ext)
     video_name = video.split(".")[0]
@@ -39,15 +51,327 @@ def preprocess(video, mount_dir):
         check=True,
     )
 
-    # video pre-processing: split to frames
+    # video pre-processing: split to frames, one per decoded frame like
+    # preprocess_segments, image2 would duplicate and drop frames of a
+    # variable frame rate video to a constant rate
     subprocess.run(
-        "ffmpeg -y -i {} {}/%06d_frame.jpg -hide_banner".format(
+        "ffmpeg -y -i {} -vsync 0 {}/%06d_frame.jpg -hide_banner".format(
             os.path.join(mount_dir, video), input_frames_path
         ),
         shell=True,
         check=True,
     )
 
+
+def _probe_size(video_path):
+    """
+    returns the width and height of the first video stream
+    """
+    output = subprocess.run(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "v:0",
+            "-show_entries",
+            "stream=width,height",
+            "-of",
+            "csv=p=0",
+            video_path,
+        ],
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+    width, height = output.decode().strip().split(",")
+    return int(width), int(height)
+
+
+def _probe_start_time(video_path):
+    """
+    returns the start time of the container, which ffmpeg adds to the input
+    seek, the lowest start time of its streams, 0 if it has none
+    """
+    output = subprocess.run(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-show_entries",
+            "format=start_time",
+            "-of",
+            "csv=p=0",
+            video_path,
+        ],
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+    try:
+        return float(output.decode().strip())
+    except ValueError:
+        return 0.0
+
+
+def _probe_frames(video_path):
+    """
+    returns the sorted presentation times of the frames of the first video
+    stream and the indices of its keyframes, read from the packets without
+    decoding the video
+    """
+    output = subprocess.run(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "v:0",
+            "-show_entries",
+            "packet=pts_time,flags",
+            "-of",
+            "csv=p=0",
+            video_path,
+        ],
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+
+    packets = []
+    for line in output.decode().splitlines():
+        fields = line.strip().split(",")
+        if len(fields) < 2 or fields[0] in ("", "N/A"):
+            continue
+        packets.append((float(fields[0]), "K" in fields[1]))
+
+    # packets are in decode order, frames are numbered in presentation order
+    packets.sort()
+    times = [pts_time for pts_time, _ in packets]
+    keyframes = [index for index, (_, key) in enumerate(packets) if key]
+    return times, keyframes
+
+
+def preprocess_segments(video, mount_dir, segments):
+    """
+    Like `preprocess`, but the video is split into `segments` ranges that
+    start at keyframes and the frames of each range are extracted by an
+    ffmpeg process of its own, in parallel with the audio extraction. Each
+    process numbers its frames from the index of its first frame, so the
+    frames are named exactly as a single ffmpeg run would name them.
+
+    :param video: the name (not path) of the video file in blob storage (including ext)
+    :param mount_dir: the mount storage of the storage container
+    :param segments: the number of segments extracted in parallel
+
+    returns the number of frames
+    """
+    video_name = video.split(".")[0]
+    video_path = os.path.join(mount_dir, video)
+    audio_path = os.path.join(mount_dir, video_name, Storage.AUDIO_FILE.value)
+    input_frames_path = os.path.join(mount_dir, video_name, Storage.INPUT_DIR.value)
+
+    if not os.path.exists(input_frames_path):
+        os.makedirs(input_frames_path)
+
+    times, keyframes = _probe_frames(video_path)
+    start_time = _probe_start_time(video_path)
+    ranges = split_frames(len(times), segments, split_points=keyframes)
+
+    def _extract(start, count):
+        # seek between the previous frame and the first one, decoding starts
+        # at the keyframe and no frame before it is kept. The seek is relative
+        # to the start time of the container, which may be before the first
+        # video frame when the audio starts first
+        seek = 0.0
+        if start > 0:
+            seek = max(0.0, (times[start - 1] + times[start]) / 2 - start_time)
+        subprocess.run(
+            [
+                "ffmpeg",
+                "-y",
+                "-hide_banner",
+                "-ss",
+                "{:.6f}".format(seek),
+                "-i",
+                video_path,
+                "-frames:v",
+                str(count),
+                "-vsync",
+                "0",
+                "-start_number",
+                str(start + 1),
+                os.path.join(input_frames_path, "%06d_frame.jpg"),
+            ],
+            check=True,
+        )
+
+    with ThreadPoolExecutor(len(ranges) + 1) as executor:
+        futures = [
+            executor.submit(
+                job_thread(subprocess.run),
+                ["ffmpeg", "-y", "-i", video_path, "-vn", audio_path],
+                check=True,
+            )
+        ]
+        futures += [
+            executor.submit(job_thread(_extract), start, count)
+            for start, count in ranges
+        ]
+        for future in futures:
+            future.result()
+    return len(times)
+
+
+def preprocess_chunks(video, mount_dir, compression="raw", chunk_frames=100):
+    """
+    Like `preprocess`, but the frames are decoded to raw RGB once and stored
+    uncompressed or zlib compressed in chunk files, skipping the JPEG encode
+    here and the decode in the workers. The audio is extracted by the same
+    ffmpeg run.
+
+    :param video: the name (not path) of the video file in blob storage (including ext)
+    :param mount_dir: the mount storage of the storage container
+    :param compression: (optional) raw or zlib
+    :param chunk_frames: (optional) the number of frames per chunk
+
+    returns the number of frames
+    """
+    video_name = video.split(".")[0]
+    video_path = os.path.join(mount_dir, video)
+    audio_path = os.path.join(mount_dir, video_name, Storage.AUDIO_FILE.value)
+    input_frames_path = os.path.join(mount_dir, video_name, Storage.INPUT_DIR.value)
+
+    if not os.path.exists(input_frames_path):
+        os.makedirs(input_frames_path)
+
+    width, height = _probe_size(video_path)
+    frame_size = width * height * 3
+
+    process = subprocess.Popen(
+        [
+            "ffmpeg",
+            "-y",
+            "-hide_banner",
+            "-i",
+            video_path,
+            "-map",
+            "0:a",
+            audio_path,
+            "-map",
+            "0:v",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "pipe:1",
+        ],
+        stdout=subprocess.PIPE,
+    )
+
+    index = 0
+    writer = None
+    try:
+        while True:
+            data = process.stdout.read(frame_size)
+            if len(data) < frame_size:
+                break
+            if writer is None:
+                writer = frame_store.ChunkWriter(
+                    input_frames_path,
+                    "input-{:06d}".format(index // chunk_frames),
+                    compression=compression,
+                )
+            index += 1
+            pixels = np.frombuffer(data, np.uint8).reshape(height, width, 3)
+            writer.append(frame_store.frame_id(index), pixels)
+            if len(writer) == chunk_frames:
+                writer.close()
+                writer = None
+        if writer is not None:
+            writer.close()
+    finally:
+        process.stdout.close()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, "ffmpeg")
+    return index
+
+
+# JPEG start and end of image markers, 0xFF bytes in the entropy coded data
+# are stuffed, so an end marker only occurs at the end of a frame
+_SOI = b"\xff\xd8"
+_EOI = b"\xff\xd9"
+
+
+def stream_preprocess(video, mount_dir, read_size=1 << 20):
+    """
+    Streaming version of `preprocess`: a single ffmpeg run decodes the
+    video once, writes the audio track and emits the frames as a MJPEG
+    stream on stdout. Each frame is written to the input frames dir as soon
+    as it has been read, so it can be queued while ffmpeg is still running.
+
+    :param video: the name (not path) of the video file in blob storage (including ext)
+    :param mount_dir: the mount storage of the storage container
+    :param read_size: (optional) the number of bytes to read from ffmpeg at once
+
+    yields the name of each frame once it is written
+    """
+    video_name = video.split(".")[0]
+    audio_path = os.path.join(mount_dir, video_name, Storage.AUDIO_FILE.value)
+    input_frames_path = os.path.join(mount_dir, video_name, Storage.INPUT_DIR.value)
+
+    if not os.path.exists(input_frames_path):
+        os.makedirs(input_frames_path)
+
+    process = subprocess.Popen(
+        [
+            "ffmpeg",
+            "-y",
+            "-hide_banner",
+            "-i",
+            os.path.join(mount_dir, video),
+            "-map",
+            "0:a",
+            audio_path,
+            "-map",
+            "0:v",
+            "-f",
+            "image2pipe",
+            "-c:v",
+            "mjpeg",
+            "pipe:1",
+        ],
+        stdout=subprocess.PIPE,
+    )
+
+    index = 0
+    buf = b""
+    try:
+        while True:
+            data = process.stdout.read(read_size)
+            if not data:
+                break
+            buf += data
+
+            while True:
+                start = buf.find(_SOI)
+                end = buf.find(_EOI, start + 2) if start >= 0 else -1
+                if end < 0:
+                    break
+                index += 1
+                filename = "{:06d}_frame.jpg".format(index)
+
+                # workers never pick up a partially written frame
+                tmp_path = os.path.join(input_frames_path, ".{}".format(filename))
+                with open(tmp_path, "wb") as f:
+                    f.write(buf[start : end + 2])
+                os.replace(tmp_path, os.path.join(input_frames_path, filename))
+
+                buf = buf[end + 2 :]
+                yield filename
+    finally:
+        process.stdout.close()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, "ffmpeg")
+
+
 if __name__ == "__main__":
     parser = Parser()
     parser.append_preprocess_args()
@@ -56,4 +380,9 @@ if __name__ == "__main__":
     assert args.video is not None
     assert args.storage_mount_dir is not None
 
-    preprocess(args.video, args.storage_mount_dir)
+    preprocess(
+        args.video,
+        args.storage_mount_dir,
+        frame_format=args.frame_format,
+        segments=args.segments,
+    )
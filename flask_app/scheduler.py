@@ -0,0 +1,205 @@
+import time
+import uuid
+import threading
+import logging
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+
+# the states a job moves through
+JOB_STATES = ("queued", "running", "done", "failed")
+
+STAGE_SECONDS = metrics.REGISTRY.histogram(
+    "orchestrator_stage_seconds", "Time spent in each stage of a job.", ("stage",)
+)
+SLOT_WAIT_SECONDS = metrics.REGISTRY.histogram(
+    "orchestrator_slot_wait_seconds",
+    "Time a job waited for a slot of a stage.",
+    ("stage",),
+)
+JOBS = metrics.REGISTRY.counter(
+    "orchestrator_jobs_total", "Jobs that finished, by state.", ("state",)
+)
+
+
+class Job:
+    """
+    A video being processed by the scheduler, with the time spent in each
+    of its stages. Stages that have a slot in the scheduler wait for it
+    before they start.
+    """
+
+    def __init__(self, video, slots):
+        """
+        :param video: the name of the video file (including ext)
+        :param slots: dict of stage name -> semaphore, shared by all jobs
+        """
+        self.id = uuid.uuid4().hex
+        self.video = video
+        self.state = "queued"
+        self.stage = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.stages = collections.OrderedDict()
+        self._slots = slots
+        self._lock = threading.Lock()
+
+    def run_stage(self, name):
+        """
+        returns a context manager that waits for a slot of the stage, if it
+        has any, and records how long the stage waited and ran
+
+        Usage:
+            with job.run_stage("preprocess"):
+                preprocess(video=video, mount_dir=mount_dir)
+        """
+        return _Stage(self, name, self._slots.get(name))
+
+    def stage_times(self):
+        """
+        returns a copy of the stages, taken while the job thread is not
+        updating them
+        """
+        with self._lock:
+            return collections.OrderedDict(
+                (name, dict(times)) for name, times in self.stages.items()
+            )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "video": self.video,
+            "state": self.state,
+            "stage": self.stage,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "stages": self.stage_times(),
+        }
+
+
+class _Stage:
+    def __init__(self, job, name, slot):
+        self.job = job
+        self.name = name
+        self.slot = slot
+
+    def __enter__(self):
+        t0 = time.time()
+        if self.slot is not None:
+            self.job.stage = "waiting for {}".format(self.name)
+            self.slot.acquire()
+        self.job.stage = self.name
+        self._start = time.time()
+        with self.job._lock:
+            self.job.stages[self.name] = {"wait": self._start - t0, "seconds": None}
+        SLOT_WAIT_SECONDS.observe(self._start - t0, stage=self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.slot is not None:
+            self.slot.release()
+        seconds = time.time() - self._start
+        with self.job._lock:
+            self.job.stages[self.name]["seconds"] = seconds
+        STAGE_SECONDS.observe(seconds, stage=self.name)
+        self.job.stage = None
+
+
+class JobScheduler:
+    """
+    Runs video jobs on a bounded pool of threads. A video that already has
+    a queued or running job is not submitted again, and the ffmpeg heavy
+    stages only run as many at once as they have slots, so concurrent jobs
+    do not oversubscribe the cores of the pod.
+
+    Usage:
+        scheduler = JobScheduler(max_jobs=2, stage_slots={"preprocess": 1})
+        job, created = scheduler.submit(video, fn, chunk_size=chunk_size)
+        scheduler.get(job.id).to_dict()
+    """
+
+    def __init__(self, max_jobs=2, stage_slots=None, history=100):
+        """
+        :param max_jobs: (optional) the number of jobs that run at once
+        :param stage_slots: (optional) dict of stage name -> the number of jobs
+            that may run the stage at once, stages without slots are not limited
+        :param history: (optional) the number of finished jobs to keep
+        """
+        self.max_jobs = max_jobs
+        self.history = history
+        self._slots = {
+            stage: threading.BoundedSemaphore(slots)
+            for stage, slots in (stage_slots or {}).items()
+        }
+        self._executor = ThreadPoolExecutor(max_jobs)
+        self._jobs = collections.OrderedDict()
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def submit(self, video, fn, **kwargs):
+        """
+        :param video: the name of the video file (including ext)
+        :param fn: callable(job, video, **kwargs) that processes the video
+        :param kwargs: (optional) passed on to fn
+
+        returns the job of the video and whether it was newly created, a video
+        with a queued or running job returns that job
+        """
+        with self._lock:
+            job = self._active.get(video)
+            if job is not None:
+                return job, False
+            job = Job(video, self._slots)
+            self._active[video] = job
+            self._jobs[job.id] = job
+            self._trim()
+        self._executor.submit(self._run, job, fn, kwargs)
+        return job, True
+
+    def _run(self, job, fn, kwargs):
+        logger = logging.getLogger("root")
+
+        job.state = "running"
+        job.started = time.time()
+        try:
+            fn(job, job.video, **kwargs)
+            job.state = "done"
+        except Exception as e:
+            logger.exception("Job {} of {} failed".format(job.id, job.video))
+            job.state = "failed"
+            job.error = str(e)
+        finally:
+            job.finished = time.time()
+            JOBS.inc(state=job.state)
+            with self._lock:
+                self._active.pop(job.video, None)
+
+    def _trim(self):
+        """
+        forget the oldest finished jobs beyond `history`
+        """
+        finished = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.state in ("done", "failed")
+        ]
+        for job_id in finished[: max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        """
+        returns the job, or None if there is no such job
+        """
+        return self._jobs.get(job_id)
+
+    def jobs(self):
+        """
+        returns all known jobs, oldest first
+        """
+        with self._lock:
+            return list(self._jobs.values())
@@ -1,18 +1,135 @@
 import argparse
 import logging
 import os
+import threading
 from enum import Enum
 
 class Storage(Enum):
     AUDIO_FILE = "audio.aac"
     INPUT_DIR = "input_frames"
     OUTPUT_DIR = "output_frames"
+    EVENTS_DIR = "events"
+    CHECKPOINT_DIR = "checkpoints"
+    SEGMENTS_DIR = "segments"
+
+def style_name(model_dir):
+    """
+    returns the name of the style a model dir holds, e.g. mosaic for models/mosaic
+    """
+    return os.path.basename(os.path.normpath(model_dir))
+
+def check_model_dirs(model_dirs):
+    """
+    raise a ValueError if a model dir is not a relative path inside the mount
+    or two model dirs have the same style name, their output frames and videos
+    would overwrite each other
+    """
+    styles = {}
+    for model_dir in model_dirs:
+        path = os.path.normpath(model_dir)
+        outside = path.split(os.sep)[0] == os.pardir
+        if os.path.isabs(path) or path == os.curdir or outside:
+            raise ValueError(
+                "model dir {!r} is not a path inside the mount".format(model_dir)
+            )
+        style = style_name(model_dir)
+        if style in styles:
+            raise ValueError(
+                "model dirs {!r} and {!r} have the same style name {!r}".format(
+                    styles[style], model_dir, style
+                )
+            )
+        styles[style] = model_dir
+
+def output_dir_name(style=None):
+    """
+    returns the name of the dir output frames are written to, a video rendered
+    in several styles gets one output_frames_<style> dir per style
+    """
+    if style is None:
+        return Storage.OUTPUT_DIR.value
+    return "{}_{}".format(Storage.OUTPUT_DIR.value, style)
+
+def split_frames(frame_count, segments, split_points=None):
+    """
+    returns (start, count) ranges of 0-based frame indices that cover all
+    frames in at most `segments` ranges of about equal length
+
+    :param frame_count: the number of frames
+    :param segments: the number of ranges to aim for
+    :param split_points: (optional) sorted frame indices a range may start at,
+        e.g. the keyframes of a video, any frame if not set
+    """
+    starts = {0}
+    for segment in range(1, segments):
+        target = segment * frame_count / segments
+        if split_points:
+            starts.add(min(split_points, key=lambda index: abs(index - target)))
+        else:
+            starts.add(int(round(target)))
+    starts = sorted(start for start in starts if start < frame_count)
+    ends = starts[1:] + [frame_count]
+    return [(start, end - start) for start, end in zip(starts, ends)]
+
+# the id of the job the current thread works for, see `job_thread`
+_job = threading.local()
+
+def current_job_id():
+    """
+    returns the id of the job the current thread works for, or None
+    """
+    return getattr(_job, "id", None)
+
+def job_thread(fn, job_id=None):
+    """
+    returns `fn` wrapped to run with the job id of the calling thread, or
+    `job_id` if set, so the records logged on a helper thread of a job go to
+    the log of the job, e.g. executor.submit(job_thread(fn), *args)
+    """
+    if job_id is None:
+        job_id = current_job_id()
+
+    def _run(*args, **kwargs):
+        previous = current_job_id()
+        _job.id = job_id
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _job.id = previous
+
+    return _run
+
+class JobFilter(logging.Filter):
+    """
+    tags records with the id of the job the logging thread works for and only
+    passes the records of one job, so the log file of a job does not collect
+    the records of other jobs
+    """
+
+    def __init__(self, job_id):
+        super().__init__()
+        self.job_id = job_id
+
+    def filter(self, record):
+        record.job_id = current_job_id()
+        return record.job_id == self.job_id
 
 def get_handler_format():
     return logging.Formatter(
         "%(asctime)s [%(name)s:%(filename)s:%(lineno)s] %(levelname)s - %(message)s"
     )
 
+def parse_model_dirs(value):
+    """
+    returns the list of model dirs in a comma separated string, or None, raises
+    a ValueError if they cannot be rendered side by side
+    """
+    if not value:
+        return None
+    model_dirs = [d.strip() for d in value.split(",") if d.strip()]
+    check_model_dirs(model_dirs)
+    return model_dirs
+
 class Parser:
     """
     Parsing utility for this module
@@ -30,6 +147,8 @@ class Parser:
             help="The name (not path) of the video in a storage container (including ext).",
             default=os.getenv("VIDEO"),
         )
+        self.__append_segments_args()
+        self.__append_frame_format_args()
         self.__append_storage_args()
 
     def append_add_images_to_queue_args(self):
@@ -44,6 +163,19 @@ class Parser:
             type=int,
             default=None,
         )
+        self.parser.add_argument(
+            "--chunk-size",
+            help="Queue work units of this many frames instead of one message per frame, or auto.",
+            default=os.getenv("CHUNK_SIZE"),
+        )
+        self.parser.add_argument(
+            "--workers",
+            help="The number of scoring workers, used to derive an auto chunk size.",
+            type=int,
+            default=int(os.getenv("SCORING_WORKERS", 1)),
+        )
+        self.__append_model_dirs_args()
+        self.__append_frame_format_args()
         self.__append_storage_args()
         self.__append_service_bus_args()
 
@@ -53,8 +185,35 @@ class Parser:
             help="The name (not path) of the video in a storage container (excluding ext).",
             default=None,
         )
+        self.__append_model_dirs_args()
+        self.__append_segments_args()
+        self.__append_frame_format_args()
         self.__append_storage_args()
 
+    def __append_model_dirs_args(self):
+        self.parser.add_argument(
+            "--model-dirs",
+            help="Comma separated model dirs to render the video in each of their styles.",
+            type=parse_model_dirs,
+            default=parse_model_dirs(os.getenv("MODEL_DIRS")),
+        )
+
+    def __append_segments_args(self):
+        self.parser.add_argument(
+            "--segments",
+            help="The number of video segments processed by ffmpeg in parallel.",
+            type=int,
+            default=int(os.getenv("FFMPEG_SEGMENTS", 1)),
+        )
+
+    def __append_frame_format_args(self):
+        self.parser.add_argument(
+            "--frame-format",
+            help="Store frames as jpeg files, or as raw or zlib compressed chunks.",
+            choices=["jpeg", "raw", "zlib"],
+            default=os.getenv("FRAME_FORMAT", "jpeg"),
+        )
+
     def __append_storage_args(self):
         self.parser.add_argument(
             "--storage-mount-dir",
@@ -0,0 +1,130 @@
+import argparse
+import os
+import sys
+import json
+import time
+import tempfile
+import tracemalloc
+import numpy as np
+import torch
+from PIL import Image
+import style_transfer
+import image_convert
+
+
+def _baseline(input_file, output_file, device):
+    """
+    PIL -> ToTensor -> mul(255) on the way in, clone -> clamp -> numpy ->
+    transpose -> astype on the way out
+    """
+    content_image = style_transfer._load_content(input_file, None).unsqueeze(0)
+    output = content_image.to(device).cpu()
+    style_transfer.save_image(output_file, output[0])
+
+
+def _converter(input_file, output_file, device):
+    converter = image_convert.get_converter(device)
+    content_image = converter.decode(input_file)
+    output = content_image.to(device, non_blocking=True)
+    converter.encode(output_file, output[0])
+
+
+def _torch_allocations(fn, *args):
+    """
+    returns (count, bytes) of cpu tensor allocations made by fn, or None if
+    this torch has no memory profiler
+    """
+    if not hasattr(torch, "profiler"):
+        return None
+    with torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True
+    ) as prof:
+        fn(*args)
+    allocations = [
+        e.cpu_memory_usage for e in prof.events() if e.cpu_memory_usage > 0
+    ]
+    return len(allocations), sum(allocations)
+
+
+def benchmark(fn, input_file, output_file, device, iterations):
+    """
+    :param fn: the conversion path to measure
+    :param input_file: full path of the input frame
+    :param output_file: full path of the output frame
+    :param device: cuda or cpu
+    :param iterations: the number of frames to convert
+
+    returns a dict of per-frame time and allocations
+    """
+    # warm up so that reusable buffers are allocated before measuring
+    fn(input_file, output_file, device)
+
+    t0 = time.time()
+    for _ in range(iterations):
+        fn(input_file, output_file, device)
+    seconds = (time.time() - t0) / iterations
+
+    tracemalloc.start()
+    fn(input_file, output_file, device)
+    traced_total, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        "seconds_per_frame": seconds,
+        "traced_bytes_per_frame": traced_total,
+        "traced_peak_bytes": traced_peak,
+    }
+    torch_allocations = _torch_allocations(fn, input_file, output_file, device)
+    if torch_allocations is not None:
+        result["tensor_allocations_per_frame"] = torch_allocations[0]
+        result["tensor_bytes_per_frame"] = torch_allocations[1]
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="benchmark frame <-> tensor conversion before and after image_convert"
+    )
+    parser.add_argument(
+        "--input-file",
+        type=str,
+        default=None,
+        help="(optional) the frame to convert, a random frame is generated if not set",
+    )
+    parser.add_argument(
+        "--width", type=int, default=1920, help="width of the generated frame"
+    )
+    parser.add_argument(
+        "--height", type=int, default=1080, help="height of the generated frame"
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=50, help="the number of frames to convert"
+    )
+    parser.add_argument(
+        "--cuda", type=int, default=0, help="set it to 1 for running on GPU, 0 for CPU"
+    )
+    args = parser.parse_args()
+
+    if args.cuda and not torch.cuda.is_available():
+        print("ERROR: cuda is not available, try running on CPU")
+        sys.exit(1)
+    device = torch.device("cuda" if args.cuda else "cpu")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_file = args.input_file
+        if input_file is None:
+            input_file = os.path.join(tmp_dir, "input.jpg")
+            pixels = np.random.randint(0, 256, (args.height, args.width, 3), np.uint8)
+            Image.fromarray(pixels).save(input_file)
+        output_file = os.path.join(tmp_dir, "output.jpg")
+
+        results = {
+            "baseline": benchmark(
+                _baseline, input_file, output_file, device, args.iterations
+            ),
+            "image_convert": benchmark(
+                _converter, input_file, output_file, device, args.iterations
+            ),
+        }
+
+    print(json.dumps(results, indent=4, sort_keys=True))
@@ -0,0 +1,237 @@
+import argparse
+import itertools
+import os
+import sys
+import json
+import time
+import torch
+import style_transfer
+import profiling
+
+
+def _sizes(value):
+    """
+    parse a comma separated list of WIDTHxHEIGHT
+    """
+    return [tuple(int(n) for n in size.split("x")) for size in value.split(",")]
+
+
+def _ints(value):
+    return [int(n) for n in value.split(",")]
+
+
+def benchmark(style_model, device, size, batch_size, threads, iterations, warm_up=2):
+    """
+    :param style_model: the style model
+    :param device: cuda or cpu
+    :param size: the (width, height) of the frames
+    :param batch_size: the number of frames per forward pass
+    :param threads: the number of torch threads
+    :param iterations: the number of forward passes to measure
+    :param warm_up: (optional) the number of forward passes before measuring
+
+    returns a dict of the time per batch and per frame, frames per second and,
+    on cuda, the peak memory; on torch versions that cannot reset the peak,
+    e.g. 0.4.1, it is the growth of the peak over the measured passes
+    """
+    torch.set_num_threads(threads)
+    width, height = size
+    content_images = torch.rand(batch_size, 3, height, width) * 255
+
+    def _run():
+        style_transfer.run_style_model(style_model, content_images, device)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+
+    with torch.no_grad():
+        for _ in range(warm_up):
+            _run()
+        peak_before = 0
+        if device.type == "cuda":
+            if hasattr(torch.cuda, "reset_peak_memory_stats"):
+                torch.cuda.reset_peak_memory_stats()
+            else:
+                peak_before = torch.cuda.max_memory_allocated()
+
+        t0 = time.time()
+        for _ in range(iterations):
+            _run()
+        seconds = (time.time() - t0) / iterations
+
+    result = {
+        "width": width,
+        "height": height,
+        "batch_size": batch_size,
+        "threads": threads,
+        "seconds_per_batch": seconds,
+        "seconds_per_frame": seconds / batch_size,
+        "frames_per_second": batch_size / seconds,
+    }
+    if device.type == "cuda":
+        result["peak_memory_mb"] = (
+            torch.cuda.max_memory_allocated() - peak_before
+        ) / 2 ** 20
+    return result
+
+
+def profile_layers(style_model, device, size, batch_size, trace_file=None):
+    """
+    returns the LayerProfiler of a forward pass, and writes a Chrome trace of
+    it to `trace_file` if set
+    """
+    width, height = size
+    content_images = torch.rand(batch_size, 3, height, width) * 255
+    with torch.no_grad():
+        style_transfer.run_style_model(style_model, content_images, device)
+        tracer = profiling.trace(device) if trace_file else None
+        with profiling.LayerProfiler(style_model, device) as layers:
+            if tracer is not None:
+                with tracer:
+                    style_transfer.run_style_model(style_model, content_images, device)
+                tracer.export_chrome_trace(trace_file)
+            else:
+                style_transfer.run_style_model(style_model, content_images, device)
+    return layers
+
+
+def table(results):
+    """
+    returns the results as a text table
+    """
+    lines = [
+        "{:>11} {:>6} {:>8} {:>12} {:>10}".format(
+            "size", "batch", "threads", "ms/frame", "frames/s"
+        )
+    ]
+    for r in results:
+        lines.append(
+            "{:>11} {:>6} {:>8} {:>12.2f} {:>10.2f}".format(
+                "{}x{}".format(r["width"], r["height"]),
+                r["batch_size"],
+                r["threads"],
+                r["seconds_per_frame"] * 1000,
+                r["frames_per_second"],
+            )
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="benchmark the style model across frame sizes, batch sizes and threads"
+    )
+    parser.add_argument(
+        "--model-dir",
+        type=str,
+        default=None,
+        help="(optional) saved model dir, a randomly initialised TransformerNet is used if not set",
+    )
+    parser.add_argument(
+        "--sizes",
+        type=_sizes,
+        default="640x360,1280x720,1920x1080",
+        help="comma separated WIDTHxHEIGHT of the frames",
+    )
+    parser.add_argument(
+        "--batch-sizes",
+        type=_ints,
+        default="1,2,4",
+        help="comma separated numbers of frames per forward pass",
+    )
+    parser.add_argument(
+        "--threads",
+        type=_ints,
+        default=str(torch.get_num_threads()),
+        help="comma separated numbers of torch threads",
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=5, help="the number of forward passes"
+    )
+    parser.add_argument(
+        "--cuda", type=int, default=0, help="set it to 1 for running on GPU, 0 for CPU"
+    )
+    parser.add_argument(
+        "--precision",
+        choices=["fp32", "bf16", "fp16"],
+        default="fp32",
+        help="(optional) the precision to run the model in",
+    )
+    parser.add_argument(
+        "--channels-last",
+        action="store_true",
+        help="(optional) run the model in the channels_last memory format",
+    )
+    parser.add_argument(
+        "--model-format",
+        choices=sorted(style_transfer.MODEL_FILES),
+        default="eager",
+        help="(optional) the model artifact to load from --model-dir",
+    )
+    parser.add_argument(
+        "--layers",
+        action="store_true",
+        help="(optional) print the per-module timings of each frame size",
+    )
+    parser.add_argument(
+        "--trace-dir",
+        type=str,
+        default=None,
+        help="(optional) write a Chrome trace of a forward pass of each frame size to this dir",
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="(optional) save the results as json"
+    )
+    args = parser.parse_args()
+
+    if args.cuda and not torch.cuda.is_available():
+        print("ERROR: cuda is not available, try running on CPU")
+        sys.exit(1)
+    device = torch.device("cuda" if args.cuda else "cpu")
+
+    if args.model_dir is not None:
+        style_model = style_transfer.load_style_model(
+            args.model_dir,
+            device,
+            precision=args.precision,
+            channels_last=args.channels_last,
+            model_format=args.model_format,
+        )
+    else:
+        style_model = style_transfer.TransformerNet().to(device).eval()
+        if args.precision != "fp32" or args.channels_last:
+            style_model = style_transfer.precision_mode.InferenceModel(
+                style_model, precision=args.precision, channels_last=args.channels_last
+            )
+
+    results = []
+    for size, batch_size, threads in itertools.product(
+        args.sizes, args.batch_sizes, args.threads
+    ):
+        results.append(
+            benchmark(style_model, device, size, batch_size, threads, args.iterations)
+        )
+
+    layers = {}
+    if args.layers or args.trace_dir:
+        if args.trace_dir:
+            os.makedirs(args.trace_dir, exist_ok=True)
+        for size in args.sizes:
+            trace_file = None
+            if args.trace_dir:
+                trace_file = os.path.join(
+                    args.trace_dir, "trace_{}x{}.json".format(*size)
+                )
+            profiler = profile_layers(
+                style_model, device, size, args.batch_sizes[0], trace_file
+            )
+            layers["{}x{}".format(*size)] = profiler.summary()
+            if args.layers:
+                print("\n{}x{}".format(*size))
+                print(profiler.table())
+
+    print()
+    print(table(results))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"results": results, "layers": layers}, f, indent=4)
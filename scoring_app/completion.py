@@ -0,0 +1,231 @@
+import json
+import time
+import threading
+import logging
+from azure.servicebus import Message
+from frame_log import FrameLog
+import util
+
+
+def _run_callbacks(callbacks, written):
+    logger = logging.getLogger("root")
+
+    for callback in callbacks:
+        try:
+            callback(written)
+        except Exception:
+            logger.exception("Failed to run a completion event flush callback")
+
+
+class FileEventBackend:
+    """
+    Writes completion events as batched JSON lines files to the events dir
+    of each video, so the orchestrator reads a handful of small files
+    instead of listing every output frame. The orchestrator removes the
+    files it has read once their events are in the manifest.
+    """
+
+    def __init__(self, mount_dir, flush_interval=2.0):
+        """
+        :param mount_dir: the mount directory of the storage container
+        :param flush_interval: how often events are written, in seconds
+        """
+        self.flush_interval = flush_interval
+        self._log = FrameLog(
+            mount_dir, log_dir=util.Storage.EVENTS_DIR.value, prefix="events"
+        )
+        self.worker = self._log.worker
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+
+    def send(self, event):
+        self._log.sink(event["video"]).write(event)
+
+    def after_flush(self, callback):
+        """
+        :param callback: called with whether the events sent so far were written,
+            once they have been
+        """
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def flush(self):
+        # events sent before a callback are in the sinks by now
+        with self._lock:
+            callbacks, self._callbacks = self._callbacks, []
+        _run_callbacks(callbacks, self._log.flush())
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+
+class QueueEventBackend:
+    """
+    Sends completion events to a Service Bus results queue, batched every
+    `flush_interval` seconds.
+    """
+
+    def __init__(self, bus_service, queue, flush_interval=1.0):
+        """
+        :param bus_service: service bus client
+        :param queue: the name of the results queue
+        :param flush_interval: how often events are sent, in seconds
+        """
+        self.bus_service = bus_service
+        self.queue = queue
+        self.flush_interval = flush_interval
+        self.worker = None
+        self._events = []
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+
+    def send(self, event):
+        with self._lock:
+            self._events.append(event)
+
+    def after_flush(self, callback):
+        """
+        :param callback: called with whether the events sent so far were sent,
+            once they have been
+        """
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def flush(self):
+        with self._lock:
+            events, self._events = self._events, []
+            callbacks, self._callbacks = self._callbacks, []
+        try:
+            if events:
+                self.bus_service.send_queue_message_batch(
+                    self.queue, [Message(json.dumps(e).encode()) for e in events]
+                )
+        except Exception:
+            _run_callbacks(callbacks, False)
+            raise
+        _run_callbacks(callbacks, True)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+    def _flush_loop(self):
+        logger = logging.getLogger("root")
+
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to send completion events")
+
+
+class CompletionPublisher:
+    """
+    Publishes one event per finished or failed frame, which the orchestrator
+    uses to track the progress of a video.
+    """
+
+    def __init__(self, backend):
+        """
+        :param backend: a FileEventBackend or QueueEventBackend
+        """
+        self.backend = backend
+
+    def publish(
+        self, video_name, frame, error=None, stages=None, status=None, **fields
+    ):
+        """
+        :param video_name: the name of the video the frame belongs to
+        :param frame: the name of the frame
+        :param error: (optional) the exception or message if the frame failed
+        :param stages: (optional) dict of stage name -> seconds
+        :param status: (optional) overrides the done or failed status, e.g. scoring
+        :param fields: (optional) any other fields to store in the event
+        """
+        if status is None:
+            status = "done" if error is None else "failed"
+        event = dict(fields)
+        event.update(
+            {
+                "time": time.time(),
+                "worker": self.backend.worker,
+                "video": video_name,
+                "frame": frame,
+                "status": status,
+                "seconds": sum((stages or {}).values()),
+            }
+        )
+        self.backend.send(event)
+
+    def complete_after_flush(self, receiver, msg):
+        """
+        complete the message once the events published so far are written, so
+        a worker that stops before then leaves the message to be redelivered
+        instead of losing the events of its frames; the message is abandoned
+        if they cannot be written
+
+        :param receiver: the receiver the message came from
+        :param msg: the locked message
+        """
+
+        def _complete(written):
+            if written:
+                receiver.complete(msg)
+            else:
+                receiver.abandon(msg)
+
+        self.backend.after_flush(_complete)
+
+    def close(self):
+        self.backend.close()
+
+
+class FlushedReceiver:
+    """
+    Wraps a receiver so that its messages are completed once the completion
+    events published before are written, see `complete_after_flush`. Report
+    a frame before completing its message.
+
+    Usage:
+        receiver = FlushedReceiver(PrefetchingReceiver(transport).start(), publisher)
+    """
+
+    def __init__(self, receiver, publisher):
+        """
+        :param receiver: the receiver to wrap
+        :param publisher: the CompletionPublisher the frames are reported to
+        """
+        self.receiver = receiver
+        self.publisher = publisher
+
+    def complete(self, msg):
+        self.publisher.complete_after_flush(self.receiver, msg)
+
+    def __getattr__(self, name):
+        return getattr(self.receiver, name)
+
+
+def get_publisher(backend, mount_dir, bus_service=None, results_queue=None):
+    """
+    :param backend: file or queue
+    :param mount_dir: the mount directory of the storage container
+    :param bus_service: (optional) service bus client, for the queue backend
+    :param results_queue: (optional) the name of the results queue, for the queue backend
+    """
+    if backend == "queue":
+        assert bus_service is not None and results_queue is not None
+        return CompletionPublisher(QueueEventBackend(bus_service, results_queue))
+    return CompletionPublisher(FileEventBackend(mount_dir))
@@ -0,0 +1,169 @@
+import argparse
+import os
+import sys
+import logging
+import util
+import torch
+import style_transfer
+import precision as precision_mode
+
+
+def export_model(
+    model_dir,
+    device,
+    mode="trace",
+    freeze=True,
+    optimize=True,
+    size=256,
+    output_file=None,
+    psnr_threshold=40.0,
+):
+    """
+    Compile the style model in `model_dir` with TorchScript and save the
+    artifact next to model.pth, so that workers can load it with
+    `--model-format torchscript` without constructing the python modules.
+    TorchScript models can only be saved and loaded from torch 1.0 on, a
+    ValueError is raised on older versions such as the pinned torch 0.4.1.
+
+    :param model_dir: the dir that contains model.pth
+    :param device: cuda or cpu, the device the artifact is optimized for
+    :param mode: (optional) trace or script
+    :param freeze: (optional) inline parameters and attributes as constants, skipped
+        with a warning on torch versions without torch.jit.freeze
+    :param optimize: (optional) apply torch.jit.optimize_for_inference, implies
+        freeze, skipped with a warning on torch versions without it
+    :param size: (optional) the height and width of the example input used to trace
+    :param output_file: (optional) the path of the artifact, defaults to model.pt in model_dir
+    :param psnr_threshold: (optional) the lowest PSNR in dB of the compiled output
+        against the eager output for which the artifact is saved, None to skip
+
+    returns the path of the artifact
+    """
+    logger = logging.getLogger("root")
+
+    if not style_transfer.can_load_torchscript():
+        raise ValueError(
+            "exporting requires TorchScript save and load (torch {} installed)".format(
+                torch.__version__
+            )
+        )
+
+    if output_file is None:
+        output_file = os.path.join(model_dir, style_transfer.MODEL_FILES["torchscript"])
+
+    style_model = style_transfer.load_style_model(model_dir, device)
+    example = torch.rand(1, 3, size, size, device=device) * 255
+
+    with torch.no_grad():
+        if mode == "trace":
+            compiled = torch.jit.trace(style_model, example)
+        else:
+            compiled = torch.jit.script(style_model)
+
+        if (freeze or optimize) and not hasattr(torch.jit, "freeze"):
+            logger.warning(
+                "torch {} cannot freeze, saving the model unfrozen".format(
+                    torch.__version__
+                )
+            )
+        elif freeze or optimize:
+            compiled = torch.jit.freeze(compiled.eval())
+            if optimize and not hasattr(torch.jit, "optimize_for_inference"):
+                logger.warning(
+                    "torch {} cannot optimize for inference, saving the model "
+                    "frozen only".format(torch.__version__)
+                )
+            elif optimize:
+                compiled = torch.jit.optimize_for_inference(compiled)
+
+        # the compiled model has to reproduce the eager output
+        quality = precision_mode.psnr(compiled(example).cpu(), style_model(example).cpu())
+        logger.debug("PSNR of compiled output against eager: {:.2f}dB".format(quality))
+        if psnr_threshold is not None and quality < psnr_threshold:
+            raise ValueError(
+                "PSNR of compiled output {:.2f}dB is below the threshold of {:.2f}dB".format(
+                    quality, psnr_threshold
+                )
+            )
+
+    # write to a temporary file so workers never load a partial artifact
+    tmp_file = "{}.tmp".format(output_file)
+    compiled.save(tmp_file)
+    os.replace(tmp_file, output_file)
+    logger.debug("Saved compiled model to {}".format(output_file))
+    return output_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="export the style model with TorchScript")
+
+    parser.add_argument(
+        "--model-dir",
+        type=str,
+        required=True,
+        help="saved model dir the contains model.pth",
+    )
+    parser.add_argument(
+        "--cuda",
+        type=int,
+        required=True,
+        help="set it to 1 to optimize for GPU, 0 for CPU",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["trace", "script"],
+        default="trace",
+        help="(optional) compile with torch.jit.trace or torch.jit.script",
+    )
+    parser.add_argument(
+        "--no-freeze",
+        action="store_true",
+        help="(optional) do not freeze or optimize the compiled model",
+    )
+    parser.add_argument(
+        "--no-optimize",
+        action="store_true",
+        help="(optional) do not apply torch.jit.optimize_for_inference",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=256,
+        help="(optional) the height and width of the example input",
+    )
+    parser.add_argument(
+        "--psnr-threshold",
+        type=float,
+        default=40.0,
+        help="(optional) the lowest PSNR in dB of the compiled output against the eager output that is saved",
+    )
+    parser.add_argument(
+        "--output-file",
+        type=str,
+        default=None,
+        help="(optional) where to save the artifact, defaults to model.pt in the model dir",
+    )
+    args = parser.parse_args()
+
+    if args.cuda and not torch.cuda.is_available():
+        print("ERROR: cuda is not available, try running on CPU")
+        sys.exit(1)
+
+    # set up logger
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(util.get_handler_format())
+    logger = logging.getLogger("root")
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(console_handler)
+    logger.propagate = False
+
+    export_model(
+        model_dir=args.model_dir,
+        device=torch.device("cuda" if args.cuda else "cpu"),
+        mode=args.mode,
+        freeze=not args.no_freeze,
+        optimize=not (args.no_freeze or args.no_optimize),
+        size=args.size,
+        output_file=args.output_file,
+        psnr_threshold=args.psnr_threshold,
+    )
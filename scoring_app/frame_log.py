@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import atexit
+import socket
+import threading
+import logging
+
+
+LOG_DIR = "logs"
+
+
+class FrameLogSink:
+    """
+    Buffers the records of one video and writes them in batches. Every flush
+    writes a new JSON lines file to the video's log dir, so the storage
+    mount never has to rewrite a growing file.
+    """
+
+    def __init__(self, log_dir, worker, prefix="frames"):
+        """
+        :param log_dir: the dir to write the log files to
+        :param worker: the name of this worker, used in the file names
+        :param prefix: (optional) the prefix of the file names
+        """
+        self.log_dir = log_dir
+        self.worker = worker
+        self.prefix = prefix
+        self._records = []
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._records)
+
+    def write(self, record):
+        with self._lock:
+            self._records.append(record)
+
+    def flush(self):
+        with self._lock:
+            records, self._records = self._records, []
+            if not records:
+                return
+            seq = self._seq
+            self._seq += 1
+
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir, exist_ok=True)
+        filename = "{}-{}-{:06d}.jsonl".format(self.prefix, self.worker, seq)
+
+        # readers skip dot files, so they never see a partially written batch
+        tmp_path = os.path.join(self.log_dir, ".{}".format(filename))
+        with open(tmp_path, "w") as f:
+            f.write("".join(json.dumps(r, sort_keys=True) + "\n" for r in records))
+        os.replace(tmp_path, os.path.join(self.log_dir, filename))
+
+
+class FrameLog:
+    """
+    Structured per-frame log records, one buffered sink per video. Sinks are
+    flushed by a background thread every `flush_interval` seconds, or as soon
+    as one holds `max_buffered` records.
+
+    Usage:
+        frame_log = FrameLog(mount_dir).start()
+        frame_log.record(video_name, frame, stages={"infer": 0.2})
+    """
+
+    def __init__(
+        self,
+        mount_dir,
+        flush_interval=10.0,
+        max_buffered=500,
+        log_dir=LOG_DIR,
+        prefix="frames",
+    ):
+        """
+        :param mount_dir: the mount directory of the storage container
+        :param flush_interval: how often buffered records are written, in seconds
+        :param max_buffered: the number of records that triggers an early flush
+        :param log_dir: (optional) the dir in each video dir to write to
+        :param prefix: (optional) the prefix of the file names
+        """
+        self.mount_dir = mount_dir
+        self.log_dir = log_dir
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.worker = "{}-{}".format(socket.gethostname(), os.getpid())
+        self._sinks = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        return self
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def sink(self, video_name):
+        with self._lock:
+            sink = self._sinks.get(video_name)
+            if sink is None:
+                log_dir = os.path.join(self.mount_dir, video_name, self.log_dir)
+                sink = self._sinks[video_name] = FrameLogSink(
+                    log_dir, self.worker, prefix=self.prefix
+                )
+            return sink
+
+    def record(self, video_name, frame, stages=None, error=None, **fields):
+        """
+        :param video_name: the name of the video the frame belongs to
+        :param frame: the name of the frame
+        :param stages: (optional) dict of stage name -> seconds
+        :param error: (optional) the exception or message if the frame failed
+        :param fields: (optional) any other fields to store in the record
+        """
+        record = dict(fields)
+        record.update(
+            {
+                "time": time.time(),
+                "worker": self.worker,
+                "video": video_name,
+                "frame": frame,
+                "stages": stages or {},
+                "error": None if error is None else repr(error),
+            }
+        )
+        sink = self.sink(video_name)
+        sink.write(record)
+        if len(sink) >= self.max_buffered:
+            self._wake.set()
+
+    def flush(self):
+        """
+        returns whether the records of every sink were written
+        """
+        logger = logging.getLogger("root")
+
+        with self._lock:
+            sinks = list(self._sinks.values())
+        written = True
+        for sink in sinks:
+            try:
+                sink.flush()
+            except Exception:
+                logger.exception("Failed to flush frame log to {}".format(sink.log_dir))
+                written = False
+        return written
+
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+
+def read_records(mount_dir, video_name):
+    """
+    returns every record logged for the video, ordered by time
+    """
+    log_dir = os.path.join(mount_dir, video_name, LOG_DIR)
+    records = []
+    for filename in os.listdir(log_dir):
+        if filename.startswith("frames-") and filename.endswith(".jsonl"):
+            with open(os.path.join(log_dir, filename)) as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+    return sorted(records, key=lambda r: r["time"])
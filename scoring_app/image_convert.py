@@ -0,0 +1,172 @@
+import io
+import os
+import hashlib
+import threading
+import collections
+import numpy as np
+import torch
+from PIL import Image
+
+
+# the content hashes of the frames this process read or wrote last, by path,
+# so finished frames are recorded without reading them back from storage
+_digests = collections.OrderedDict()
+_digests_lock = threading.Lock()
+MAX_DIGESTS = 10000
+
+
+def _record_digest(path, data):
+    digest = hashlib.sha256(data).hexdigest()
+    with _digests_lock:
+        _digests[os.path.normpath(path)] = digest
+        while len(_digests) > MAX_DIGESTS:
+            _digests.popitem(last=False)
+
+
+def pop_digest(path):
+    """
+    returns the hex sha256 of the bytes last read from or written to the path
+    by this process, or None if it has not seen them
+    """
+    with _digests_lock:
+        return _digests.pop(os.path.normpath(path), None)
+
+
+def read_image(path):
+    """
+    returns the PIL image of the file, read in a single pass that also records
+    its content hash
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    _record_digest(path, data)
+    return Image.open(io.BytesIO(data))
+
+
+def write_image(path, img):
+    """
+    encode the PIL image in the format of the file extension and write it
+    atomically, recording the content hash of the encoded bytes
+    """
+    Image.init()
+    buf = io.BytesIO()
+    img.save(buf, format=Image.EXTENSION[os.path.splitext(path)[1].lower()])
+    data = buf.getvalue()
+    _record_digest(path, data)
+
+    tmp_path = os.path.join(
+        os.path.dirname(path), ".{}".format(os.path.basename(path))
+    )
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class FrameConverter:
+    """
+    Converts between image files and model tensors through buffers that are
+    allocated once per frame size and then reused:
+
+        decode: JPEG -> uint8 HWC array -> float NCHW buffer (one strided cast)
+        encode: output -> pinned host buffer (cuda only) -> uint8 RGBX buffer -> JPEG
+
+    This replaces ToTensor (divide by 255) followed by mul(255) on the way
+    in, and clone/clamp/numpy/transpose/astype on the way out.
+
+    The tensors returned by `decode` are views of the reusable buffers and
+    are only valid until the next call with a frame of the same size, so a
+    converter must not be shared between threads; use `get_converter`. The
+    HxWx3 uint8 `pixels` of the last decoded frame are read only.
+    """
+
+    def __init__(self, device=None):
+        """
+        :param device: (optional) cuda or cpu, host buffers are pinned for cuda
+        """
+        self.pin_memory = device is not None and torch.device(device).type == "cuda"
+        self.pixels = None
+        self._buffers = {}
+
+    def _buffer(self, name, size, factory):
+        key = (name, size)
+        buf = self._buffers.get(key)
+        if buf is None:
+            buf = self._buffers[key] = factory()
+        return buf
+
+    def _tensor(self, name, *size):
+        # torch 0.4 has no pin_memory argument to torch.empty
+        def _empty():
+            tensor = torch.empty(*size)
+            return tensor.pin_memory() if self.pin_memory else tensor
+
+        return self._buffer(name, size, _empty)
+
+    def _uint8(self, name, width, height, channels):
+        return self._buffer(
+            name,
+            (width, height),
+            lambda: np.empty((height, width, channels), dtype=np.uint8),
+        )
+
+    def decode(self, input_file, content_scale=None):
+        """
+        :param input_file: full path of image to load
+        :param content_scale: (optional) to scale image
+
+        returns a 1x3xHxW float tensor in the range [0, 255], pinned on cuda
+        """
+        img = read_image(input_file)
+        if content_scale is not None:
+            img = img.resize(
+                (int(img.size[0] / content_scale), int(img.size[1] / content_scale)),
+                Image.ANTIALIAS,
+            )
+        width, height = img.size
+
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+
+        # PIL decodes into memory of its own, the array is the single copy out
+        # of it, and a single strided cast moves it into the reusable buffer
+        pixels = np.asarray(img)
+        self.pixels = pixels
+        content_image = self._tensor("content", 1, 3, height, width)
+        content_image[0].copy_(torch.from_numpy(pixels).permute(2, 0, 1))
+        return content_image
+
+    def encode(self, output_file, output_image):
+        """
+        :param output_file: full path of the output image
+        :param output_image: 3xHxW float tensor on the cpu or on cuda
+        """
+        height, width = output_image.shape[1:]
+
+        if output_image.is_cuda:
+            host = self._tensor("host", 3, height, width)
+            host.copy_(output_image)
+            output_image = host
+
+        # clamp in place and cast straight into the uint8 buffer the image shares
+        rgbx = self._uint8("output", width, height, 4)
+        torch.from_numpy(rgbx)[:, :, :3].copy_(
+            output_image.clamp_(0, 255).permute(1, 2, 0)
+        )
+
+        img = Image.frombuffer("RGBX", (width, height), rgbx, "raw", "RGBX", 0, 1)
+        if not output_file.lower().endswith((".jpg", ".jpeg")):
+            img = img.convert("RGB")
+        write_image(output_file, img)
+
+
+_local = threading.local()
+
+
+def get_converter(device=None):
+    """
+    returns the FrameConverter of the calling thread
+    """
+    converter = getattr(_local, "converter", None)
+    if converter is None:
+        converter = _local.converter = FrameConverter(device)
+    return converter
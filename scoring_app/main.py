@@ -55,6 +55,150 @@ if __name__ == "__main__":
         help="The value of the storage mount directory",
         default=os.getenv("MOUNT_DIR", "data")
     )
+    parser.add_argument(
+        "--batch-size",
+        dest="batch_size",
+        type=int,
+        help="The number of queue messages to score in one forward pass.",
+        default=int(os.getenv("BATCH_SIZE", 1)),
+    )
+    parser.add_argument(
+        "--max-batch-wait-ms",
+        dest="max_batch_wait_ms",
+        type=int,
+        help="How long to wait for a batch to fill up, in milliseconds.",
+        default=int(os.getenv("MAX_BATCH_WAIT_MS", 500)),
+    )
+    parser.add_argument(
+        "--pipeline-depth",
+        dest="pipeline_depth",
+        type=int,
+        help="Overlap decode, inference and encode with this many frames buffered between stages (0 to disable).",
+        default=int(os.getenv("PIPELINE_DEPTH", 0)),
+    )
+    parser.add_argument(
+        "--prefetch",
+        dest="prefetch",
+        type=int,
+        help="The number of locked queue messages to keep buffered.",
+        default=int(os.getenv("PREFETCH", 2)),
+    )
+    parser.add_argument(
+        "--receivers",
+        dest="receivers",
+        type=int,
+        help="The number of threads receiving from the queue concurrently.",
+        default=int(os.getenv("RECEIVERS", 1)),
+    )
+    parser.add_argument(
+        "--precision",
+        dest="precision",
+        choices=["fp32", "bf16", "fp16"],
+        help="The precision to run the model in, bf16 uses autocast on CPU.",
+        default=os.getenv("PRECISION", "fp32"),
+    )
+    parser.add_argument(
+        "--channels-last",
+        dest="channels_last",
+        action="store_true",
+        help="Run the model in the channels_last memory format.",
+        default=bool(os.getenv("CHANNELS_LAST")),
+    )
+    parser.add_argument(
+        "--psnr-threshold",
+        dest="psnr_threshold",
+        type=float,
+        help="The lowest PSNR in dB against fp32 output on the first frame for which reduced precision is kept.",
+        default=float(os.getenv("PSNR_THRESHOLD", 40.0)),
+    )
+    parser.add_argument(
+        "--model-format",
+        dest="model_format",
+        choices=["eager", "torchscript", "quantized"],
+        help="eager loads model.pth, torchscript and quantized load the artifacts written by export_model.py and quantize_model.py.",
+        default=os.getenv("MODEL_FORMAT", "eager"),
+    )
+    parser.add_argument(
+        "--tile-size",
+        dest="tile_size",
+        type=int,
+        help="Stylize frames larger than this tile by tile to bound memory.",
+        default=int(os.getenv("TILE_SIZE", 0)) or None,
+    )
+    parser.add_argument(
+        "--tile-overlap",
+        dest="tile_overlap",
+        type=int,
+        help="The overlap in pixels blended between neighbouring tiles.",
+        default=int(os.getenv("TILE_OVERLAP", 32)),
+    )
+    parser.add_argument(
+        "--tile-global-stats",
+        dest="tile_global_stats",
+        action="store_true",
+        help="Normalise all tiles with statistics of the whole frame.",
+        default=bool(os.getenv("TILE_GLOBAL_STATS")),
+    )
+    parser.add_argument(
+        "--completion-backend",
+        dest="completion_backend",
+        choices=["file", "queue"],
+        help="Publish completion events to the video's events dir or to a results queue.",
+        default=os.getenv("COMPLETION_BACKEND", "file"),
+    )
+    parser.add_argument(
+        "--results-queue",
+        dest="results_queue",
+        help="The name of the Service Bus queue completion events are sent to.",
+        default=os.getenv("SB_RESULTS_QUEUE"),
+    )
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        help="The directory in storage to cache outputs in, by input frame and model.",
+        default=os.getenv("CACHE_DIR"),
+    )
+    parser.add_argument(
+        "--cache-max-gb",
+        dest="cache_max_gb",
+        type=float,
+        help="The size of the output cache in GB, least recently used outputs are evicted.",
+        default=float(os.getenv("CACHE_MAX_GB", 10)),
+    )
+    parser.add_argument(
+        "--cache-near-duplicates",
+        dest="cache_near_duplicates",
+        action="store_true",
+        help="Key the output cache by a perceptual hash, so near-identical frames share an output.",
+        default=bool(os.getenv("CACHE_NEAR_DUPLICATES")),
+    )
+    parser.add_argument(
+        "--cache-copy",
+        dest="cache_copy",
+        action="store_true",
+        help="Copy outputs from the cache instead of hardlinking them.",
+        default=bool(os.getenv("CACHE_COPY")),
+    )
+    parser.add_argument(
+        "--metrics-port",
+        dest="metrics_port",
+        type=int,
+        help="Serve Prometheus metrics at /metrics on this port.",
+        default=int(os.getenv("METRICS_PORT", 0)) or None,
+    )
+    parser.add_argument(
+        "--profile-dir",
+        dest="profile_dir",
+        help="The directory in storage to write per-module timings and a Chrome trace of the style model to.",
+        default=os.getenv("PROFILE_DIR"),
+    )
+    parser.add_argument(
+        "--profile-frames",
+        dest="profile_frames",
+        type=int,
+        help="The number of frames to profile the style model over.",
+        default=int(os.getenv("PROFILE_FRAMES", 100)),
+    )
     parser.add_argument(
         "--terminate",
         dest="terminate",
@@ -70,6 +214,9 @@ if __name__ == "__main__":
     assert args.sb_key_name is not None
     assert args.sb_key_value is not None
     assert args.storage_mount_dir is not None
+    assert args.batch_size > 0
+    assert args.prefetch > 0
+    assert args.completion_backend != "queue" or args.results_queue is not None
 
     # setup logger
     handler_format = util.get_handler_format()
@@ -94,4 +241,25 @@ if __name__ == "__main__":
         queue=args.queue,
         mount_dir=args.storage_mount_dir,
         terminate=args.terminate or os.getenv("TERMINATE"),
+        batch_size=args.batch_size,
+        max_batch_wait_ms=args.max_batch_wait_ms,
+        pipeline_depth=args.pipeline_depth,
+        prefetch=args.prefetch,
+        receivers=args.receivers,
+        precision=args.precision,
+        channels_last=args.channels_last,
+        psnr_threshold=args.psnr_threshold,
+        model_format=args.model_format,
+        tile_size=args.tile_size,
+        tile_overlap=args.tile_overlap,
+        tile_global_stats=args.tile_global_stats,
+        completion_backend=args.completion_backend,
+        results_queue=args.results_queue,
+        cache_dir=args.cache_dir,
+        cache_max_gb=args.cache_max_gb,
+        cache_near_duplicates=args.cache_near_duplicates,
+        cache_copy=args.cache_copy,
+        metrics_port=args.metrics_port,
+        profile_dir=args.profile_dir,
+        profile_frames=args.profile_frames,
     )
@@ -0,0 +1,95 @@
+import ast
+import json
+import util
+
+
+# bump when the message body changes in a way older workers cannot read
+VERSION = 1
+
+# a message queues a single frame or a work unit of frames, either may carry
+# a list of model_dirs to render the frames in several styles at once
+REQUIRED_FIELDS = {
+    "frame": ("video_name", "input_frame"),
+    "unit": ("video_name", "unit", "frames"),
+}
+
+
+def encode(msg_body):
+    """
+    :param msg_body: dict with video_name and input_frame, or unit and frames,
+        and optionally model_dirs
+
+    returns the compact JSON encoding of the message body
+    """
+    validate(msg_body)
+    data = dict(msg_body, v=VERSION)
+    return json.dumps(data, separators=(",", ":"), sort_keys=True).encode("utf-8")
+
+
+def _is_literal(value):
+    """
+    returns True if the value only holds dicts with str keys, lists, str and
+    numbers, the values a legacy message body is made of
+    """
+    if isinstance(value, dict):
+        return all(
+            isinstance(k, str) and _is_literal(v) for k, v in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return all(_is_literal(v) for v in value)
+    return value is None or isinstance(value, (str, int, float))
+
+
+def _decode_legacy(text):
+    """
+    returns the message body of an orchestrator that sent the repr of the
+    dict, raises ValueError if it is not one
+    """
+    try:
+        msg_body = ast.literal_eval(text)
+    except (SyntaxError, ValueError):
+        raise ValueError("Message is not a JSON or legacy encoded message body")
+    if not isinstance(msg_body, dict) or not _is_literal(msg_body):
+        raise ValueError("Message is not a JSON or legacy encoded message body")
+    validate(msg_body)
+    return msg_body
+
+
+def decode(data):
+    """
+    :param data: the body of a queue message
+
+    returns the message body as a dict, raises ValueError if it is not a
+    message of a supported version. Bodies of orchestrators from before the
+    versioned encoding, the repr of the dict, are accepted while messages of
+    both may be in flight.
+    """
+    try:
+        text = data.decode("utf-8")
+        msg_body = json.loads(text)
+    except UnicodeDecodeError:
+        raise ValueError("Message is not a JSON encoded message body")
+    except ValueError:
+        return _decode_legacy(text)
+    version = msg_body.get("v") if isinstance(msg_body, dict) else None
+    if version != VERSION:
+        raise ValueError("Unsupported message version {!r}".format(version))
+    del msg_body["v"]
+    validate(msg_body)
+    return msg_body
+
+
+def validate(msg_body):
+    """
+    raise a ValueError if the message body misses a required field
+    """
+    kind = "unit" if "frames" in msg_body else "frame"
+    missing = [f for f in REQUIRED_FIELDS[kind] if f not in msg_body]
+    if missing:
+        raise ValueError("Message body misses {}".format(", ".join(missing)))
+    model_dirs = msg_body.get("model_dirs")
+    if model_dirs is None:
+        return
+    if not isinstance(model_dirs, list) or not model_dirs:
+        raise ValueError("model_dirs must be a non-empty list")
+    util.check_model_dirs(model_dirs)
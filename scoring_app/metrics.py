@@ -0,0 +1,272 @@
+import math
+import bisect
+import threading
+import collections
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+# latency buckets in seconds, from a single frame on a GPU to a slow model load
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    float("inf"),
+)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                name,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace("\n", "\\n")
+                .replace('"', '\\"'),
+            )
+            for name, value in labels.items()
+        )
+    )
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        """
+        :param name: the name of the metric
+        :param help: what the metric measures
+        :param labelnames: (optional) the names of the labels of the metric
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                "{} takes the labels {}, got {}".format(
+                    self.name, self.labelnames, tuple(labels)
+                )
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key):
+        return collections.OrderedDict(zip(self.labelnames, key))
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    """
+    A value that only goes up, e.g. the number of frames scored.
+    """
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self._labels(k), v) for k, v in self._values.items()]
+
+
+class Gauge(Counter):
+    """
+    A value that is set, e.g. the estimated seconds until a video is done.
+    """
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """
+    Counts observations, e.g. stage latencies, in cumulative buckets.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: (optional) the sorted upper bounds of the buckets
+        """
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        if self.buckets[-1] != float("inf"):
+            self.buckets += (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+            return sum(counts)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                labels = self._labels(key)
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append(
+                        (
+                            self.name + "_bucket",
+                            collections.OrderedDict(labels, le=_format_value(bound)),
+                            cumulative,
+                        )
+                    )
+                samples.append((self.name + "_sum", labels, total))
+                samples.append((self.name + "_count", labels, cumulative))
+        return samples
+
+
+class Registry:
+    """
+    The metrics of a process, rendered in the Prometheus text format.
+
+    Usage:
+        frames = REGISTRY.counter("frames_total", "Frames scored", ("status",))
+        frames.inc(status="done")
+        REGISTRY.render()
+    """
+
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError("{} is a {}".format(name, metric.kind))
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+    def render(self):
+        """
+        returns all metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append(
+                    "{}{} {}".format(name, _format_labels(labels), _format_value(value))
+                )
+        return "\n".join(lines) + "\n"
+
+
+# the metrics of this process
+REGISTRY = Registry()
+
+# the content type of the Prometheus text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def start_http_server(port, registry=REGISTRY):
+    """
+    serve the metrics at http://<host>:<port>/metrics from a daemon thread
+
+    returns the HTTPServer
+    """
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(("", port), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def recommended_replicas(
+    backlog, frames_per_second, replicas, target_seconds, minimum=1, maximum=None
+):
+    """
+    returns the number of scoring replicas that would score the backlog within
+    `target_seconds`, at the throughput per replica measured so far
+
+    :param backlog: the number of frames waiting to be scored
+    :param frames_per_second: the measured throughput of all replicas together
+    :param replicas: the number of replicas the throughput was measured with
+    :param target_seconds: how long the backlog may take to be scored
+    :param minimum: (optional) the fewest replicas to recommend
+    :param maximum: (optional) the most replicas to recommend
+    """
+    if backlog <= 0:
+        recommended = minimum
+    elif frames_per_second <= 0 or replicas <= 0:
+        # nothing measured yet, keep the replicas that are there
+        recommended = max(replicas, minimum)
+    else:
+        per_replica = frames_per_second / replicas
+        recommended = math.ceil(backlog / (per_replica * target_seconds))
+    recommended = max(minimum, recommended)
+    if maximum is not None:
+        recommended = min(maximum, recommended)
+    return recommended
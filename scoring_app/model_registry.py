@@ -0,0 +1,92 @@
+import os
+import time
+import threading
+import logging
+
+
+class ModelRegistry:
+    """
+    Keeps loaded models in memory for the lifetime of the worker process.
+
+    Models are loaded lazily on first use and cached by model directory
+    and the modification time of the model file, so a model that is
+    replaced on the storage mount is picked up on the next lookup.
+    """
+
+    def __init__(self, loader, model_file="model.pth", on_load=None):
+        """
+        :param loader: callable(model_dir, **options) that returns a loaded model
+        :param model_file: the file in the model dir used to detect changes, or a
+            callable(**options) that returns it
+        :param on_load: (optional) callable(model_dir, seconds) called after a model
+            is loaded, e.g. to export the load time as a metric
+        """
+        self.loader = loader
+        self.model_file = model_file
+        self.on_load = on_load
+        self.hits = 0
+        self.misses = 0
+        self.load_time = 0.0
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _model_path(self, model_dir, options):
+        model_file = self.model_file
+        if callable(model_file):
+            model_file = model_file(**options)
+        return os.path.join(model_dir, model_file)
+
+    def get(self, model_dir, **options):
+        """
+        Return the model stored in `model_dir`, loading it if it is not
+        cached yet or if the model file has changed since it was loaded.
+
+        :param model_dir: the directory that holds the model file
+        :param options: extra options passed on to the loader, also part of the cache key
+        """
+        logger = logging.getLogger("root")
+
+        mtime = os.path.getmtime(self._model_path(model_dir, options))
+        key = (os.path.abspath(model_dir), tuple(sorted(options.items())))
+
+        with self._lock:
+            cached = self._models.get(key)
+            if cached is not None and cached[0] == mtime:
+                self.hits += 1
+                return cached[1]
+
+            self.misses += 1
+            logger.debug("Loading model from {} ({})".format(model_dir, options))
+            t0 = time.time()
+            model = self.loader(model_dir, **options)
+            seconds = time.time() - t0
+            self.load_time += seconds
+            self._models[key] = (mtime, model)
+        if self.on_load is not None:
+            self.on_load(model_dir, seconds)
+        return model
+
+    def warm_up(self, model_dir, warm_up_fn=None, **options):
+        """
+        Load the model ahead of the first request and optionally run it
+        once so that lazy initialisation happens outside the scoring loop.
+
+        :param model_dir: the directory that holds the model file
+        :param warm_up_fn: (optional) callable(model) run once after loading
+        """
+        model = self.get(model_dir, **options)
+        if warm_up_fn is not None:
+            warm_up_fn(model)
+        return model
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+    def stats(self):
+        return {
+            "models": len(self._models),
+            "hits": self.hits,
+            "misses": self.misses,
+            "load_time": self.load_time,
+        }
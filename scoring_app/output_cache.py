@@ -0,0 +1,229 @@
+import os
+import shutil
+import hashlib
+import threading
+import logging
+import numpy as np
+from PIL import Image
+
+
+def model_digest(model_file, **options):
+    """
+    returns a digest of the model file and the options that change its output
+
+    :param model_file: full path of the model file
+    :param options: (optional) e.g. precision and model_format
+    """
+    digest = hashlib.sha256()
+    with open(model_file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    for name in sorted(options):
+        digest.update("{}={};".format(name, options[name]).encode())
+    return digest.hexdigest()
+
+
+def dhash(pixels, size=8):
+    """
+    returns the difference hash of a HxWx3 uint8 frame as a hex string, frames
+    that look the same, e.g. of a static scene, have the same hash
+    """
+    img = Image.fromarray(pixels).convert("L")
+    gray = np.asarray(img.resize((size + 1, size), Image.ANTIALIAS), dtype=np.int16)
+    bits = np.packbits(gray[:, 1:] > gray[:, :-1])
+    return "".join("{:02x}".format(b) for b in bits)
+
+
+# entries are spread over 256 shard dirs by the first two hex digits of the key
+SHARDS = 256
+
+# the counter file of the size of a shard, dot files are not entries
+SIZE_FILE = ".size"
+
+
+class OutputCache:
+    """
+    A content-addressed cache of stylized frames on the mount, keyed by the
+    decoded input frame and the model digest. A hit links (or copies) the
+    stored output instead of running the style model.
+
+    Entries are spread over SHARDS dirs by key, and each shard keeps its size
+    in a counter file so that the cache is never walked as a whole. Once a
+    shard grows beyond its share of `max_bytes`, only that shard is listed
+    and its least recently used entries are evicted. Counters that drift
+    because workers update them concurrently are corrected by that listing.
+
+    Usage:
+        cache = OutputCache(cache_dir, model_digest(model_file))
+        key = cache.key(pixels)
+        if not cache.fetch(key, output_file):
+            ...  # stylize and write output_file
+            cache.put(key, output_file)
+    """
+
+    def __init__(
+        self, cache_dir, digest, max_bytes=10 << 30, near_duplicates=False, link=True
+    ):
+        """
+        :param cache_dir: the dir on the mount to keep the cache in
+        :param digest: the digest of the model, see `model_digest`
+        :param max_bytes: (optional) the size the cache is evicted down to
+        :param near_duplicates: (optional) key frames by a perceptual hash, so
+            frames that only differ by noise share an output
+        :param link: (optional) hardlink entries instead of copying them, falls
+            back to copying where the mount has no hardlinks
+        """
+        self.cache_dir = cache_dir
+        self.digest = digest
+        self.max_bytes = max_bytes
+        self.near_duplicates = near_duplicates
+        self.link = link
+        self.hits = 0
+        self.misses = 0
+        self._shards = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, pixels):
+        """
+        :param pixels: the decoded input frame as a HxWx3 uint8 array
+
+        returns the cache key of the frame's output with this model
+        """
+        pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+        if self.near_duplicates:
+            frame_hash = "dhash-" + dhash(pixels)
+        else:
+            frame_hash = hashlib.sha256(pixels.data).hexdigest()
+        key = "{}:{}x{}:{}".format(
+            self.digest, pixels.shape[1], pixels.shape[0], frame_hash
+        )
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _path(self, key, ext):
+        return os.path.join(self.cache_dir, key[:2], key + ext)
+
+    def _counter(self, shard):
+        return os.path.join(self.cache_dir, shard, SIZE_FILE)
+
+    def _read_size(self, shard):
+        try:
+            with open(self._counter(shard)) as f:
+                return int(f.read() or 0)
+        except (OSError, IOError, ValueError):
+            return 0
+
+    def _write_size(self, shard, size):
+        counter = self._counter(shard)
+        tmp_path = "{}.{}".format(counter, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.write(str(max(0, size)))
+        os.replace(tmp_path, counter)
+        self._shards[shard] = max(0, size)
+
+    def _place(self, src, dst):
+        """
+        atomically link or copy src to dst
+        """
+        tmp_path = os.path.join(
+            os.path.dirname(dst), ".{}.{}".format(os.path.basename(dst), os.getpid())
+        )
+        try:
+            if not self.link:
+                raise OSError("hardlinks disabled")
+            os.link(src, tmp_path)
+        except OSError:
+            shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+
+    def fetch(self, key, output_file):
+        """
+        returns True if the output was in the cache and is now at output_file
+        """
+        path = self._path(key, os.path.splitext(output_file)[1])
+        try:
+            self._place(path, output_file)
+            # the mtime orders entries for eviction
+            os.utime(path)
+        except (OSError, IOError):
+            with self._lock:
+                self.misses += 1
+            return False
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def put(self, key, output_file):
+        """
+        store the output written to output_file under the key
+        """
+        path = self._path(key, os.path.splitext(output_file)[1])
+        shard = key[:2]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        self._place(output_file, path)
+        with self._lock:
+            size = self._read_size(shard) + os.path.getsize(path) - replaced
+            self._write_size(shard, size)
+        if size > self.max_bytes / SHARDS:
+            self.evict(shard)
+
+    def _entries(self, shard):
+        """
+        yields (path, size, mtime) of every entry of the shard
+        """
+        shard_dir = os.path.join(self.cache_dir, shard)
+        for filename in os.listdir(shard_dir):
+            if filename.startswith("."):
+                continue
+            path = os.path.join(shard_dir, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            yield path, stat.st_size, stat.st_mtime
+
+    def evict(self, shard, target=0.9):
+        """
+        remove the least recently used entries of the shard until it is below
+        `target` of its share of max_bytes
+        """
+        logger = logging.getLogger("root")
+
+        # other workers share the shard, so its size is counted again
+        entries = sorted(self._entries(shard), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for path, size, _ in entries:
+            if total <= self.max_bytes / SHARDS * target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        with self._lock:
+            self._write_size(shard, total)
+        logger.debug(
+            "Evicted {} entries from shard {} of the output cache".format(
+                removed, shard
+            )
+        )
+
+    def stats(self):
+        """
+        returns the hits, misses, hit rate and the size of the shards this
+        worker has written to
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "bytes": sum(self._shards.values()),
+            }
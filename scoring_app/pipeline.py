@@ -0,0 +1,200 @@
+import time
+import queue
+import threading
+import logging
+import torch
+from concurrent.futures import ThreadPoolExecutor
+import style_transfer
+
+
+class StageTimer:
+    """
+    Thread safe accumulator for the time spent in each pipeline stage.
+    """
+
+    def __init__(self):
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            count, total, peak = self._stages.get(stage, (0, 0.0, 0.0))
+            self._stages[stage] = (count + 1, total + seconds, max(peak, seconds))
+
+    def stats(self):
+        """
+        returns a dict of stage -> {count, total, mean, max} in seconds
+        """
+        with self._lock:
+            return {
+                stage: {
+                    "count": count,
+                    "total": total,
+                    "mean": total / count if count else 0.0,
+                    "max": peak,
+                }
+                for stage, (count, total, peak) in self._stages.items()
+            }
+
+    def summary(self):
+        return ", ".join(
+            "{} {:.3f}s/frame (max {:.3f}s, n={})".format(
+                stage, s["mean"], s["max"], s["count"]
+            )
+            for stage, s in sorted(self.stats().items())
+        )
+
+
+class StylePipeline:
+    """
+    Runs decode -> infer -> encode as three overlapping stages. Decoding and
+    encoding run on thread pools, inference runs on a dedicated thread, and
+    the stages are linked by bounded queues so that at most `depth` frames
+    are waiting in front of, and behind, the model at any time.
+
+    Usage:
+        with StylePipeline(style_model, device) as pipeline:
+            pipeline.submit(input_file, output_file, on_done=callback)
+    """
+
+    def __init__(
+        self,
+        style_model,
+        device,
+        content_scale=None,
+        depth=4,
+        decode_workers=2,
+        encode_workers=2,
+        tiling=None,
+    ):
+        """
+        :param style_model: the style model
+        :param device: cuda or cpu
+        :param content_scale: (optional) to scale images
+        :param depth: the number of frames buffered between stages
+        :param decode_workers: the number of threads decoding input frames
+        :param encode_workers: the number of threads encoding output frames
+        :param tiling: (optional) dict of tile_size, overlap and global_stats
+        """
+        assert depth > 0
+        self.style_model = style_model
+        self.device = device
+        self.content_scale = content_scale
+        self.tiling = tiling
+        self.timer = StageTimer()
+
+        self._decode_pool = ThreadPoolExecutor(max_workers=decode_workers)
+        self._encode_pool = ThreadPoolExecutor(max_workers=encode_workers)
+        self._decoded = queue.Queue(maxsize=depth)
+        self._encode_slots = threading.BoundedSemaphore(depth)
+
+        self._pending = 0
+        self._pending_cond = threading.Condition()
+
+        self._infer_thread = threading.Thread(target=self._infer_loop, daemon=True)
+        self._infer_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, input_file, output_file, on_done=None):
+        """
+        Queue a frame for processing. Blocks while the pipeline is full.
+
+        :param input_file: full path of image to process
+        :param output_file: full path of the output image
+        :param on_done: (optional) callable(error, timings) called after the frame
+            is written (error is None) or once it has failed, timings is a dict of
+            stage -> seconds for this frame
+        """
+        with self._pending_cond:
+            self._pending += 1
+        timings = {}
+        future = self._decode_pool.submit(self._decode, input_file, timings)
+        self._decoded.put((future, input_file, output_file, on_done, timings))
+
+    def join(self):
+        """
+        Block until every submitted frame has been written or has failed.
+        """
+        with self._pending_cond:
+            while self._pending > 0:
+                self._pending_cond.wait()
+
+    def close(self):
+        self.join()
+        self._decoded.put(None)
+        self._infer_thread.join()
+        self._decode_pool.shutdown()
+        self._encode_pool.shutdown()
+
+    def _record(self, timings, stage, seconds):
+        timings[stage] = seconds
+        self.timer.record(stage, seconds)
+
+    def _decode(self, input_file, timings):
+        t0 = time.time()
+        content_image = style_transfer._load_content(input_file, self.content_scale)
+        self._record(timings, "decode", time.time() - t0)
+        return content_image
+
+    def _infer_loop(self):
+        logger = logging.getLogger("root")
+
+        while True:
+            item = self._decoded.get()
+            if item is None:
+                break
+            future, input_file, output_file, on_done, timings = item
+
+            try:
+                content_image = future.result()
+                t0 = time.time()
+                with torch.no_grad():
+                    output = style_transfer.run_style_model(
+                        self.style_model,
+                        content_image.unsqueeze(0),
+                        self.device,
+                        tiling=self.tiling,
+                    )
+                self._record(timings, "infer", time.time() - t0)
+            except Exception as e:
+                logger.exception("Failed to stylize {}".format(input_file))
+                self._finish(on_done, e, timings)
+                continue
+
+            self._encode_slots.acquire()
+            self._encode_pool.submit(
+                self._encode, output[0], output_file, on_done, timings
+            )
+
+    def _encode(self, output_image, output_file, on_done, timings):
+        logger = logging.getLogger("root")
+
+        error = None
+        try:
+            t0 = time.time()
+            style_transfer.save_image(output_file, output_image)
+            self._record(timings, "encode", time.time() - t0)
+        except Exception as e:
+            logger.exception("Failed to write {}".format(output_file))
+            error = e
+        finally:
+            self._encode_slots.release()
+        self._finish(on_done, error, timings)
+
+    def _finish(self, on_done, error, timings):
+        logger = logging.getLogger("root")
+
+        try:
+            if on_done is not None:
+                on_done(error, timings)
+        except Exception:
+            logger.exception("Pipeline callback failed")
+        finally:
+            with self._pending_cond:
+                self._pending -= 1
+                self._pending_cond.notify_all()
@@ -0,0 +1,86 @@
+import math
+import contextlib
+import torch
+
+
+PRECISIONS = ["fp32", "bf16", "fp16"]
+
+
+def _dtype(precision):
+    return {"bf16": torch.bfloat16, "fp16": torch.float16}[precision]
+
+
+def check_supported(precision, channels_last, device):
+    """
+    Raise a ValueError if this torch build cannot run the requested mode.
+
+    :param precision: one of PRECISIONS
+    :param channels_last: whether to use the channels_last memory format
+    :param device: cuda or cpu
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision '{}'".format(precision))
+    if precision != "fp32" and not hasattr(torch, "autocast"):
+        raise ValueError(
+            "precision '{}' requires torch.autocast (torch {} installed)".format(
+                precision, torch.__version__
+            )
+        )
+    if precision == "fp16" and torch.device(device).type != "cuda":
+        raise ValueError("precision 'fp16' is only supported on cuda, use 'bf16'")
+    if channels_last and not hasattr(torch, "channels_last"):
+        raise ValueError(
+            "channels_last requires a newer torch (torch {} installed)".format(
+                torch.__version__
+            )
+        )
+
+
+class InferenceModel(torch.nn.Module):
+    """
+    Runs a style model with reduced precision autocast and/or the
+    channels_last memory format. Inputs and outputs stay fp32 NCHW tensors,
+    so callers do not need to know which mode is used.
+    """
+
+    def __init__(self, model, precision="fp32", channels_last=False):
+        """
+        :param model: the fp32 style model
+        :param precision: one of PRECISIONS
+        :param channels_last: whether to use the channels_last memory format
+        """
+        super(InferenceModel, self).__init__()
+        self.model = model
+        self.precision = precision
+        self.channels_last = channels_last
+        if channels_last:
+            self.model.to(memory_format=torch.channels_last)
+
+    def _autocast(self, device):
+        if self.precision == "fp32":
+            return contextlib.suppress()
+        return torch.autocast(device_type=device.type, dtype=_dtype(self.precision))
+
+    def forward(self, X):
+        if self.channels_last:
+            X = X.contiguous(memory_format=torch.channels_last)
+        with self._autocast(X.device):
+            y = self.model(X)
+        return y.float().contiguous()
+
+
+def psnr(output, reference, peak=255.0):
+    """
+    Peak signal-to-noise ratio in dB between two images, after clamping
+    both to the range of an 8 bit image as `save_image` does.
+
+    :param output: the image to compare
+    :param reference: the reference image
+    :param peak: the maximum pixel value
+    """
+    output = output.float().clamp(0, peak)
+    reference = reference.float().clamp(0, peak)
+    mse = float(((output - reference) ** 2).mean())
+    if mse == 0:
+        return float("inf")
+    return 10 * math.log10(peak ** 2 / mse)
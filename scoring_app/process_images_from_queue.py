@@ -1,5 +1,12 @@
-import ast
+import message_codec
+import json
+import itertools
+import collections
+import email.utils
+import socket
+import threading
 import style_transfer
+import image_convert
 import pathlib
 import datetime
 import time
@@ -7,88 +14,986 @@ import os
 import logging
 import util
 import torch
-from logging.handlers import RotatingFileHandler
+from pipeline import StylePipeline
+from receiver import PrefetchingReceiver, ServiceBusTransport
+from frame_log import FrameLog
+import frame_store
+from completion import FlushedReceiver, get_publisher
+from output_cache import OutputCache, model_digest
+from manifest import Manifest, MANIFEST_FILE
+import metrics
+import profiling
 
 
-def add_file_handler(logger, log_path):
+# output dirs this worker has already created
+_created_dirs = set()
+
+# output chunks are named after the worker that wrote them
+_worker = "{}-{}".format(socket.gethostname(), os.getpid())
+_chunk_seq = itertools.count()
+
+# manifests of the videos this worker scores, reloaded when they change but
+# at most every MANIFEST_RELOAD_INTERVAL seconds, the orchestrator saves them
+# on every poll with progress
+_manifests = {}
+MANIFEST_RELOAD_INTERVAL = 10.0
+
+# frames this worker finished, by video, run and frame, so that duplicate
+# messages of a requeued frame are completed without scoring it again
+_finished = collections.OrderedDict()
+_finished_lock = threading.Lock()
+_MAX_FINISHED = 100000
+
+# exported at /metrics when the worker is started with a metrics port
+FRAMES = metrics.REGISTRY.counter(
+    "scoring_frames_total", "Frames handled by this worker, by status.", ("status",)
+)
+STAGE_SECONDS = metrics.REGISTRY.histogram(
+    "scoring_stage_seconds", "Time spent in each stage of scoring a frame.", ("stage",)
+)
+MODEL_LOAD_SECONDS = metrics.REGISTRY.histogram(
+    "scoring_model_load_seconds", "Time spent loading a style model."
+)
+QUEUE_WAIT_SECONDS = metrics.REGISTRY.histogram(
+    "scoring_queue_wait_seconds",
+    "Time a message waited in the queue before this worker took it.",
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0),
+)
+
+
+def _ensure_dir(path):
+    if path not in _created_dirs:
+        os.makedirs(path, exist_ok=True)
+        _created_dirs.add(path)
+
+
+def _frame_dirs(mount_dir, video_name, style=None):
+    """
+    returns the input and output dir of the video, for the style if the
+    video is rendered in several styles
+    """
+    return (
+        os.path.join(mount_dir, video_name, util.Storage.INPUT_DIR.value),
+        os.path.join(mount_dir, video_name, util.output_dir_name(style)),
+    )
+
+
+def _parse_msg(msg, mount_dir):
+    """
+    :param msg: the service bus message
+    :param mount_dir: the mount directory of the storage container
+
+    returns the message body, input_dir and output_dir
+    """
+    msg_body = _decode(msg)
+    input_dir, output_dir = _frame_dirs(mount_dir, msg_body["video_name"])
+    return msg_body, input_dir, output_dir
+
+
+def _decode(msg):
+    """
+    returns the message body, decoded once and kept on the message
+    """
+    msg_body = getattr(msg, "decoded_body", None)
+    if msg_body is None:
+        msg_body = msg.decoded_body = message_codec.decode(msg.body)
+    return msg_body
+
+
+def _drop_malformed(msgs, receiver):
+    """
+    complete messages that cannot be decoded, so they are not redelivered
+
+    returns the messages that can be decoded
+    """
+    logger = logging.getLogger("root")
+
+    valid = []
+    for msg in msgs:
+        try:
+            _decode(msg)
+        except (ValueError, KeyError):
+            logger.exception("Dropping malformed message {!r}".format(msg.body))
+            receiver.complete(msg)
+            continue
+        valid.append(msg)
+    return valid
+
+
+def _observe_queue_wait(msgs):
+    """
+    observe how long each message waited since the broker enqueued it
+    """
+    now = time.time()
+    for msg in msgs:
+        enqueued = (getattr(msg, "broker_properties", None) or {}).get(
+            "EnqueuedTimeUtc"
+        )
+        if enqueued is None:
+            continue
+        try:
+            enqueued = email.utils.parsedate_to_datetime(enqueued).timestamp()
+        except (TypeError, ValueError):
+            continue
+        QUEUE_WAIT_SECONDS.observe(max(0.0, now - enqueued))
+
+
+def _input_frame(msg_body, input_dir):
+    """
+    returns the full path of the input frame, or the frame_store.ChunkFrame
+    if the frame is in a chunk store
+    """
+    ref = msg_body.get("input_chunk")
+    if ref is not None:
+        return frame_store.ChunkFrame(input_dir, ref)
+    return os.path.join(input_dir, msg_body["input_frame"])
+
+
+def _get_manifest(mount_dir, video_name):
+    """
+    returns the manifest of the video, or None if it has none
+    """
+    now = time.time()
+    cached = _manifests.get(video_name)
+    if cached is not None and now - cached[0] < MANIFEST_RELOAD_INTERVAL:
+        return cached[2]
+
+    try:
+        mtime = os.path.getmtime(os.path.join(mount_dir, video_name, MANIFEST_FILE))
+    except OSError:
+        mtime = None
+    if cached is not None and cached[1] == mtime:
+        manifest = cached[2]
+    elif mtime is None:
+        manifest = None
+    else:
+        manifest = Manifest.load(mount_dir, video_name)
+    _manifests[video_name] = (now, mtime, manifest)
+    return manifest
+
+
+def _is_done(mount_dir, msg_body):
+    """
+    returns True if the manifest records the frame as done and its output
+    exists, e.g. when a worker died before deleting the message. The files
+    are not hashed, the orchestrator verifies them when it resumes a video.
+    Frames in a chunk store or rendered in several styles are never skipped.
+    """
+    if "input_chunk" in msg_body or "model_dirs" in msg_body:
+        return False
+    manifest = _get_manifest(mount_dir, msg_body["video_name"])
+    if manifest is None:
+        return False
+    input_dir, output_dir = _frame_dirs(mount_dir, msg_body["video_name"])
+    input_frame = msg_body["input_frame"]
+    return manifest.is_done(
+        input_frame,
+        os.path.join(input_dir, input_frame),
+        os.path.join(output_dir, input_frame),
+        verify=False,
+    )
+
+
+def _finished_key(mount_dir, video_name, frame):
+    """
+    returns the key of the frame in the current run of its video, or None if
+    the video has no manifest
+    """
+    manifest = _get_manifest(mount_dir, video_name)
+    if manifest is None:
+        return None
+    return video_name, manifest.started, frame
+
+
+def _mark_finished(mount_dir, video_name, frame):
+    key = _finished_key(mount_dir, video_name, frame)
+    if key is None:
+        return
+    with _finished_lock:
+        _finished[key] = True
+        while len(_finished) > _MAX_FINISHED:
+            _finished.popitem(last=False)
+
+
+def _is_duplicate(mount_dir, msg_body):
+    """
+    returns True if this worker already finished the frame in the current run
+    of its video, e.g. a failed frame that was requeued while its original
+    message was still redelivered
+    """
+    key = _finished_key(mount_dir, msg_body["video_name"], msg_body["input_frame"])
+    return key is not None and key in _finished
+
+
+def _frame_hashes(mount_dir, video_name, frame):
+    """
+    returns the content hashes of the input and output of a finished frame,
+    taken from the bytes this worker decoded and encoded. Frames in a chunk
+    store or whose output came from the cache have none, they are scored
+    again instead of skipped when redelivered.
+    """
+    input_dir, output_dir = _frame_dirs(mount_dir, video_name)
+    input_sha256 = image_convert.pop_digest(os.path.join(input_dir, frame))
+    output_sha256 = image_convert.pop_digest(os.path.join(output_dir, frame))
+    if input_sha256 is None or output_sha256 is None:
+        return {}
+    return {"input_sha256": input_sha256, "output_sha256": output_sha256}
+
+
+def _receive_batch(receiver, batch_size, max_batch_wait_ms):
+    """
+    Take up to `batch_size` locked messages from the receiver. The first
+    message is waited for as usual; once it has arrived, further messages
+    are collected until the batch is full or `max_batch_wait_ms` has passed.
+
+    :param receiver: the PrefetchingReceiver for the queue
+    :param batch_size: the maximum number of messages to take
+    :param max_batch_wait_ms: how long to wait for the batch to fill up
+
+    returns a (possibly empty) list of messages
+    """
+    msg = receiver.get(timeout=30)
+    if msg is None:
+        return []
+
+    msgs = [msg]
+    deadline = time.time() + max_batch_wait_ms / 1000.0
+    while len(msgs) < batch_size:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        msg = receiver.get(timeout=remaining)
+        if msg is None:
+            break
+        msgs.append(msg)
+    return msgs
+
+
+def _stylize_frames(
+    bodies, mount_dir, style_model, device, on_saved, tiling=None, cache=None
+):
+    """
+    Stylize the frames of several message bodies with as few forward passes
+    as possible. Frames in a chunk store are written to one output chunk per
+    video and style and only count as saved once that chunk is closed.
+
+    :param bodies: list of dicts with video_name, input_frame and, for frames in
+        a chunk store, input_chunk
+    :param mount_dir: the mount directory of the storage container
+    :param style_model: the loaded style model, or an OrderedDict of style name
+        -> style model to render every frame in each of the styles
+    :param device: cuda or cpu
+    :param on_saved: callable(index) called once bodies[index] is written
+    :param tiling: (optional) dict of tile_size, overlap and global_stats
+    :param cache: (optional) the OutputCache to look outputs up in
+    """
+    logger = logging.getLogger("root")
+
+    fan_out = isinstance(style_model, dict)
+    styles = list(style_model) if fan_out else [None]
+
+    frames = []
+    writers = {}
+    for msg_body in bodies:
+        input_dir, _ = _frame_dirs(mount_dir, msg_body["video_name"])
+        input_frame = msg_body["input_frame"]
+        ref = msg_body.get("input_chunk")
+
+        targets = []
+        for style in styles:
+            _, output_dir = _frame_dirs(mount_dir, msg_body["video_name"], style)
+            _ensure_dir(output_dir)
+            if ref is None:
+                targets.append(os.path.join(output_dir, input_frame))
+                continue
+            writer = writers.get(output_dir)
+            if writer is None:
+                writer = writers[output_dir] = frame_store.ChunkWriter(
+                    output_dir,
+                    "{}-{:06d}".format(_worker, next(_chunk_seq)),
+                    compression=ref["compression"],
+                )
+            targets.append(writer.target(input_frame))
+        frames.append(
+            (_input_frame(msg_body, input_dir), targets if fan_out else targets[0])
+        )
+
+    in_chunks = []
+
+    def _on_saved(i):
+        logger.debug("Finished style transfer on {}".format(bodies[i]["input_frame"]))
+        if "input_chunk" in bodies[i]:
+            in_chunks.append(i)
+        else:
+            on_saved(i)
+
+    logger.debug("Starting style transfer on batch of {} frames".format(len(frames)))
+    try:
+        if fan_out:
+            style_transfer.stylize_styles(
+                content_scale=None,
+                style_models=list(style_model.values()),
+                device=device,
+                frames=frames,
+                on_saved=_on_saved,
+                tiling=tiling,
+            )
+        else:
+            style_transfer.stylize_batch(
+                content_scale=None,
+                style_model=style_model,
+                device=device,
+                frames=frames,
+                on_saved=_on_saved,
+                tiling=tiling,
+                cache=cache,
+            )
+        while writers:
+            writers.popitem()[1].close()
+    except Exception:
+        for writer in writers.values():
+            writer.abort()
+        raise
+    for i in in_chunks:
+        on_saved(i)
+
+
+def _process_batch(
+    msgs, receiver, report, style_model, device, mount_dir, tiling=None, cache=None
+):
+    """
+    :param msgs: the locked service bus messages
+    :param receiver: the PrefetchingReceiver the messages came from
+    :param report: called with the video name, frame and outcome of each frame
+    :param style_model: the loaded style model, or an OrderedDict of style name
+        -> style model, see `_stylize_frames`
+    :param device: cuda or cpu
+    :param mount_dir: the mount directory of the storage container
+    :param tiling: (optional) dict of tile_size, overlap and global_stats
+    :param cache: (optional) the OutputCache to look outputs up in
+    """
+    logger = logging.getLogger("root")
+
+    bodies = []
+    for msg in msgs:
+        msg_body, _, _ = _parse_msg(msg, mount_dir)
+        logger.debug("Queue message body: {}".format(msg_body))
+        bodies.append(msg_body)
+
+    # delete each msg as soon as its frame has been written
+    t0 = time.time()
+    saved = set()
+
+    def _on_saved(i):
+        saved.add(i)
+        report(
+            bodies[i]["video_name"],
+            bodies[i]["input_frame"],
+            stages={"batch": time.time() - t0},
+            batch_size=len(bodies),
+        )
+        receiver.complete(msgs[i])
+
+    try:
+        _stylize_frames(
+            bodies,
+            mount_dir,
+            style_model,
+            device,
+            _on_saved,
+            tiling=tiling,
+            cache=cache,
+        )
+    except Exception as e:
+        logger.exception("Style transfer failed on batch")
+        for i in range(len(msgs)):
+            if i not in saved:
+                report(bodies[i]["video_name"], bodies[i]["input_frame"], error=e)
+                receiver.abandon(msgs[i])
+
+
+def _read_checkpoint(checkpoint_file):
+    """
+    returns the set of frames the checkpoint records as done
+    """
+    if not os.path.exists(checkpoint_file):
+        return set()
+    with open(checkpoint_file) as f:
+        return set(json.load(f)["done"])
+
+
+def _write_checkpoint(checkpoint_file, done):
+    """
+    atomically replace the checkpoint with the set of frames that are done
+    """
+    checkpoint_dir, filename = os.path.split(checkpoint_file)
+    _ensure_dir(checkpoint_dir)
+    tmp_path = os.path.join(checkpoint_dir, ".{}".format(filename))
+    with open(tmp_path, "w") as f:
+        json.dump({"done": sorted(done)}, f)
+    os.replace(tmp_path, checkpoint_file)
+
+
+def _process_unit(
+    msg,
+    receiver,
+    report,
+    style_model,
+    device,
+    mount_dir,
+    batch_size,
+    tiling=None,
+    cache=None,
+):
+    """
+    Stylize all frames of a work unit message in batches of `batch_size`.
+    Progress is checkpointed after every batch, so when the message is
+    redelivered only the unfinished frames are processed again.
+
+    :param msg: the locked service bus message of the work unit
+    :param receiver: the PrefetchingReceiver the message came from
+    :param report: called with the video name, frame and outcome of each frame
+    :param style_model: the loaded style model, or an OrderedDict of style name
+        -> style model, see `_stylize_frames`
+    :param device: cuda or cpu
+    :param mount_dir: the mount directory of the storage container
+    :param batch_size: the maximum number of frames per forward pass
+    :param tiling: (optional) dict of tile_size, overlap and global_stats
+    :param cache: (optional) the OutputCache to look outputs up in
+    """
+    logger = logging.getLogger("root")
+
+    msg_body, _, _ = _parse_msg(msg, mount_dir)
+    video_name = msg_body["video_name"]
+    checkpoint_file = os.path.join(
+        mount_dir,
+        video_name,
+        util.Storage.CHECKPOINT_DIR.value,
+        "{}.json".format(msg_body["unit"]),
+    )
+
+    done = _read_checkpoint(checkpoint_file)
+    bodies = []
+    for frame in msg_body["frames"]:
+        frame = dict(frame, video_name=video_name)
+        if "model_dirs" in msg_body:
+            frame["model_dirs"] = msg_body["model_dirs"]
+        if frame["input_frame"] in done:
+            report(video_name, frame["input_frame"], skipped=True)
+            continue
+        if _is_done(mount_dir, frame):
+            done.add(frame["input_frame"])
+            report(video_name, frame["input_frame"], skipped=True)
+            continue
+        bodies.append(frame)
+    logger.debug(
+        "Work unit {} of {}: {} of {} frames left".format(
+            msg_body["unit"], video_name, len(bodies), len(msg_body["frames"])
+        )
+    )
+
+    t0 = time.time()
+    for start in range(0, len(bodies), batch_size):
+        batch = bodies[start : start + batch_size]
+
+        def _on_saved(i, batch=batch):
+            done.add(batch[i]["input_frame"])
+            report(
+                video_name,
+                batch[i]["input_frame"],
+                stages={"unit": time.time() - t0},
+                unit=msg_body["unit"],
+            )
+
+        try:
+            _stylize_frames(
+                batch,
+                mount_dir,
+                style_model,
+                device,
+                _on_saved,
+                tiling=tiling,
+                cache=cache,
+            )
+        except Exception as e:
+            logger.exception(
+                "Style transfer failed on work unit {}".format(msg_body["unit"])
+            )
+            for frame in batch:
+                if frame["input_frame"] not in done:
+                    report(video_name, frame["input_frame"], error=e)
+            _write_checkpoint(checkpoint_file, done)
+            receiver.abandon(msg)
+            return
+        _write_checkpoint(checkpoint_file, done)
+
+    receiver.complete(msg)
+
+
+def _submit_to_pipeline(msgs, receiver, report, style_pipeline, mount_dir):
     """
-    :param log_path: the log file to attach the handler to
+    :param msgs: the locked service bus messages
+    :param receiver: the PrefetchingReceiver the messages came from
+    :param report: called with the video name, frame and outcome of each frame
+    :param style_pipeline: the running StylePipeline
+    :param mount_dir: the mount directory of the storage container
     """
-    handler_format = util.get_handler_format()
-    file_handler = RotatingFileHandler(log_path, maxBytes=20000)
-    file_handler.setFormatter(handler_format)
-    logger.addHandler(file_handler)
+    logger = logging.getLogger("root")
+
+    for msg in msgs:
+        msg_body, input_dir, output_dir = _parse_msg(msg, mount_dir)
+        logger.debug("Queue message body: {}".format(msg_body))
+        _ensure_dir(output_dir)
+
+        video_name = msg_body["video_name"]
+        input_frame = msg_body["input_frame"]
+
+        # delete the msg once its frame is written, release it on failure
+        def _on_done(
+            error, timings, msg=msg, video_name=video_name, input_frame=input_frame
+        ):
+            report(video_name, input_frame, stages=timings, error=error)
+            if error is None:
+                logger.debug("Finished style transfer on {}".format(input_frame))
+                receiver.complete(msg)
+            else:
+                logger.debug("Unlocking queue message for {}".format(input_frame))
+                receiver.abandon(msg)
+
+        style_pipeline.submit(
+            os.path.join(input_dir, input_frame),
+            os.path.join(output_dir, input_frame),
+            on_done=_on_done,
+        )
 
 
-def dequeue(bus_service, model_dir, queue, mount_dir, terminate=None):
+def _check_precision(msg, mount_dir, model_dir, device, model_options, psnr_threshold):
+    """
+    :param msg: a locked service bus message whose frame is used as the sample
+    :param mount_dir: the mount directory of the storage container
+    :param model_dir: the directory in storage where models are stored
+    :param device: cuda or cpu
+    :param model_options: the precision, channels_last and model_format to check
+    :param psnr_threshold: the lowest PSNR in dB against fp32 output accepted
+
+    returns True if the reduced precision output is close enough to fp32
+    """
+    logger = logging.getLogger("root")
+
+    msg_body, input_dir, _ = _parse_msg(msg, mount_dir)
+    if "frames" in msg_body:
+        msg_body = msg_body["frames"][0]
+    lowest = style_transfer.check_precision(
+        os.path.join(mount_dir, model_dir),
+        device,
+        [_input_frame(msg_body, input_dir)],
+        **model_options
+    )
+    if lowest < psnr_threshold:
+        logger.warning(
+            "PSNR against fp32 {:.2f}dB is below {:.2f}dB with {}, falling back to fp32".format(
+                lowest, psnr_threshold, model_options
+            )
+        )
+        return False
+    logger.debug("PSNR against fp32 {:.2f}dB with {}".format(lowest, model_options))
+    return True
+
+
+def dequeue(
+    bus_service,
+    model_dir,
+    queue,
+    mount_dir,
+    terminate=None,
+    batch_size=1,
+    max_batch_wait_ms=500,
+    pipeline_depth=0,
+    prefetch=2,
+    receivers=1,
+    precision="fp32",
+    channels_last=False,
+    psnr_threshold=40.0,
+    model_format="eager",
+    tile_size=None,
+    tile_overlap=32,
+    tile_global_stats=False,
+    completion_backend="file",
+    results_queue=None,
+    cache_dir=None,
+    cache_max_gb=10.0,
+    cache_near_duplicates=False,
+    cache_copy=False,
+    metrics_port=None,
+    profile_dir=None,
+    profile_frames=100,
+):
     """
     :param bus_service: service bus client
     :param model_dir: the directory in storage where models are stored
     :param queue: the name of the queue
     :param terminate: (optional) used for debugging - terminate process instead of stay alive
+    :param batch_size: (optional) the number of messages to score in one forward pass
+    :param max_batch_wait_ms: (optional) how long to wait for a batch to fill up
+    :param pipeline_depth: (optional) if > 0, overlap decode, inference and encode
+        with this many frames buffered between stages
+    :param prefetch: (optional) the number of locked messages to keep buffered
+    :param receivers: (optional) the number of threads receiving from the queue
+    :param precision: (optional) one of fp32, bf16 or fp16
+    :param channels_last: (optional) run the model in the channels_last memory format
+    :param psnr_threshold: (optional) the lowest PSNR in dB against fp32 output on
+        the first frame for which reduced precision is kept, None to skip the check
+    :param model_format: (optional) eager, torchscript to load the artifact
+        written by export_model.py or quantized for the one from quantize_model.py
+    :param tile_size: (optional) stylize frames larger than this tile by tile
+    :param tile_overlap: (optional) the overlap in pixels blended between tiles
+    :param tile_global_stats: (optional) normalise all tiles with statistics of
+        the whole frame
+    :param completion_backend: (optional) file to write completion events to the
+        video's events dir or queue to send them to `results_queue`
+    :param results_queue: (optional) the name of the queue completion events are
+        sent to
+    :param cache_dir: (optional) the directory in storage to cache outputs in, by
+        input frame and model
+    :param cache_max_gb: (optional) the size of the output cache in GB
+    :param cache_near_duplicates: (optional) key the cache by a perceptual hash so
+        near-identical frames, e.g. of static scenes, share an output
+    :param cache_copy: (optional) copy outputs from the cache instead of hardlinking
+    :param metrics_port: (optional) serve Prometheus metrics on this port
+    :param profile_dir: (optional) the directory in storage to write per-module
+        timings and a Chrome trace of the style model to, per worker
+    :param profile_frames: (optional) the number of frames to profile
     """
 
     logger = logging.getLogger("root")
 
-    # start listening...
+    # export frame, stage, model load and queue wait metrics
+    style_transfer.model_registry.on_load = lambda model_dir, seconds: (
+        MODEL_LOAD_SECONDS.observe(seconds)
+    )
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+        logger.debug("Serving metrics on port {}".format(metrics_port))
+
+    # load the style model once for the lifetime of this worker
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if model_format == "quantized":
+        device = torch.device("cpu")
+    model_options = {
+        "precision": precision,
+        "channels_last": channels_last,
+        "model_format": model_format,
+    }
+    logger.debug("Warming up style model from {}...".format(model_dir))
+    style_model = style_transfer.warm_up(
+        os.path.join(mount_dir, model_dir), device, **model_options
+    )
+    verify_precision = psnr_threshold is not None and (
+        precision != "fp32" or channels_last
+    )
+
+    # stylize large frames tile by tile
+    tiling = util.tiling_options(tile_size, tile_overlap, tile_global_stats)
+
+    # reuse the output of frames this model has stylized before
+    cache = None
+    if cache_dir is not None:
+
+        def _digest(model_options):
+            model_file = style_transfer.MODEL_FILES[model_options["model_format"]]
+            return model_digest(
+                os.path.join(mount_dir, model_dir, model_file),
+                model_format=model_options["model_format"],
+                precision=model_options["precision"],
+            )
+
+        cache = OutputCache(
+            os.path.join(mount_dir, cache_dir),
+            _digest(model_options),
+            max_bytes=int(cache_max_gb * (1 << 30)),
+            near_duplicates=cache_near_duplicates,
+            link=not cache_copy,
+        )
+
+    # overlap decode -> infer -> encode across frames
+    style_pipeline = None
+    if pipeline_depth > 0:
+        if cache is not None:
+            logger.warning(
+                "The output cache is not used for single frames handed to the "
+                "pipeline, they are always stylized; run without --pipeline-depth "
+                "to use it"
+            )
+        style_pipeline = StylePipeline(
+            style_model, device, depth=pipeline_depth, tiling=tiling
+        )
+
+    # profile the modules of the style model over the first frames
+    profiler = None
+    if profile_dir is not None:
+        profiler = profiling.ModelProfiler(
+            style_model,
+            device,
+            os.path.join(mount_dir, profile_dir, _worker),
+            max_frames=profile_frames,
+        ).start()
+
+    # structured per-frame records, buffered per video
+    frame_log = FrameLog(mount_dir).start()
+
+    # completion events the orchestrator tracks the progress of a video with
+    publisher = get_publisher(
+        completion_backend,
+        mount_dir,
+        bus_service=bus_service,
+        results_queue=results_queue,
+    )
+
+    def _model_for(msg_body):
+        """
+        returns the worker's style model, or an OrderedDict of style name ->
+        style model for a message that lists the model_dirs to fan out to
+        """
+        if "model_dirs" not in msg_body:
+            return style_transfer.get_style_model(
+                os.path.join(mount_dir, model_dir), device, **model_options
+            )
+        return collections.OrderedDict(
+            (
+                util.style_name(style_dir),
+                style_transfer.get_style_model(
+                    os.path.join(mount_dir, style_dir), device, **model_options
+                ),
+            )
+            for style_dir in msg_body["model_dirs"]
+        )
+
+    def report(video_name, frame, stages=None, error=None, **fields):
+        if error is not None:
+            FRAMES.inc(status="failed")
+        else:
+            FRAMES.inc(status="skipped" if fields.get("skipped") else "done")
+        for stage, seconds in (stages or {}).items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+        if profiler is not None and error is None and not fields.get("skipped"):
+            profiler.frame_done()
+        if error is None:
+            _mark_finished(mount_dir, video_name, frame)
+        frame_log.record(video_name, frame, stages=stages, error=error, **fields)
+        hashes = {}
+        if error is None:
+            hashes = _frame_hashes(mount_dir, video_name, frame)
+        publisher.publish(video_name, frame, error=error, stages=stages, **hashes)
+
+    # start listening, messages are completed once the events of their frames
+    # are written
     logger.debug("Start listening to queue '{}' on service bus...".format(queue))
+    receiver = FlushedReceiver(
+        PrefetchingReceiver(
+            ServiceBusTransport(bus_service, queue),
+            prefetch=prefetch,
+            receivers=receivers,
+        ).start(),
+        publisher,
+    )
 
     while True:
 
+        # the profiler is stopped on the thread that started it
+        if profiler is not None and profiler.done:
+            profiler.stop()
+            profiler = None
+
         # inspect queue
         logger.debug("Peek queue...")
-        msg = bus_service.receive_queue_message(queue, peek_lock=True, timeout=30)
+        msgs = _receive_batch(receiver, batch_size, max_batch_wait_ms)
+        msgs = _drop_malformed(msgs, receiver)
+        _observe_queue_wait(msgs)
 
-        if msg.body is None:
-            if terminate:
+        if not msgs:
+            if style_pipeline is not None:
+                style_pipeline.join()
+                logger.debug(
+                    "Pipeline stage timings: {}".format(style_pipeline.timer.summary())
+                )
+
+            # the receiver backs off while the queue stays empty
+            if terminate and receiver.is_empty():
                 logger.debug(
                     "Receiver has timed out, queue is empty. Exiting program..."
                 )
+                receiver.stop()
+                frame_log.close()
+                publisher.close()
+                if profiler is not None:
+                    profiler.stop()
                 exit(0)
             else:
+                logger.debug("Receiver has timed out, queue is empty.")
+                continue
+
+        # compare reduced precision with fp32 output on the first frame
+        if verify_precision:
+            verify_precision = False
+            if not _check_precision(
+                msgs[0], mount_dir, model_dir, device, model_options, psnr_threshold
+            ):
+                model_options = {
+                    "precision": "fp32",
+                    "channels_last": False,
+                    "model_format": model_format,
+                }
+                if cache is not None:
+                    cache.digest = _digest(model_options)
+
+        # skip frames this worker finished or whose output matches the manifest
+        bodies = []
+        for msg in list(msgs):
+            msg_body = _parse_msg(msg, mount_dir)[0]
+            if "frames" not in msg_body and (
+                _is_duplicate(mount_dir, msg_body) or _is_done(mount_dir, msg_body)
+            ):
                 logger.debug(
-                    "Receiver has timed out, queue is empty. Waiting 1 minute before trying again..."
+                    "Frame {} is already done, skipping".format(msg_body["input_frame"])
                 )
-                time.sleep(60)
+                report(msg_body["video_name"], msg_body["input_frame"], skipped=True)
+                receiver.complete(msg)
+                msgs.remove(msg)
                 continue
+            bodies.append(msg_body)
 
-        # get style, input_frame, input_dir & output_dir from msg body
-        msg_body = ast.literal_eval(msg.body.decode("utf-8"))
+            # the orchestrator tracks which frames are being scored
+            for frame in msg_body.get("frames", [msg_body]):
+                publisher.publish(
+                    msg_body["video_name"], frame["input_frame"], status="scoring"
+                )
+        if not msgs:
+            continue
 
-        input_frame = msg_body["input_frame"]
-        video_name = msg_body["video_name"]
-        input_dir = os.path.join(mount_dir, video_name, util.Storage.INPUT_DIR.value)
-        output_dir = os.path.join(mount_dir, video_name, util.Storage.OUTPUT_DIR.value)
-        log_dir = os.path.join(mount_dir, video_name, "logs")
+        # work units carry many frames, each is scored in batches on its own
+        for msg, msg_body in zip(msgs, bodies):
+            if "frames" not in msg_body:
+                continue
+            _process_unit(
+                msg,
+                receiver,
+                report,
+                _model_for(msg_body),
+                device,
+                mount_dir,
+                batch_size,
+                tiling=tiling,
+                cache=None if "model_dirs" in msg_body else cache,
+            )
 
-        # make output dir if not exists
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+        # frames rendered in several styles are batched by their list of styles
+        fan_out_msgs = collections.OrderedDict()
+        for msg, msg_body in zip(msgs, bodies):
+            if "frames" not in msg_body and "model_dirs" in msg_body:
+                fan_out_msgs.setdefault(tuple(msg_body["model_dirs"]), []).append(msg)
+        for model_dirs, style_msgs in fan_out_msgs.items():
+            _process_batch(
+                style_msgs,
+                receiver,
+                report,
+                _model_for({"model_dirs": model_dirs}),
+                device,
+                mount_dir,
+                tiling=tiling,
+            )
+        keep = [
+            i
+            for i, msg_body in enumerate(bodies)
+            if "frames" not in msg_body and "model_dirs" not in msg_body
+        ]
+        msgs = [msgs[i] for i in keep]
+        bodies = [bodies[i] for i in keep]
+
+        # frames in a chunk store are written to output chunks by the batch path
+        chunk_msgs = [msg for msg, body in zip(msgs, bodies) if "input_chunk" in body]
+        if chunk_msgs:
+            style_model = style_transfer.get_style_model(
+                os.path.join(mount_dir, model_dir), device, **model_options
+            )
+            _process_batch(
+                chunk_msgs,
+                receiver,
+                report,
+                style_model,
+                device,
+                mount_dir,
+                tiling=tiling,
+                cache=cache,
+            )
 
-        # make log dir if not exists
-        if not os.path.exists(log_dir):
-            os.makedirs(log_dir)
+        msgs = [msg for msg in msgs if msg not in chunk_msgs]
+        if not msgs:
+            continue
 
-        # create a new file handler for style transfer logs
-        log_file = "{}.log".format(input_frame.split(".")[0])
-        add_file_handler(logger, os.path.join(log_dir, log_file))
+        # hand frames to the pipeline, messages are deleted as frames are written
+        if style_pipeline is not None:
+            style_pipeline.style_model = style_transfer.get_style_model(
+                os.path.join(mount_dir, model_dir), device, **model_options
+            )
+            _submit_to_pipeline(msgs, receiver, report, style_pipeline, mount_dir)
+            continue
+
+        # score all locked messages in as few forward passes as possible
+        if batch_size > 1:
+            style_model = style_transfer.get_style_model(
+                os.path.join(mount_dir, model_dir), device, **model_options
+            )
+            _process_batch(
+                msgs,
+                receiver,
+                report,
+                style_model,
+                device,
+                mount_dir,
+                tiling=tiling,
+                cache=cache,
+            )
+            if cache is not None:
+                logger.debug("Output cache stats: {}".format(cache.stats()))
+            continue
+
+        msg = msgs[0]
+
+        # get style, input_frame, input_dir & output_dir from msg body
+        msg_body, input_dir, output_dir = _parse_msg(msg, mount_dir)
+        video_name = msg_body["video_name"]
+        input_frame = msg_body["input_frame"]
         logger.debug("Queue message body: {}".format(msg_body))
 
+        # make output dir if not exists
+        _ensure_dir(output_dir)
+
         # run style transfer
         logger.debug("Starting style transfer on {}/{}".format(input_dir, input_frame))
-        style_transfer.stylize(
-            content_scale=None,
-            model_dir=os.path.join(mount_dir, model_dir),
-            cuda=1 if torch.cuda.is_available() else 0,
-            content_dir=input_dir,
-            content_filename=input_frame,
-            output_dir=output_dir,
-        )
+        t0 = time.time()
+        try:
+            style_transfer.stylize(
+                content_scale=None,
+                model_dir=os.path.join(mount_dir, model_dir),
+                cuda=1 if device.type == "cuda" else 0,
+                content_dir=input_dir,
+                content_filename=input_frame,
+                output_dir=output_dir,
+                tiling=tiling,
+                cache=cache,
+                **model_options
+            )
+        except Exception as e:
+            logger.exception("Style transfer failed on {}".format(input_frame))
+            report(video_name, input_frame, error=e)
+            receiver.abandon(msg)
+            continue
+        report(video_name, input_frame, stages={"stylize": time.time() - t0})
         logger.debug("Finished style transfer on {}/{}".format(input_dir, input_frame))
+        logger.debug("Model registry stats: {}".format(style_transfer.model_registry.stats()))
+        if cache is not None:
+            logger.debug("Output cache stats: {}".format(cache.stats()))
 
         # delete msg
         logger.debug("Deleting queue message...")
-        msg.delete()
-
-        # pop logger handler
-        logger.handlers.pop()
+        receiver.complete(msg)
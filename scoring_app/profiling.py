@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import logging
+import threading
+import collections
+import torch
+
+
+def _tensor_bytes(output):
+    if isinstance(output, torch.Tensor):
+        return output.element_size() * output.nelement()
+    if isinstance(output, (tuple, list)):
+        return sum(_tensor_bytes(o) for o in output)
+    return 0
+
+
+# labels module ranges in the trace, torch 0.4 has no record_function
+_record_function = getattr(torch.autograd.profiler, "record_function", None)
+
+
+class LayerProfiler:
+    """
+    Times every module of a style model with forward hooks, e.g. the
+    reflection pads, the upsampling convolutions, the InstanceNorm layers and
+    the residual blocks of TransformerNet. Times are inclusive, a block's time
+    contains the time of its layers. On torch versions with record_function,
+    each module is also recorded as a range of the same name in a
+    torch.profiler trace that runs at the same time.
+
+    On cuda the device is synchronised around every module so the times are
+    of the module and not of the kernel launch, which slows the forward pass
+    down; profile a sample of frames, not a whole video.
+
+    Usage:
+        with LayerProfiler(style_model, device) as profiler:
+            style_model(content_images)
+        print(profiler.table())
+    """
+
+    def __init__(self, model, device):
+        """
+        :param model: the style model, TorchScript models have no hooks and are
+            only timed as a whole
+        :param device: cuda or cpu
+        """
+        self.model = model
+        self.cuda = torch.device(device).type == "cuda"
+        self.stats = collections.OrderedDict()
+        self._handles = []
+        self._started = {}
+
+    def _sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def _pre_hook(self, name):
+        def _hook(module, inputs):
+            self._sync()
+            ranges = self._started.setdefault(name, [])
+            record = None
+            if _record_function is not None:
+                record = _record_function(name)
+                record.__enter__()
+            allocated = torch.cuda.memory_allocated() if self.cuda else 0
+            ranges.append((record, allocated, time.perf_counter()))
+
+        return _hook
+
+    def _hook(self, name):
+        def _hook(module, inputs, output):
+            self._sync()
+            record, allocated, t0 = self._started[name].pop()
+            seconds = time.perf_counter() - t0
+            if record is not None:
+                record.__exit__(None, None, None)
+            stats = self.stats[name]
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["output_bytes"] = max(stats["output_bytes"], _tensor_bytes(output))
+            if self.cuda:
+                stats["allocated_bytes"] = max(
+                    stats["allocated_bytes"], torch.cuda.memory_allocated() - allocated
+                )
+
+        return _hook
+
+    def start(self):
+        logger = logging.getLogger("root")
+
+        for name, module in self.model.named_modules():
+            name = name or type(self.model).__name__
+            self.stats[name] = {
+                "module": type(module).__name__,
+                "calls": 0,
+                "seconds": 0.0,
+                "output_bytes": 0,
+                "allocated_bytes": 0,
+            }
+            try:
+                self._handles.append(
+                    module.register_forward_pre_hook(self._pre_hook(name))
+                )
+                self._handles.append(module.register_forward_hook(self._hook(name)))
+            except (AttributeError, RuntimeError):
+                logger.debug("Cannot hook {}, it is not profiled".format(name))
+                del self.stats[name]
+        return self
+
+    def stop(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        self._started.clear()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def summary(self):
+        """
+        returns a list of dicts with the name, module, calls, total and mean
+        seconds, share of the model's time and memory of every module that ran,
+        slowest first
+        """
+        total = max((s["seconds"] for s in self.stats.values()), default=0.0)
+        rows = []
+        for name, stats in self.stats.items():
+            if not stats["calls"]:
+                continue
+            rows.append(
+                dict(
+                    stats,
+                    name=name,
+                    mean_seconds=stats["seconds"] / stats["calls"],
+                    share=stats["seconds"] / total if total else 0.0,
+                )
+            )
+        return sorted(rows, key=lambda row: row["seconds"], reverse=True)
+
+    def table(self):
+        """
+        returns the summary as a text table
+        """
+        lines = [
+            "{:<32} {:<18} {:>6} {:>10} {:>7} {:>10}".format(
+                "module", "type", "calls", "mean ms", "share", "output MB"
+            )
+        ]
+        for row in self.summary():
+            lines.append(
+                "{:<32} {:<18} {:>6} {:>10.3f} {:>6.1%} {:>10.2f}".format(
+                    row["name"][:32],
+                    row["module"][:18],
+                    row["calls"],
+                    row["mean_seconds"] * 1000,
+                    row["share"],
+                    row["output_bytes"] / 2 ** 20,
+                )
+            )
+        return "\n".join(lines)
+
+
+def trace(device):
+    """
+    returns a torch profiler of cpu, and cuda on a cuda device, operators with
+    their shapes and memory, export it with `export_chrome_trace`. Falls back
+    to the autograd profiler of operators only on torch versions without
+    torch.profiler, e.g. the pinned torch 0.4.1.
+    """
+    if hasattr(torch, "profiler"):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.device(device).type == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        return torch.profiler.profile(
+            activities=activities, record_shapes=True, profile_memory=True
+        )
+    return torch.autograd.profiler.profile(
+        use_cuda=torch.device(device).type == "cuda"
+    )
+
+
+class ModelProfiler:
+    """
+    Profiles a style model while it stylizes frames and writes the per-module
+    timings as layers.json and layers.txt, and a Chrome trace as trace.json,
+    to the output dir when it is stopped. Open the trace in chrome://tracing
+    or https://ui.perfetto.dev.
+
+    The profiler has to be stopped on the thread that started it; frames
+    may be counted from any thread.
+
+    Usage:
+        profiler = ModelProfiler(style_model, device, "profiles", max_frames=100)
+        profiler.start()
+        for frame in frames:
+            stylize(frame)
+            profiler.frame_done()
+            if profiler.done:
+                profiler.stop()
+    """
+
+    def __init__(self, model, device, output_dir, chrome_trace=True, max_frames=None):
+        """
+        :param model: the style model
+        :param device: cuda or cpu
+        :param output_dir: the dir to write the results to
+        :param chrome_trace: (optional) also record a torch.profiler trace
+        :param max_frames: (optional) the profiler is done after this many calls
+            to frame_done
+        """
+        self.device = device
+        self.output_dir = output_dir
+        self.max_frames = max_frames
+        self.frames = 0
+        self.layers = LayerProfiler(model, device)
+        self._trace = trace(device) if chrome_trace else None
+        self._running = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.layers.start()
+        if self._trace is not None:
+            self._trace.__enter__()
+        self._running = True
+        return self
+
+    def frame_done(self):
+        """
+        count a stylized frame
+        """
+        with self._lock:
+            self.frames += 1
+
+    @property
+    def done(self):
+        """
+        returns True once max_frames are done
+        """
+        return self.max_frames is not None and self.frames >= self.max_frames
+
+    def stop(self):
+        """
+        stop profiling and write the results, if it is still running
+
+        returns the per-module summary
+        """
+        logger = logging.getLogger("root")
+
+        with self._lock:
+            if not self._running:
+                return self.layers.summary()
+            self._running = False
+        self.layers.stop()
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self._trace is not None:
+            self._trace.__exit__(None, None, None)
+            self._trace.export_chrome_trace(os.path.join(self.output_dir, "trace.json"))
+            self._trace = None
+
+        summary = self.layers.summary()
+        with open(os.path.join(self.output_dir, "layers.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+        table = self.layers.table()
+        with open(os.path.join(self.output_dir, "layers.txt"), "w") as f:
+            f.write(table + "\n")
+        logger.debug("Style model profile:\n{}".format(table))
+        logger.debug("Wrote profile to {}".format(self.output_dir))
+        return summary
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
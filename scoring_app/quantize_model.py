@@ -0,0 +1,150 @@
+import argparse
+import os
+import sys
+import json
+import logging
+import util
+import torch
+import style_transfer
+import precision as precision_mode
+
+
+def _sample_frames(content_dir, num_samples):
+    """
+    :param content_dir: the dir holding the images
+    :param num_samples: the number of frames to pick, evenly spaced over the video
+    """
+    filenames = sorted(f for f in os.listdir(content_dir) if not f.startswith("."))
+    step = max(1, len(filenames) // num_samples)
+    return [os.path.join(content_dir, f) for f in filenames[::step][:num_samples]]
+
+
+def quantize_model(
+    model_dir, content_dir, num_samples=32, content_scale=None, output_file=None
+):
+    """
+    Statically quantize the style model in `model_dir` to int8 for CPU
+    inference. Activation ranges are calibrated on a sample of frames from
+    `content_dir`. The quantized model is saved with TorchScript next to
+    model.pth, together with a report comparing its output to fp32.
+
+    :param model_dir: the dir that contains model.pth
+    :param content_dir: the dir holding the frames to calibrate on, eg. input_frames
+    :param num_samples: (optional) the number of frames to calibrate and report on
+    :param content_scale: (optional) to scale images
+    :param output_file: (optional) the path of the artifact, defaults to model_int8.pt
+
+    returns the quality report
+    """
+    logger = logging.getLogger("root")
+
+    if not hasattr(torch, "ao"):
+        raise ValueError(
+            "quantization requires a newer torch (torch {} installed)".format(
+                torch.__version__
+            )
+        )
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    if output_file is None:
+        output_file = os.path.join(model_dir, style_transfer.MODEL_FILES["quantized"])
+
+    device = torch.device("cpu")
+    samples = _sample_frames(content_dir, num_samples)
+    assert samples, "no frames found in {}".format(content_dir)
+
+    def load(input_file):
+        return style_transfer._load_content(input_file, content_scale).unsqueeze(0)
+
+    # prepare_fx fuses conv/relu pairs where they are adjacent and inserts
+    # observers, the residual adds and instance norms are quantized as well
+    reference_model = style_transfer.load_style_model(model_dir, device)
+    style_model = style_transfer.load_style_model(model_dir, device)
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    prepared = prepare_fx(style_model, qconfig_mapping, (load(samples[0]),))
+
+    logger.debug("Calibrating on {} frames from {}".format(len(samples), content_dir))
+    with torch.no_grad():
+        for sample in samples:
+            prepared(load(sample))
+    quantized = convert_fx(prepared)
+
+    # compare quantized and fp32 output on the calibration frames
+    report = {"engine": torch.backends.quantized.engine, "frames": {}}
+    with torch.no_grad():
+        for sample in samples:
+            content_image = load(sample)
+            report["frames"][os.path.basename(sample)] = precision_mode.psnr(
+                quantized(content_image), reference_model(content_image)
+            )
+        compiled = torch.jit.trace(quantized, load(samples[0]))
+    values = list(report["frames"].values())
+    report["min_psnr"] = min(values)
+    report["mean_psnr"] = sum(values) / len(values)
+    logger.debug(
+        "PSNR of int8 output against fp32: mean {:.2f}dB, min {:.2f}dB".format(
+            report["mean_psnr"], report["min_psnr"]
+        )
+    )
+
+    # write to temporary files so workers never load a partial artifact
+    tmp_file = "{}.tmp".format(output_file)
+    compiled.save(tmp_file)
+    os.replace(tmp_file, output_file)
+    with open(os.path.splitext(output_file)[0] + "_report.json", "w") as f:
+        json.dump(report, f, indent=4, sort_keys=True)
+    logger.debug("Saved quantized model to {}".format(output_file))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="quantize the style model to int8")
+
+    parser.add_argument(
+        "--model-dir",
+        type=str,
+        required=True,
+        help="saved model dir the contains model.pth",
+    )
+    parser.add_argument(
+        "--content-dir",
+        type=str,
+        required=True,
+        help="directory holding the frames to calibrate on",
+    )
+    parser.add_argument(
+        "--num-samples",
+        type=int,
+        default=32,
+        help="(optional) the number of frames to calibrate on",
+    )
+    parser.add_argument(
+        "--content-scale",
+        type=float,
+        default=None,
+        help="factor for scaling down the content image",
+    )
+    parser.add_argument(
+        "--output-file",
+        type=str,
+        default=None,
+        help="(optional) where to save the artifact, defaults to model_int8.pt in the model dir",
+    )
+    args = parser.parse_args()
+
+    # set up logger
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(util.get_handler_format())
+    logger = logging.getLogger("root")
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(console_handler)
+    logger.propagate = False
+
+    quantize_model(
+        model_dir=args.model_dir,
+        content_dir=args.content_dir,
+        num_samples=args.num_samples,
+        content_scale=args.content_scale,
+        output_file=args.output_file,
+    )
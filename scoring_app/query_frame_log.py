@@ -0,0 +1,45 @@
+import argparse
+import os
+import json
+from frame_log import read_records
+
+
+if __name__ == "__main__":
+    """
+    Print the structured log records of a video, optionally only those of
+    one frame or only the failed ones.
+    """
+    parser = argparse.ArgumentParser(description="query the per-frame logs of a video")
+    parser.add_argument(
+        "--storage-mount-dir",
+        dest="storage_mount_dir",
+        help="The value of the storage mount directory",
+        default=os.getenv("MOUNT_DIR", "data"),
+    )
+    parser.add_argument(
+        "--video-name",
+        dest="video_name",
+        required=True,
+        help="The name (not path) of the video (excluding ext).",
+    )
+    parser.add_argument(
+        "--frame",
+        dest="frame",
+        help="(optional) only print the records of this frame, eg. 000001_frame.jpg",
+        default=None,
+    )
+    parser.add_argument(
+        "--errors",
+        dest="errors",
+        action="store_true",
+        help="(optional) only print records of failed frames",
+        default=False,
+    )
+    args = parser.parse_args()
+
+    for record in read_records(args.storage_mount_dir, args.video_name):
+        if args.frame is not None and record["frame"] != args.frame:
+            continue
+        if args.errors and record["error"] is None:
+            continue
+        print(json.dumps(record, sort_keys=True))
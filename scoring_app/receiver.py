@@ -0,0 +1,309 @@
+import time
+import queue
+import random
+import threading
+import logging
+
+
+class Backoff:
+    """
+    Exponential backoff with jitter, used while the queue is empty.
+    """
+
+    def __init__(self, base=1.0, maximum=60.0, factor=2.0, jitter=0.5):
+        """
+        :param base: the first delay in seconds
+        :param maximum: the largest delay in seconds
+        :param factor: the growth factor between consecutive delays
+        :param jitter: the fraction of each delay that is randomised
+        """
+        self.base = base
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempt = 0
+
+    def next(self):
+        """
+        returns the next delay in seconds
+        """
+        delay = min(self.maximum, self.base * self.factor ** self.attempt)
+        self.attempt += 1
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        self.attempt = 0
+
+
+class Transport:
+    """
+    Interface between the receiver and a message broker. Messages returned
+    by `receive` must have a `body` attribute and stay locked until they are
+    completed, abandoned or their lock expires.
+    """
+
+    def receive(self, timeout):
+        """
+        :param timeout: how long to wait for a message, in seconds
+
+        returns a locked message or None if the queue is empty
+        """
+        raise NotImplementedError
+
+    def complete(self, msg):
+        raise NotImplementedError
+
+    def abandon(self, msg):
+        raise NotImplementedError
+
+    def renew_lock(self, msg):
+        raise NotImplementedError
+
+
+class ServiceBusTransport(Transport):
+    """
+    Transport for a queue of the azure ServiceBusService client.
+    """
+
+    def __init__(self, bus_service, queue):
+        """
+        :param bus_service: service bus client
+        :param queue: the name of the queue
+        """
+        self.bus_service = bus_service
+        self.queue = queue
+
+    def receive(self, timeout):
+        msg = self.bus_service.receive_queue_message(
+            self.queue, peek_lock=True, timeout=max(1, int(timeout))
+        )
+        return msg if msg.body is not None else None
+
+    def complete(self, msg):
+        msg.delete()
+
+    def abandon(self, msg):
+        msg.unlock()
+
+    def renew_lock(self, msg):
+        msg.renew_lock()
+
+
+class InMemoryMessage:
+    def __init__(self, body, message_id):
+        self.body = body
+        self.message_id = message_id
+        self.locked_until = None
+        self.delivery_count = 0
+
+
+class InMemoryTransport(Transport):
+    """
+    In-memory stand-in for a Service Bus queue with peek-lock semantics.
+    Messages whose lock expires become visible again.
+    """
+
+    def __init__(self, lock_duration=30.0):
+        """
+        :param lock_duration: how long a received message stays locked, in seconds
+        """
+        self.lock_duration = lock_duration
+        self._messages = []
+        self._next_id = 0
+        self._cond = threading.Condition()
+
+    def send(self, body):
+        """
+        :param body: the message body (bytes)
+        """
+        with self._cond:
+            self._messages.append(InMemoryMessage(body, self._next_id))
+            self._next_id += 1
+            self._cond.notify_all()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._messages)
+
+    def receive(self, timeout):
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                now = time.time()
+                for msg in self._messages:
+                    if msg.locked_until is None or msg.locked_until < now:
+                        msg.locked_until = now + self.lock_duration
+                        msg.delivery_count += 1
+                        return msg
+                if now >= deadline:
+                    return None
+                self._cond.wait(min(deadline - now, 0.1))
+
+    def complete(self, msg):
+        with self._cond:
+            self._messages.remove(msg)
+
+    def abandon(self, msg):
+        with self._cond:
+            msg.locked_until = None
+            self._cond.notify_all()
+
+    def renew_lock(self, msg):
+        with self._cond:
+            msg.locked_until = time.time() + self.lock_duration
+
+
+class PrefetchingReceiver:
+    """
+    Receives messages on background threads into a small buffer of locked
+    messages, so the scoring loop does not wait on a network round trip for
+    each frame. Locks of buffered and in-flight messages are renewed until
+    the message is completed or abandoned. When the queue is empty the
+    receive threads back off exponentially.
+
+    Usage:
+        receiver = PrefetchingReceiver(ServiceBusTransport(bus_service, queue))
+        receiver.start()
+        msg = receiver.get(timeout=30)
+        ...
+        receiver.complete(msg)
+    """
+
+    def __init__(
+        self,
+        transport,
+        prefetch=2,
+        receivers=1,
+        receive_timeout=30,
+        lock_renewal_interval=20.0,
+        backoff=None,
+    ):
+        """
+        :param transport: the Transport to receive messages from
+        :param prefetch: the number of locked messages to keep buffered
+        :param receivers: the number of threads receiving concurrently
+        :param receive_timeout: the timeout of each receive call, in seconds
+        :param lock_renewal_interval: how often locks are renewed, in seconds
+        :param backoff: (optional) the Backoff to use while the queue is empty
+        """
+        assert prefetch > 0
+        self.transport = transport
+        self.receivers = receivers
+        self.receive_timeout = receive_timeout
+        self.lock_renewal_interval = lock_renewal_interval
+        self.backoff = backoff or Backoff()
+
+        self._buffer = queue.Queue(maxsize=prefetch)
+        self._locked = {}
+        self._locked_lock = threading.Lock()
+        self._backoff_lock = threading.Lock()
+        self._empty = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.receivers):
+            thread = threading.Thread(target=self._receive_loop, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._renew_loop, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return self
+
+    def stop(self):
+        """
+        Stop receiving and release every message that was not handed out yet.
+        """
+        self._stop.set()
+        while True:
+            try:
+                msg = self._buffer.get_nowait()
+            except queue.Empty:
+                break
+            self.abandon(msg)
+
+    def get(self, timeout=None):
+        """
+        :param timeout: (optional) how long to wait for a message, in seconds
+
+        returns a locked message or None if none arrived in time
+        """
+        try:
+            return self._buffer.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def is_empty(self):
+        """
+        returns True if the last receive found the queue empty and no
+        messages are buffered
+        """
+        return self._empty.is_set() and self._buffer.empty()
+
+    def complete(self, msg):
+        self._release(msg)
+        self.transport.complete(msg)
+
+    def abandon(self, msg):
+        self._release(msg)
+        self.transport.abandon(msg)
+
+    def _release(self, msg):
+        with self._locked_lock:
+            self._locked.pop(id(msg), None)
+
+    def _receive_loop(self):
+        logger = logging.getLogger("root")
+
+        while not self._stop.is_set():
+            try:
+                msg = self.transport.receive(self.receive_timeout)
+            except Exception:
+                logger.exception("Failed to receive from queue")
+                msg = None
+
+            if msg is None:
+                self._empty.set()
+                with self._backoff_lock:
+                    delay = self.backoff.next()
+                logger.debug("Queue is empty, backing off {:.1f} seconds".format(delay))
+                self._stop.wait(delay)
+                continue
+
+            self._empty.clear()
+            with self._backoff_lock:
+                self.backoff.reset()
+            with self._locked_lock:
+                self._locked[id(msg)] = (msg, time.time())
+
+            # blocks while the buffer is full, the lock keeps being renewed
+            while not self._stop.is_set():
+                try:
+                    self._buffer.put(msg, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+            else:
+                self.abandon(msg)
+
+    def _renew_loop(self):
+        logger = logging.getLogger("root")
+
+        while not self._stop.wait(1):
+            now = time.time()
+            with self._locked_lock:
+                due = [
+                    msg
+                    for msg, renewed in self._locked.values()
+                    if now - renewed >= self.lock_renewal_interval
+                ]
+            for msg in due:
+                try:
+                    self.transport.renew_lock(msg)
+                except Exception:
+                    logger.exception("Failed to renew message lock")
+                    continue
+                with self._locked_lock:
+                    if id(msg) in self._locked:
+                        self._locked[id(msg)] = (msg, time.time())
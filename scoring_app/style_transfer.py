@@ -1,18 +1,29 @@
 # Original source: https://github.com/pytorch/examples/blob/master/fast_neural_style/neural_style/neural_style.py
 import argparse
+import collections
 import os
 import time
 import sys
 import re
 import logging
 import util
+from model_registry import ModelRegistry
+import precision as precision_mode
+import tiling as tiling_mode
+import profiling
+import image_convert
+import frame_store
 from PIL import Image
+import numpy as np
 import torch
 from torchvision import transforms
 
 
 def load_image(filename, size=None, scale=None):
-    img = Image.open(filename)
+    if isinstance(filename, frame_store.ChunkFrame):
+        img = Image.fromarray(frame_store.read_frame(*filename))
+    else:
+        img = image_convert.read_image(filename)
     if size is not None:
         img = img.resize((size, size), Image.ANTIALIAS)
     elif scale is not None:
@@ -25,8 +36,10 @@ def load_image(filename, size=None, scale=None):
 def save_image(filename, data):
     img = data.clone().clamp(0, 255).numpy()
     img = img.transpose(1, 2, 0).astype("uint8")
-    img = Image.fromarray(img)
-    img.save(filename)
+    if isinstance(filename, frame_store.ChunkTarget):
+        filename.writer.append(filename.frame, img)
+        return
+    image_convert.write_image(filename, Image.fromarray(img))
 
 
 class TransformerNet(torch.nn.Module):
@@ -131,7 +144,38 @@ class UpsampleConvLayer(torch.nn.Module):
         return out
 
 
-def _stylize(content_scale, style_model, device, input_file, output_file, output_dir):
+def run_style_model(style_model, content_images, device, tiling=None):
+    """
+    :param style_model: the style model
+    :param content_images: NCHW tensor on the cpu
+    :param device: cuda or cpu
+    :param tiling: (optional) dict of tile_size, overlap and global_stats, frames
+        larger than tile_size are stylized tile by tile
+
+    returns the NCHW output on the cpu
+    """
+    if tiling is not None and max(content_images.shape[2:]) > tiling["tile_size"]:
+        return torch.cat(
+            [
+                tiling_mode.stylize_tiled(
+                    style_model, content_image.unsqueeze(0), device, **tiling
+                )
+                for content_image in content_images
+            ]
+        )
+    return style_model(content_images.to(device)).cpu()
+
+
+def _stylize(
+    content_scale,
+    style_model,
+    device,
+    input_file,
+    output_file,
+    output_dir,
+    tiling=None,
+    cache=None,
+):
     """
     :param content_scale: to scale image
     :param style_model: the style model
@@ -139,25 +183,394 @@ def _stylize(content_scale, style_model, device, input_file, output_file, output
     :param path: full path of image to process
     :param filename: the name of the file to output
     :param output_dir: the name of the dir to save processed output files
+    :param tiling: (optional) dict of tile_size, overlap and global_stats
+    :param cache: (optional) the OutputCache to look the output up in
     """
     logger = logging.getLogger("root")
 
     logger.debug("Processing {}".format(input_file))
-    content_image = load_image(input_file, scale=content_scale)
+    converter = image_convert.get_converter(device)
+    content_image = converter.decode(input_file, content_scale)
+    output_path = os.path.join(output_dir, output_file)
+
+    if cache is not None:
+        key = cache.key(converter.pixels)
+        if cache.fetch(key, output_path):
+            logger.debug("Output of {} found in the cache".format(input_file))
+            return
+        _unlink(output_path)
+
+    if tiling is not None:
+        output = run_style_model(style_model, content_image, device, tiling=tiling)
+    else:
+        output = style_model(content_image.to(device, non_blocking=True))
+
+    converter.encode(output_path, output[0])
+    if cache is not None:
+        cache.put(key, output_path)
+
+
+def _unlink(output_file):
+    """
+    outputs may be hardlinks to cache entries, never write through them
+    """
+    try:
+        os.remove(output_file)
+    except FileNotFoundError:
+        pass
+
+
+def _load_content(input_file, content_scale):
+    """
+    :param input_file: full path of image to load
+    :param content_scale: to scale image
+
+    returns the image as a CHW float tensor in the range [0, 255]
+    """
+    return _to_content(load_image(input_file, scale=content_scale))
+
+
+def _to_content(content_image):
+    """
+    returns the PIL image as a CHW float tensor in the range [0, 255]
+    """
     content_transform = transforms.Compose(
         [transforms.ToTensor(), transforms.Lambda(lambda x: x.mul(255))]
     )
-    content_image = content_transform(content_image)
-    content_image = content_image.unsqueeze(0).to(device)
+    return content_transform(content_image)
 
-    output = style_model(content_image).cpu()
 
-    output_path = os.path.join(output_dir, output_file)
-    save_image(output_path, output[0])
+def stylize_batch(
+    content_scale, style_model, device, frames, on_saved=None, tiling=None, cache=None
+):
+    """
+    Stylize several frames with as few forward passes as possible. Frames
+    of the same resolution are stacked into a single NCHW batch.
+
+    :param content_scale: to scale image
+    :param style_model: the style model
+    :param device: cuda or cpu
+    :param frames: list of (input_file, output_file) tuples, both full paths or
+        a frame_store.ChunkFrame and ChunkTarget
+    :param on_saved: (optional) callable(index) called once frames[index] is written
+    :param tiling: (optional) dict of tile_size, overlap and global_stats
+    :param cache: (optional) the OutputCache to look outputs written to files up in
+    """
+    logger = logging.getLogger("root")
+
+    # group frames by resolution, keeping the order they arrived in
+    groups = collections.OrderedDict()
+    keys = {}
+    for i, (input_file, output_file) in enumerate(frames):
+        img = load_image(input_file, scale=content_scale)
+        if cache is not None and not isinstance(output_file, frame_store.ChunkTarget):
+            keys[i] = cache.key(np.asarray(img.convert("RGB")))
+            if cache.fetch(keys[i], output_file):
+                logger.debug("Output of {} found in the cache".format(input_file))
+                if on_saved is not None:
+                    on_saved(i)
+                continue
+            _unlink(output_file)
+        content_image = _to_content(img)
+        groups.setdefault(tuple(content_image.shape), []).append((i, content_image))
+
+    with torch.no_grad():
+        for shape, items in groups.items():
+            logger.debug(
+                "Processing batch of {} frames with shape {}".format(len(items), shape)
+            )
+            batch = torch.stack([content_image for _, content_image in items])
+            output = run_style_model(style_model, batch, device, tiling=tiling)
+
+            for (i, _), output_image in zip(items, output):
+                save_image(frames[i][1], output_image)
+                if i in keys:
+                    cache.put(keys[i], frames[i][1])
+                if on_saved is not None:
+                    on_saved(i)
+
+
+def stylize_styles(
+    content_scale, style_models, device, frames, on_saved=None, tiling=None
+):
+    """
+    Stylize several frames with several style models. Each frame is decoded
+    once and each batch is moved to the device once, every model then runs
+    on the same input tensor.
+
+    :param content_scale: to scale image
+    :param style_models: list of style models
+    :param device: cuda or cpu
+    :param frames: list of (input_file, output_files) tuples, with one output
+        file (or frame_store.ChunkTarget) per style model
+    :param on_saved: (optional) callable(index) called once every output of
+        frames[index] is written
+    :param tiling: (optional) dict of tile_size, overlap and global_stats
+    """
+    logger = logging.getLogger("root")
+
+    # group frames by resolution, keeping the order they arrived in
+    groups = collections.OrderedDict()
+    for i, (input_file, _) in enumerate(frames):
+        content_image = _load_content(input_file, content_scale)
+        groups.setdefault(tuple(content_image.shape), []).append((i, content_image))
+
+    with torch.no_grad():
+        for shape, items in groups.items():
+            logger.debug(
+                "Processing batch of {} frames with shape {} in {} styles".format(
+                    len(items), shape, len(style_models)
+                )
+            )
+            batch = torch.stack([content_image for _, content_image in items])
+
+            # tiles are moved to the device one at a time
+            if tiling is None:
+                batch = batch.to(device, non_blocking=True)
+
+            for style, style_model in enumerate(style_models):
+                output = run_style_model(style_model, batch, device, tiling=tiling)
+                for (i, _), output_image in zip(items, output):
+                    output_file = frames[i][1][style]
+                    if not isinstance(output_file, frame_store.ChunkTarget):
+                        _unlink(output_file)
+                    save_image(output_file, output_image)
+
+            if on_saved is not None:
+                for i, _ in items:
+                    on_saved(i)
+
+
+# the file in the model dir that each model format is loaded from
+MODEL_FILES = {
+    "eager": "model.pth",
+    "torchscript": "model.pt",
+    "quantized": "model_int8.pt",
+}
+
+
+def can_load_torchscript():
+    """
+    returns whether this torch can save and load TorchScript models, torch
+    0.4 has neither torch.jit.load nor ScriptModule.save
+    """
+    script_module = getattr(torch.jit, "ScriptModule", None)
+    return hasattr(torch.jit, "load") and hasattr(script_module, "save")
+
+
+def load_style_model(
+    model_dir, device, precision="fp32", channels_last=False, model_format="eager"
+):
+    """
+    :param model_dir: the dir that contains model.pth
+    :param device: cuda or cpu
+    :param precision: (optional) one of fp32, bf16 or fp16
+    :param channels_last: (optional) run the model in the channels_last memory format
+    :param model_format: (optional) one of MODEL_FILES, torchscript loads the
+        artifact written by export_model.py and quantized the one written by
+        quantize_model.py, both need a torch that can load TorchScript
+    """
+    precision_mode.check_supported(precision, channels_last, device)
+    if model_format in ("torchscript", "quantized") and not can_load_torchscript():
+        raise ValueError(
+            "model format '{}' requires torch.jit.load (torch {} installed)".format(
+                model_format, torch.__version__
+            )
+        )
+    if model_format == "quantized" and torch.device(device).type != "cpu":
+        raise ValueError("the quantized model only runs on cpu")
+
+    if model_format in ("torchscript", "quantized"):
+        style_model = torch.jit.load(
+            os.path.join(model_dir, MODEL_FILES[model_format]), map_location=device
+        )
+    else:
+        style_model = _load_eager_model(model_dir, device)
+
+    if precision != "fp32" or channels_last:
+        style_model = precision_mode.InferenceModel(
+            style_model, precision=precision, channels_last=channels_last
+        )
+    return style_model
+
+
+def _load_eager_model(model_dir, device):
+    """
+    :param model_dir: the dir that contains model.pth
+    :param device: cuda or cpu
+    """
+    with torch.no_grad():
+        style_model = TransformerNet()
+        state_dict = torch.load(
+            os.path.join(model_dir, "model.pth"),
+            map_location=lambda storage, loc: storage,
+        )
+        for k in list(state_dict.keys()):
+            if re.search(r"in\d+\.running_(mean|var)$", k):
+                del state_dict[k]
+        style_model.load_state_dict(state_dict)
+        style_model.to(device)
+        style_model.eval()
+    return style_model
+
+
+# models loaded by this process, shared across calls to `stylize`
+model_registry = ModelRegistry(
+    lambda model_dir, device, **options: load_style_model(
+        model_dir, torch.device(device), **options
+    ),
+    model_file=lambda model_format="eager", **options: MODEL_FILES[model_format],
+)
+
 
+def get_style_model(
+    model_dir, device, precision="fp32", channels_last=False, model_format="eager"
+):
+    """
+    :param model_dir: the dir that contains model.pth
+    :param device: cuda or cpu
+    :param precision: (optional) one of fp32, bf16 or fp16
+    :param channels_last: (optional) run the model in the channels_last memory format
+    :param model_format: (optional) one of MODEL_FILES
+    """
+    return model_registry.get(
+        model_dir,
+        device=str(device),
+        precision=precision,
+        channels_last=channels_last,
+        model_format=model_format,
+    )
+
+
+def warm_up(
+    model_dir,
+    device,
+    size=256,
+    precision="fp32",
+    channels_last=False,
+    model_format="eager",
+):
+    """
+    Load the style model into the registry and run a single forward pass
+    so the first frame does not pay for loading or lazy initialisation.
+
+    :param model_dir: the dir that contains model.pth
+    :param device: cuda or cpu
+    :param size: the height and width of the dummy input image
+    :param precision: (optional) one of fp32, bf16 or fp16
+    :param channels_last: (optional) run the model in the channels_last memory format
+    :param model_format: (optional) one of MODEL_FILES
+    """
+
+    def _run(style_model):
+        with torch.no_grad():
+            style_model(torch.zeros(1, 3, size, size, device=device))
+
+    return model_registry.warm_up(
+        model_dir,
+        warm_up_fn=_run,
+        device=str(device),
+        precision=precision,
+        channels_last=channels_last,
+        model_format=model_format,
+    )
+
+
+def check_precision(
+    model_dir,
+    device,
+    input_files,
+    precision,
+    channels_last=False,
+    model_format="eager",
+    content_scale=None,
+):
+    """
+    Compare the output of a reduced precision and/or channels_last model
+    with the fp32 model on a few sample frames.
 
-def stylize(content_scale, content_filename, model_dir, cuda, content_dir, output_dir):
+    :param model_dir: the dir that contains model.pth
+    :param device: cuda or cpu
+    :param input_files: full paths of the sample frames
+    :param precision: one of fp32, bf16 or fp16
+    :param channels_last: (optional) run the model in the channels_last memory format
+    :param model_format: (optional) one of MODEL_FILES
+    :param content_scale: (optional) to scale images
 
+    returns the lowest PSNR in dB over the sample frames
+    """
+    reference_model = get_style_model(model_dir, device)
+    style_model = get_style_model(
+        model_dir,
+        device,
+        precision=precision,
+        channels_last=channels_last,
+        model_format=model_format,
+    )
+
+    lowest = float("inf")
+    with torch.no_grad():
+        for input_file in input_files:
+            content_image = _load_content(input_file, content_scale).unsqueeze(0)
+            content_image = content_image.to(device)
+            lowest = min(
+                lowest,
+                precision_mode.psnr(
+                    style_model(content_image).cpu(), reference_model(content_image).cpu()
+                ),
+            )
+    return lowest
+
+
+def stylize(
+    content_scale,
+    content_filename,
+    model_dir,
+    cuda,
+    content_dir,
+    output_dir,
+    pipeline_depth=0,
+    batch_size=1,
+    loader_workers=0,
+    writer_workers=1,
+    skip_existing=False,
+    precision="fp32",
+    channels_last=False,
+    psnr_threshold=None,
+    model_format="eager",
+    tiling=None,
+    cache=None,
+    profile_dir=None,
+):
+    """
+    :param content_scale: to scale image
+    :param content_filename: (optional) if set, only process this image
+    :param model_dir: the dir that contains model.pth
+    :param cuda: 1 to run on GPU, 0 for CPU
+    :param content_dir: the dir holding the input images
+    :param output_dir: the dir to save processed output files
+    :param pipeline_depth: (optional) if > 0, overlap decode, inference and
+        encode of a directory with this many frames buffered between stages
+    :param batch_size: (optional) the maximum number of frames per forward pass
+        when processing a directory
+    :param loader_workers: (optional) the number of processes decoding frames
+        when processing a directory
+    :param writer_workers: (optional) the number of threads writing frames
+        when processing a directory
+    :param skip_existing: (optional) skip frames that already exist in output_dir
+        when processing a directory
+    :param precision: (optional) one of fp32, bf16 or fp16
+    :param channels_last: (optional) run the model in the channels_last memory format
+    :param psnr_threshold: (optional) if set, compare the first frame against fp32
+        output and raise a ValueError if the PSNR in dB is below this value
+    :param model_format: (optional) eager, torchscript to load the artifact
+        written by export_model.py or quantized for the one from quantize_model.py
+    :param tiling: (optional) dict of tile_size, overlap and global_stats, frames
+        larger than tile_size are stylized tile by tile with bounded memory
+    :param cache: (optional) the OutputCache to look the output of a single image up in
+    :param profile_dir: (optional) profile the modules of the style model and write
+        the per-module timings and a Chrome trace to this dir
+    """
     logger = logging.getLogger("root")
 
     # check that all the paths and image references are good
@@ -168,14 +581,42 @@ def stylize(content_scale, content_filename, model_dir, cuda, content_dir, outpu
         assert os.path.exists(os.path.join(content_dir, content_filename))
 
     device = torch.device("cuda" if cuda else "cpu")
+
+    # make sure reduced precision output stays close to the fp32 output
+    if psnr_threshold is not None and (precision != "fp32" or channels_last):
+        sample = content_filename or min(
+            f for f in os.listdir(content_dir) if not f.startswith(".")
+        )
+        lowest = check_precision(
+            model_dir,
+            device,
+            [os.path.join(content_dir, sample)],
+            precision,
+            channels_last=channels_last,
+            model_format=model_format,
+            content_scale=content_scale,
+        )
+        logger.debug("PSNR of {} output against fp32: {:.2f}dB".format(precision, lowest))
+        if lowest < psnr_threshold:
+            raise ValueError(
+                "PSNR of {} output {:.2f}dB is below the threshold of {:.2f}dB".format(
+                    precision, lowest, psnr_threshold
+                )
+            )
+
     with torch.no_grad():
-        style_model = TransformerNet()
-        state_dict = torch.load(os.path.join(model_dir, "model.pth"))
-        for k in list(state_dict.keys()):
-            if re.search(r"in\d+\.running_(mean|var)$", k):
-                del state_dict[k]
-        style_model.load_state_dict(state_dict)
-        style_model.to(device)
+        style_model = get_style_model(
+            model_dir,
+            device,
+            precision=precision,
+            channels_last=channels_last,
+            model_format=model_format,
+        )
+
+        profiler = None
+        if profile_dir is not None:
+            profiler = profiling.ModelProfiler(style_model, device, profile_dir)
+            profiler.start()
 
         # if applying style transfer to only one image
         if content_filename:
@@ -187,16 +628,48 @@ def stylize(content_scale, content_filename, model_dir, cuda, content_dir, outpu
                 full_path,
                 content_filename,
                 output_dir,
+                tiling=tiling,
+                cache=cache,
             )
 
+        # if applying style transfer to all images in directory, pipelined
+        elif pipeline_depth > 0:
+            from pipeline import StylePipeline
+
+            filenames = os.listdir(content_dir)
+            with StylePipeline(
+                style_model,
+                device,
+                content_scale=content_scale,
+                depth=pipeline_depth,
+                tiling=tiling,
+            ) as style_pipeline:
+                for filename in filenames:
+                    style_pipeline.submit(
+                        os.path.join(content_dir, filename),
+                        os.path.join(output_dir, filename),
+                    )
+            logger.debug("Pipeline stage timings: {}".format(style_pipeline.timer.summary()))
+
         # if applying style transfer to all images in directory
         else:
-            filenames = os.listdir(content_dir)
-            for filename in filenames:
-                full_path = os.path.join(content_dir, filename)
-                _stylize(
-                    content_scale, style_model, device, full_path, filename, output_dir
-                )
+            from stylize_directory import stylize_directory
+
+            stylize_directory(
+                style_model,
+                device,
+                content_dir,
+                output_dir,
+                content_scale=content_scale,
+                batch_size=batch_size,
+                loader_workers=loader_workers,
+                writer_workers=writer_workers,
+                skip_existing=skip_existing,
+                tiling=tiling,
+            )
+
+        if profiler is not None:
+            profiler.stop()
 
 
 if __name__ == "__main__":
@@ -234,6 +707,81 @@ if __name__ == "__main__":
         required=True,
         help="directory holding the output images",
     )
+    parser.add_argument(
+        "--pipeline-depth",
+        type=int,
+        default=0,
+        help="(optional) overlap decode, inference and encode with this many frames buffered between stages",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=4,
+        help="(optional) the maximum number of same-sized frames per forward pass",
+    )
+    parser.add_argument(
+        "--loader-workers",
+        type=int,
+        default=2,
+        help="(optional) the number of processes decoding frames",
+    )
+    parser.add_argument(
+        "--writer-workers",
+        type=int,
+        default=2,
+        help="(optional) the number of threads writing output frames",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="(optional) reprocess frames that already exist in the output directory",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=precision_mode.PRECISIONS,
+        default="fp32",
+        help="(optional) the precision to run the model in, bf16 uses autocast on CPU",
+    )
+    parser.add_argument(
+        "--channels-last",
+        action="store_true",
+        help="(optional) run the model in the channels_last memory format",
+    )
+    parser.add_argument(
+        "--psnr-threshold",
+        type=float,
+        default=40.0,
+        help="(optional) the lowest PSNR in dB against fp32 output that is accepted",
+    )
+    parser.add_argument(
+        "--model-format",
+        choices=sorted(MODEL_FILES),
+        default="eager",
+        help="(optional) eager loads model.pth, torchscript and quantized load the artifacts from export_model.py and quantize_model.py",
+    )
+    parser.add_argument(
+        "--tile-size",
+        type=int,
+        default=None,
+        help="(optional) stylize frames larger than this tile by tile to bound memory",
+    )
+    parser.add_argument(
+        "--tile-overlap",
+        type=int,
+        default=32,
+        help="(optional) the overlap in pixels blended between neighbouring tiles",
+    )
+    parser.add_argument(
+        "--tile-global-stats",
+        action="store_true",
+        help="(optional) normalise all tiles with statistics of the whole frame",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        type=str,
+        default=None,
+        help="(optional) write per-module timings and a Chrome trace of the model to this dir",
+    )
     args = parser.parse_args()
 
     if args.cuda and not torch.cuda.is_available():
@@ -256,4 +804,17 @@ if __name__ == "__main__":
         content_dir=args.content_dir,
         content_filename=args.content_filename,
         output_dir=args.output_dir,
+        pipeline_depth=args.pipeline_depth,
+        batch_size=args.batch_size,
+        loader_workers=args.loader_workers,
+        writer_workers=args.writer_workers,
+        skip_existing=not args.overwrite,
+        precision=args.precision,
+        channels_last=args.channels_last,
+        psnr_threshold=args.psnr_threshold,
+        model_format=args.model_format,
+        tiling=util.tiling_options(
+            args.tile_size, args.tile_overlap, args.tile_global_stats
+        ),
+        profile_dir=args.profile_dir,
     )
@@ -0,0 +1,148 @@
+import os
+import time
+import logging
+import torch
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from torch.utils.data import Dataset, DataLoader
+import style_transfer
+
+
+class FrameDataset(Dataset):
+    """
+    Dataset over the image files of a directory. Each item is a tuple of
+    (filename, CHW float tensor in the range [0, 255]).
+    """
+
+    def __init__(self, content_dir, filenames, content_scale=None):
+        """
+        :param content_dir: the dir holding the images
+        :param filenames: the names of the images in content_dir to load
+        :param content_scale: (optional) to scale images
+        """
+        self.content_dir = content_dir
+        self.filenames = filenames
+        self.content_scale = content_scale
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, index):
+        filename = self.filenames[index]
+        content_image = style_transfer._load_content(
+            os.path.join(self.content_dir, filename), self.content_scale
+        )
+        return filename, content_image
+
+
+def _unwrap(items):
+    """
+    collate_fn for a DataLoader with batch_size=1, batching is done by
+    `_batches` so that only frames of the same size are stacked together
+    """
+    return items[0]
+
+
+def _batches(loader, batch_size):
+    """
+    Group consecutive frames of the same size into batches of up to `batch_size`.
+
+    :param loader: iterable of (filename, content_image)
+    :param batch_size: the maximum number of frames in a batch
+    """
+    batch = []
+    for filename, content_image in loader:
+        if batch and (
+            len(batch) == batch_size or batch[0][1].shape != content_image.shape
+        ):
+            yield batch
+            batch = []
+        batch.append((filename, content_image))
+    if batch:
+        yield batch
+
+
+def _write(output_dir, filename, output_image):
+    """
+    Write to a temporary file first so that an interrupted run never leaves
+    a partial frame behind that a resumed run would then skip.
+    """
+    tmp_path = os.path.join(output_dir, ".{}".format(filename))
+    style_transfer.save_image(tmp_path, output_image)
+    os.replace(tmp_path, os.path.join(output_dir, filename))
+
+
+def stylize_directory(
+    style_model,
+    device,
+    content_dir,
+    output_dir,
+    content_scale=None,
+    batch_size=4,
+    loader_workers=2,
+    writer_workers=2,
+    skip_existing=True,
+    tiling=None,
+):
+    """
+    Stylize every image in `content_dir`. Frames are decoded by DataLoader
+    worker processes, frames of the same size are run through the model in
+    batches, and outputs are written asynchronously by a thread pool.
+
+    :param style_model: the style model
+    :param device: cuda or cpu
+    :param content_dir: the dir holding the images
+    :param output_dir: the dir to save processed output files
+    :param content_scale: (optional) to scale images
+    :param batch_size: (optional) the maximum number of frames per forward pass
+    :param loader_workers: (optional) the number of processes decoding frames
+    :param writer_workers: (optional) the number of threads writing frames
+    :param skip_existing: (optional) skip frames that already exist in output_dir
+    :param tiling: (optional) dict of tile_size, overlap and global_stats
+
+    returns the number of frames processed
+    """
+    logger = logging.getLogger("root")
+
+    filenames = sorted(f for f in os.listdir(content_dir) if not f.startswith("."))
+    if skip_existing:
+        existing = set(os.listdir(output_dir))
+        skipped = len([f for f in filenames if f in existing])
+        filenames = [f for f in filenames if f not in existing]
+        logger.debug("Skipping {} frames that already exist".format(skipped))
+
+    loader = DataLoader(
+        FrameDataset(content_dir, filenames, content_scale),
+        batch_size=1,
+        num_workers=loader_workers,
+        collate_fn=_unwrap,
+        pin_memory=device.type == "cuda",
+    )
+
+    t0 = time.time()
+    pending = set()
+    with ThreadPoolExecutor(max_workers=writer_workers) as writers:
+        with torch.no_grad():
+            for batch in _batches(loader, batch_size):
+                content_images = torch.stack([image for _, image in batch])
+                output = style_transfer.run_style_model(
+                    style_model, content_images, device, tiling=tiling
+                )
+
+                # bound the number of frames waiting to be written
+                while len(pending) >= 2 * writer_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+
+                for (filename, _), output_image in zip(batch, output):
+                    pending.add(
+                        writers.submit(_write, output_dir, filename, output_image)
+                    )
+
+        for future in pending:
+            future.result()
+
+    logger.debug(
+        "Processed {} frames in {:.2f} seconds".format(len(filenames), time.time() - t0)
+    )
+    return len(filenames)
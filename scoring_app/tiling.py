@@ -0,0 +1,143 @@
+import contextlib
+import torch
+
+
+def _starts(length, tile_size, overlap):
+    """
+    returns the start offsets of tiles of `tile_size` covering `length`, with
+    neighbouring tiles overlapping by at least `overlap`
+    """
+    if length <= tile_size:
+        return [0]
+    step = tile_size - overlap
+    starts = list(range(0, length - tile_size, step))
+    starts.append(length - tile_size)
+    return starts
+
+
+def _ramp(length, overlap, feather_start, feather_end):
+    """
+    1D blending weights for a tile, ramping up and down linearly over the
+    overlap on the sides that border another tile.
+    """
+    weights = torch.ones(length)
+    ramp = torch.arange(1, overlap + 1, dtype=torch.float32) / (overlap + 1)
+    if feather_start and overlap > 0:
+        weights[:overlap] = ramp
+    if feather_end and overlap > 0:
+        weights[-overlap:] = torch.flip(ramp, [0])
+    return weights
+
+
+def _instance_norms(style_model):
+    norms = [
+        m for m in style_model.modules() if isinstance(m, torch.nn.InstanceNorm2d)
+    ]
+    if not norms:
+        raise ValueError("global statistics need an eager model with InstanceNorm2d")
+    return norms
+
+
+@contextlib.contextmanager
+def global_instance_norm(style_model, content_image):
+    """
+    Run the style model once on `content_image` (usually a downscaled copy
+    of the whole frame), record the mean and variance every InstanceNorm2d
+    layer sees, and normalise with those statistics instead of per-tile ones
+    while the context is active. This keeps the colour and contrast of each
+    tile consistent with the rest of the frame.
+
+    :param style_model: the eager style model
+    :param content_image: 1xCxHxW tensor on the model's device
+    """
+    norms = _instance_norms(style_model)
+    stats = {}
+
+    def _record(module, inputs):
+        # torch 0.4 reduces over a single dim only
+        n, c = inputs[0].shape[:2]
+        x = inputs[0].contiguous().view(n, c, -1)
+        stats[module] = (
+            x.mean(dim=2).view(n, c, 1, 1),
+            x.var(dim=2, unbiased=False).view(n, c, 1, 1),
+        )
+
+    handles = [m.register_forward_pre_hook(_record) for m in norms]
+    try:
+        with torch.no_grad():
+            style_model(content_image)
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    def _fixed_forward(module):
+        mean, var = stats[module]
+
+        def forward(x):
+            y = (x - mean) / torch.sqrt(var + module.eps)
+            if module.affine:
+                y = y * module.weight.view(1, -1, 1, 1) + module.bias.view(1, -1, 1, 1)
+            return y
+
+        return forward
+
+    for m in norms:
+        m.forward = _fixed_forward(m)
+    try:
+        yield
+    finally:
+        for m in norms:
+            del m.forward
+
+
+def stylize_tiled(
+    style_model, content_image, device, tile_size=512, overlap=32, global_stats=False
+):
+    """
+    Stylize a frame tile by tile so that the memory used by activations
+    depends only on `tile_size`, not on the size of the frame. Overlapping
+    tiles are blended with linear feathering to hide seams.
+
+    :param style_model: the style model
+    :param content_image: 1xCxHxW tensor on the cpu
+    :param device: cuda or cpu
+    :param tile_size: (optional) the height and width of the tiles
+    :param overlap: (optional) the overlap between neighbouring tiles in pixels
+    :param global_stats: (optional) normalise every tile with InstanceNorm
+        statistics from a downscaled copy of the whole frame
+
+    returns the 1xCxHxW output on the cpu
+    """
+    assert 0 <= overlap < tile_size
+    _, _, height, width = content_image.shape
+    output = torch.zeros(1, 3, height, width)
+    total_weight = torch.zeros(1, 1, height, width)
+
+    context = contextlib.suppress()
+    if global_stats:
+        scale = min(1.0, float(tile_size) / max(height, width))
+        thumbnail = torch.nn.functional.interpolate(
+            content_image, scale_factor=scale, mode="bilinear", align_corners=False
+        )
+        context = global_instance_norm(style_model, thumbnail.to(device))
+
+    ys = _starts(height, tile_size, overlap)
+    xs = _starts(width, tile_size, overlap)
+    with context, torch.no_grad():
+        for i, y in enumerate(ys):
+            for j, x in enumerate(xs):
+                tile = content_image[:, :, y : y + tile_size, x : x + tile_size]
+                tile_height, tile_width = tile.shape[2], tile.shape[3]
+
+                # the network may round odd sizes up, crop back to the tile
+                out = style_model(tile.to(device)).cpu()
+                out = out[:, :, :tile_height, :tile_width]
+
+                weight = torch.ger(
+                    _ramp(tile_height, overlap, i > 0, i < len(ys) - 1),
+                    _ramp(tile_width, overlap, j > 0, j < len(xs) - 1),
+                ).view(1, 1, tile_height, tile_width)
+                output[:, :, y : y + tile_height, x : x + tile_width] += out * weight
+                total_weight[:, :, y : y + tile_height, x : x + tile_width] += weight
+
+    return output / total_weight
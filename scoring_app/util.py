@@ -1,12 +1,66 @@
 import logging
+import os
 from enum import Enum
 
 class Storage(Enum):
     AUDIO_FILE = "audio.aac"
     INPUT_DIR = "input_frames"
     OUTPUT_DIR = "output_frames"
+    EVENTS_DIR = "events"
+    CHECKPOINT_DIR = "checkpoints"
+    SEGMENTS_DIR = "segments"
+
+def style_name(model_dir):
+    """
+    returns the name of the style a model dir holds, e.g. mosaic for models/mosaic
+    """
+    return os.path.basename(os.path.normpath(model_dir))
+
+def check_model_dirs(model_dirs):
+    """
+    raise a ValueError if a model dir is not a relative path inside the mount
+    or two model dirs have the same style name, their output frames and videos
+    would overwrite each other
+    """
+    styles = {}
+    for model_dir in model_dirs:
+        path = os.path.normpath(model_dir)
+        outside = path.split(os.sep)[0] == os.pardir
+        if os.path.isabs(path) or path == os.curdir or outside:
+            raise ValueError(
+                "model dir {!r} is not a path inside the mount".format(model_dir)
+            )
+        style = style_name(model_dir)
+        if style in styles:
+            raise ValueError(
+                "model dirs {!r} and {!r} have the same style name {!r}".format(
+                    styles[style], model_dir, style
+                )
+            )
+        styles[style] = model_dir
+
+def output_dir_name(style=None):
+    """
+    returns the name of the dir output frames are written to, a video rendered
+    in several styles gets one output_frames_<style> dir per style
+    """
+    if style is None:
+        return Storage.OUTPUT_DIR.value
+    return "{}_{}".format(Storage.OUTPUT_DIR.value, style)
 
 def get_handler_format():
     return logging.Formatter(
         "%(asctime)s [%(name)s:%(filename)s:%(lineno)s] %(levelname)s - %(message)s"
     )
+
+def tiling_options(tile_size, tile_overlap=32, tile_global_stats=False):
+    """
+    returns the tiling dict used by style_transfer, or None if tiling is off
+    """
+    if not tile_size:
+        return None
+    return {
+        "tile_size": tile_size,
+        "overlap": tile_overlap,
+        "global_stats": tile_global_stats,
+    }